@@ -0,0 +1,84 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+from typing import AsyncIterator, Iterator, Optional, Tuple
+
+# "local" stores the blobs on the filesystem under BLOB_STORE_PATH
+BLOB_STORE = os.environ.get("BLOB_STORE", "local")
+BLOB_STORE_PATH = os.environ.get("BLOB_STORE_PATH", "blobs")
+# Uploads and downloads are copied in chunks of this many bytes, never as a whole
+BLOB_CHUNK_SIZE = int(os.environ.get("BLOB_CHUNK_SIZE", str(1024 * 1024)))
+
+
+class LocalBlobStore:
+    """
+    Content-addressed blobs on the local filesystem: a blob is stored once under the SHA-256 of
+    its content, so uploading the same file twice does not use any extra space.
+    """
+
+    def __init__(self, root: str = BLOB_STORE_PATH):
+        self.root = root
+        os.makedirs(os.path.join(root, "tmp"), exist_ok=True)
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def exists(self, digest: str) -> bool:
+        return os.path.exists(self.path(digest))
+
+    def size(self, digest: str) -> int:
+        return os.path.getsize(self.path(digest))
+
+    async def put(self, chunks: AsyncIterator[bytes]) -> Tuple[str, int]:
+        """Streams `chunks` into the store and returns the SHA-256 hex digest and the size of the blob."""
+        loop = asyncio.get_running_loop()
+        sha = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.root, "tmp"))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                async for chunk in chunks:
+                    sha.update(chunk)
+                    size += len(chunk)
+                    await loop.run_in_executor(None, f.write, chunk)
+            digest = sha.hexdigest()
+            path = self.path(digest)
+            if os.path.exists(path):
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+            return digest, size
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def read(self, digest: str, start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+        """Yields the bytes `start` to `end` (inclusive, like HTTP ranges) of the blob in chunks."""
+        with open(self.path(digest), "rb") as f:
+            f.seek(start)
+            remaining = (end if end is not None else self.size(digest) - 1) - start + 1
+            while remaining > 0:
+                chunk = f.read(min(BLOB_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    def delete(self, digest: str):
+        if self.exists(digest):
+            os.remove(self.path(digest))
+
+
+_blob_store = None
+
+
+def get_blob_store():
+    global _blob_store
+    if _blob_store is None:
+        if BLOB_STORE != "local":
+            raise ValueError(f"Unknown blob store `{BLOB_STORE}`, expected `local`.")
+        _blob_store = LocalBlobStore()
+    return _blob_store
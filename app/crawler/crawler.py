@@ -1,14 +1,38 @@
+import asyncio
+import functools
 import os
+import sys
 import time
+from concurrent.futures import ProcessPoolExecutor
 from typing import Set
-from urllib.parse import urljoin, urlparse, urlunparse
+from urllib.parse import urljoin, urlparse
 from tqdm import tqdm
 
-import requests
+import aiohttp
 import validators
 from bs4 import BeautifulSoup
 
 import vector_database as db
+from dedup import DEDUP_REGISTRY_PATH, ChunkRegistry
+from frontier import FRONTIER_PATH, Frontier, SqliteFrontier, canonical_url
+from ingest import BatchWriter
+from manifest import MANIFEST_PATH, Manifest, content_hash
+from rag_conversation.index_versions import FAILED, READY, aliases, versioned_path
+
+DIR_NAME = "sites"
+MAX_WORKERS = int(os.environ.get("CRAWLER_WORKERS", "16"))
+MAX_PER_HOST = int(os.environ.get("CRAWLER_MAX_PER_HOST", "8"))
+# Minimum number of seconds between two requests to the same host
+POLITENESS_DELAY = float(os.environ.get("CRAWLER_DELAY", "0.05"))
+REQUEST_TIMEOUT = float(os.environ.get("CRAWLER_TIMEOUT", "30"))
+# Processes that parse and chunk the fetched pages, 0 parses on a thread of the crawler process
+PARSE_PROCESSES = int(os.environ.get("CRAWLER_PARSE_PROCESSES", str(os.cpu_count() or 1)))
+# Manifest key of the hand-written chunks from vector_database.absence_chunks
+ABSENCE_KEY = "absence"
+# A new index version is only switched to if it has at least this share of the live version's chunks
+INDEX_MIN_CHUNK_RATIO = float(os.environ.get("INDEX_MIN_CHUNK_RATIO", "0.8"))
+# Optional query the new version has to return a result for before it is switched to
+INDEX_PROBE_QUERY = os.environ.get("INDEX_PROBE_QUERY", "")
 
 
 def parse_urls(soup) -> Set[str]:
@@ -40,63 +64,363 @@ def refactor_links(target_hostname, target_path, base_url, links):
 	return refactored_links
 
 
-def get_next_url(urls, urls_crawled):
-	while True:
-		current = urls.pop()
-		if current not in urls_crawled:
-			return current
-		if len(urls) == 0:
-			return None
+class HostLimiter:
+	"""Caps concurrent requests per host and spaces out their start times."""
 
+	def __init__(self, max_per_host=MAX_PER_HOST, delay=POLITENESS_DELAY):
+		self.max_per_host = max_per_host
+		self.delay = delay
+		self._semaphores = {}
+		self._locks = {}
+		self._last_request = {}
 
-def crawl(start_url: str, save_documents: bool = False, max_pages: int = 1000, target_host: str = "www.cit.tum.de", target_path: str = "/cit"):
-	urls: Set[str] = set()
-	urls_crawled: Set[str] = set()
-	urls.add(start_url)
-	DIR_NAME = "sites"
+	async def acquire(self, host):
+		if host not in self._semaphores:
+			self._semaphores[host] = asyncio.Semaphore(self.max_per_host)
+			self._locks[host] = asyncio.Lock()
+		await self._semaphores[host].acquire()
+		async with self._locks[host]:
+			wait = self._last_request.get(host, 0) + self.delay - time.monotonic()
+			if wait > 0:
+				await asyncio.sleep(wait)
+			self._last_request[host] = time.monotonic()
+
+	def release(self, host):
+		self._semaphores[host].release()
+
+
+class CrawlStats:
+	def __init__(self):
+		self.started = time.monotonic()
+		self.fetched = 0
+		self.html_pages = 0
+		self.unchanged = 0
+		self.errors = 0
+		self.chunks = 0
+
+	@property
+	def elapsed(self):
+		return time.monotonic() - self.started
+
+	@property
+	def pages_per_second(self):
+		return self.fetched / self.elapsed if self.elapsed > 0 else 0.0
+
+	def __str__(self):
+		return (f"{self.fetched} pages ({self.html_pages} html, {self.unchanged} unchanged, {self.errors} errors, "
+				f"{self.chunks} new chunks) in {self.elapsed:.1f}s, {self.pages_per_second:.1f} pages/s")
+
+
+def process_page(html, url, target_host, target_path):
+	# Parsed once for both; the links are read first, chunking changes the tree
+	soup = BeautifulSoup(html, db.HTML_PARSER)
+	page_urls = refactor_links(target_host, target_path, url, parse_urls(soup))
+	return page_urls, db.get_soup_chunk(soup, url)
+
+
+def run_all(*callbacks):
+	for callback in callbacks:
+		if callback is not None:
+			callback()
+
+
+def save_page(url, html):
+	filename = f"{DIR_NAME}/{url.replace('/', '_').replace(':', '_')}.html"
+	with open(filename, 'w', encoding='utf-8') as file:
+		file.write(html)
+
+
+async def fetch(session, limiter, url, headers=None):
+	"""Returns the status, response headers and body of `url`; the body is None for non-HTML responses."""
+	host = urlparse(url).hostname
+	await limiter.acquire(host)
+	try:
+		async with session.get(url, headers=headers) as response:
+			content_type = response.headers.get("Content-Type", "")
+			if response.status != 200 or not content_type.startswith("text/html"):
+				return response.status, response.headers, None
+			return response.status, response.headers, await response.text()
+	finally:
+		limiter.release(host)
+
+
+async def crawl_async(start_url: str, save_documents: bool = False, max_pages: int = 1000,
+					  target_host: str = "www.cit.tum.de", target_path: str = "/cit",
+					  workers: int = MAX_WORKERS, limiter: HostLimiter = None, manifest: Manifest = None,
+					  writer: BatchWriter = None, processes: int = PARSE_PROCESSES, frontier: Frontier = None,
+					  registry: ChunkRegistry = None):
+	"""
+	Crawls from `start_url` and ingests the pages as a pipeline: fetch workers hand the HTML to a
+	process pool that parses and chunks it, and the chunks go to a BatchWriter that embeds and
+	upserts them in fixed-size batches. Bounded queues between the stages keep the memory use flat.
+	With a manifest, unchanged pages are skipped via conditional requests and content hashes, only
+	new chunks are written and stale ones deleted, and the manifest is saved after every batch.
+	A page only counts as done in the frontier once its chunks are written, so a crawl resumed from a
+	SqliteFrontier picks up exactly the pages whose results were lost. Repeated chunks (sidebars,
+	contact boxes) are collapsed by the ChunkRegistry into one chunk listing all its sources. Pages
+	are tracked by their canonical URL, whichever spelling of it was queued.
+	"""
+	frontier = frontier if frontier is not None else Frontier()
+	registry = registry if registry is not None else ChunkRegistry(":memory:")
+	frontier.add(start_url)
+	limiter = limiter or HostLimiter()
+	writer = writer or BatchWriter(manifest)
+	stats = CrawlStats()
+	# Pages of an interrupted earlier run count against `max_pages`
+	visited = {canonical_url(url) for url in frontier.done()}
+	budget = max_pages - len(visited)
+	if visited:
+		print(f"Resuming crawl with {len(visited)} pages done and {len(frontier)} queued")
+	pages = asyncio.Queue(maxsize=2 * max(processes, 1))
 	if save_documents and not os.path.exists(f"./{DIR_NAME}"):
 		os.makedirs(f"./{DIR_NAME}")
-	chunks = []
-	with requests.Session() as session:
-		for count_pages in tqdm(range(max_pages)):
+	loop = asyncio.get_running_loop()
+	progress = tqdm(total=max_pages, initial=len(visited))
 
-			current_url = get_next_url(urls, urls_crawled)
-			if current_url is None:
-				break
-			response = session.get(url=current_url)
+	async def fetcher(session):
+		while True:
+			current_url = await frontier.get()
+			key = canonical_url(current_url)
+			queued = False
+			mark_done = True
+			try:
+				if stats.fetched >= budget:
+					mark_done = False
+					continue
+				stats.fetched += 1
+				progress.update(1)
+				headers = manifest.conditional_headers(key) if manifest is not None else None
+				try:
+					status, response_headers, html = await fetch(session, limiter, current_url, headers)
+				except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+					stats.errors += 1
+					print(f"Failed to fetch {current_url}: {e!r}")
+					visited.add(key)
+					continue
+				visited.add(key)
+				if status in (404, 410) or (status == 200 and html is None):
+					# The page is gone (or no longer HTML) and loses its chunks
+					if manifest is not None and key in manifest:
+						_, upserts, upsert_ids, removed_ids = registry.diff(
+							key, [], manifest.get(key).get("chunk_ids", []))
+						await writer.add(upserts, upsert_ids, removed_ids, functools.partial(
+							run_all, functools.partial(manifest.remove, key),
+							functools.partial(frontier.mark_done, current_url)))
+						mark_done = False
+					continue
+				etag, last_modified = response_headers.get("ETag"), response_headers.get("Last-Modified")
+				html_hash = content_hash(html) if html is not None else None
+				if manifest is not None and key in manifest and (
+						status == 304 or (html_hash is not None and html_hash == manifest.get(key).get("hash"))):
+					stats.unchanged += 1
+					manifest.touch(key, etag, last_modified)
+					frontier.add_all(manifest.links(key))
+					continue
+				if html is None:
+					continue
+				stats.html_pages += 1
+				# Blocks while the parsers are behind; the URL is done once its page is parsed
+				await pages.put((current_url, html, html_hash, etag, last_modified))
+				queued = True
+			except BaseException:
+				mark_done = False
+				raise
+			finally:
+				if not queued:
+					frontier.task_done(current_url, mark_done)
 
-			content_type = response.headers.get("Content-Type")
+	async def parser(pool):
+		while True:
+			current_url, html, html_hash, etag, last_modified = await pages.get()
+			key = canonical_url(current_url)
+			mark_done = True
+			try:
+				try:
+					page_urls, page_chunks = await loop.run_in_executor(
+						pool, process_page, html, current_url, target_host, target_path)
+				except Exception as e:
+					stats.errors += 1
+					print(f"Failed to process {current_url}: {e!r}")
+					continue
+				frontier.add_all(page_urls)
+				if save_documents:
+					save_page(current_url, html)
+				old_ids = manifest.get(key).get("chunk_ids", []) if manifest is not None else []
+				page_ids, new_chunks, new_ids, removed_ids = registry.diff(key, page_chunks, old_ids)
+				update = None
+				if manifest is not None:
+					update = functools.partial(manifest.update, key, page_chunks, html_hash, page_urls, etag,
+											   last_modified, page_ids)
+				stats.chunks += len(new_chunks)
+				# Blocks while the writer is behind
+				await writer.add(new_chunks, new_ids, removed_ids, functools.partial(
+					run_all, update, functools.partial(frontier.mark_done, current_url)))
+				# Marked done once its batch is committed
+				mark_done = False
+			except BaseException:
+				mark_done = False
+				raise
+			finally:
+				frontier.task_done(current_url, mark_done)
 
-			if content_type != "text/html; charset=utf-8":
-				urls_crawled.add(current_url)
-				continue
+	connector = aiohttp.TCPConnector(limit=workers, limit_per_host=limiter.max_per_host)
+	timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+	pool = ProcessPoolExecutor(processes) if processes > 0 else None
+	writer.start()
+	try:
+		async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+			tasks = [asyncio.create_task(fetcher(session)) for _ in range(workers)]
+			tasks += [asyncio.create_task(parser(pool)) for _ in range(max(processes, 1))]
+			join = asyncio.create_task(frontier.join())
+			try:
+				# The workers only stop when they fail, e.g. because the writer could not write a batch
+				await asyncio.wait([join, *tasks], return_when=asyncio.FIRST_COMPLETED)
+				for task in tasks:
+					if task.done():
+						raise task.exception()
+			finally:
+				join.cancel()
+				for task in tasks:
+					task.cancel()
+				await asyncio.gather(*tasks, return_exceptions=True)
+				progress.close()
+	except BaseException:
+		writer.cancel()
+		raise
+	finally:
+		if pool is not None:
+			pool.shutdown(cancel_futures=True)
+	# After a complete crawl, pages that are no longer linked lose their chunks
+	if manifest is not None and stats.fetched < budget:
+		for url in manifest.urls():
+			if url not in visited and url != ABSENCE_KEY:
+				_, upserts, upsert_ids, removed_ids = registry.diff(url, [], manifest.get(url).get("chunk_ids", []))
+				await writer.add(upserts, upsert_ids, removed_ids, functools.partial(manifest.remove, url))
+	await writer.close()
+	frontier.clear()
+	print(f"Crawled {stats}, wrote {writer.written} chunks in {writer.batches} batches, deleted {writer.deleted}, "
+		  f"collapsed {registry.exact} exact and {registry.near} near duplicates")
+	return stats
 
-			soup = BeautifulSoup(response.text, 'html.parser')
-			page_urls: Set[str] = parse_urls(soup)
-			page_urls = refactor_links(target_host, target_path, current_url, page_urls)
 
-			urls.update(page_urls)
-			urls_crawled.add(current_url)
+def crawl(start_url: str, save_documents: bool = False, max_pages: int = 1000, target_host: str = "www.cit.tum.de", target_path: str = "/cit"):
+	"""Crawls and returns the chunks of all pages, without writing them to the index."""
+	chunks = {}
+	writer = BatchWriter(upsert=lambda documents, ids: chunks.update(zip(ids, documents)),
+						 delete=lambda ids: [chunks.pop(id, None) for id in ids], flush=lambda: None)
+	asyncio.run(crawl_async(start_url, save_documents, max_pages, target_host, target_path, writer=writer))
+	return list(chunks.values())
 
-			filename = f"{DIR_NAME}/{current_url.replace('/', '_').replace(':', '_')}.html"
-			if save_documents:
-				if os.path.exists(filename):
-					os.remove(filename)
-				with open(filename, 'w', encoding='utf-8') as file:
-					file.write(response.text)
-			chunks += db.get_chunk(response.text, current_url)
-	return chunks
 
-	print(f"{urls_crawled=}")
-	print(f"{urls=}")
-	print(f"{count_pages=}")
+def recrawl(start_url: str, manifest: Manifest, max_pages: int = 1000, target_host: str = "www.cit.tum.de", target_path: str = "/cit",
+			version: str = None):
+	"""
+	Incrementally syncs the index version `version` with the site, saving the manifest after every
+	batch. An interrupted run is resumed from the frontier in CRAWLER_FRONTIER.
+	"""
+	db.use_version(version)
+	frontier = SqliteFrontier(versioned_path(FRONTIER_PATH, version))
+	registry = ChunkRegistry(versioned_path(DEDUP_REGISTRY_PATH, version))
+	try:
+		stats = asyncio.run(crawl_async(start_url, False, max_pages, target_host, target_path, manifest=manifest,
+										frontier=frontier, registry=registry))
+	finally:
+		frontier.close()
+		registry.close()
+	absence = db.absence_chunks()
+	absence_chunks, absence_ids, absence_removed = manifest.diff(ABSENCE_KEY, absence)
+	db.upsert_chunks(absence_chunks, absence_ids)
+	db.delete_chunks(absence_removed)
+	db.flush_chunks()
+	manifest.update(ABSENCE_KEY, absence)
+	manifest.save()
+	return stats
 
 
+def validate(chunks: int):
+	"""Returns why the version that was just built must not be served, or None."""
+	if chunks == 0:
+		return "it has no chunks"
+	live = aliases.live()
+	live_chunks = aliases.versions().get(live, {}).get("chunks") if live else None
+	if live_chunks and chunks < INDEX_MIN_CHUNK_RATIO * live_chunks:
+		return f"it has {chunks} chunks, the live version {live} has {live_chunks}"
+	if INDEX_PROBE_QUERY and not db.get_index().similarity_search(INDEX_PROBE_QUERY, k=1):
+		return f"it has no results for {INDEX_PROBE_QUERY!r}"
+	return None
 
 
-if __name__ == '__main__':
-	chunks = crawl("https://www.cit.tum.de/cit/studium", max_pages=5000, target_path="/cit/")
-	chunks += db.absence_chunks()
-	db.save_chunks(chunks)
+def collect_garbage():
+	"""Deletes the index versions beyond INDEX_KEEP_VERSIONS together with their crawl state."""
+	for version in aliases.expired():
+		db.drop_version(version)
+		for path in (MANIFEST_PATH, FRONTIER_PATH, DEDUP_REGISTRY_PATH):
+			for suffix in ("", "-wal", "-shm"):
+				if os.path.exists(versioned_path(path, version) + suffix):
+					os.remove(versioned_path(path, version) + suffix)
+		aliases.remove(version)
+		print(f"Deleted index version {version}")
 
 
+def seed(version, source):
+	"""
+	Starts the index version `version` as a copy of `source`: its chunks (vectors and keyword rows),
+	chunk registry and manifest. The crawl then only downloads pages that changed, using conditional
+	requests, and only embeds their new chunks. The manifest is copied last, so a seed that was
+	interrupted is redone by the next build.
+	"""
+	source_path = versioned_path(MANIFEST_PATH, source)
+	if not os.path.exists(source_path):
+		return
+	manifest = Manifest(source_path)
+	ids = sorted({id for url in manifest.urls() for id in manifest.get(url).get("chunk_ids", [])})
+	db.seed_version(source, version, ids)
+	registry = ChunkRegistry(versioned_path(DEDUP_REGISTRY_PATH, source))
+	try:
+		registry.copy_to(versioned_path(DEDUP_REGISTRY_PATH, version))
+	finally:
+		registry.close()
+	manifest.path = versioned_path(MANIFEST_PATH, version)
+	manifest.save()
+
+
+def build(start_url: str, max_pages: int = 1000, target_host: str = "www.cit.tum.de", target_path: str = "/cit"):
+	"""
+	Crawls into a new index version next to the served one, so the server never sees a half-built
+	index, and switches the alias to it once it passed validation. An interrupted build is resumed by
+	the next call. The new version starts as a copy of the live one, so only changed pages are
+	downloaded and embedded again.
+	"""
+	version = aliases.building() or aliases.create()
+	live = aliases.live()
+	print(f"Building index version {version}, serving {live}")
+	if live is not None and not os.path.exists(versioned_path(MANIFEST_PATH, version)):
+		seed(version, live)
+	stats = recrawl(start_url, Manifest(versioned_path(MANIFEST_PATH, version)), max_pages, target_host, target_path,
+					version)
+	chunks = len(db.get_keyword_index())
+	error = validate(chunks)
+	if error is not None:
+		aliases.update(version, state=FAILED, chunks=chunks)
+		print(f"Not switching to index version {version}: {error}")
+		return stats
+	aliases.update(version, state=READY, chunks=chunks)
+	previous = aliases.switch(version)
+	print(f"Switched index from version {previous} to {version} with {chunks} chunks")
+	collect_garbage()
+	return stats
+
+
+def rollback():
+	previous = aliases.previous()
+	if previous is None:
+		raise SystemExit("No earlier index version to roll back to")
+	aliases.switch(previous)
+	print(f"Rolled back index to version {previous}")
+
+
+if __name__ == '__main__':
+	if sys.argv[1:] == ["rollback"]:
+		rollback()
+	else:
+		build("https://www.cit.tum.de/cit/studium", max_pages=5000, target_path="/cit/")
@@ -0,0 +1,191 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+from typing import List, Optional, Set, Tuple
+
+import numpy as np
+from langchain.vectorstores.pinecone import Document
+
+DEDUP_REGISTRY_PATH = os.environ.get("DEDUP_REGISTRY", "chunks.sqlite3")
+# Chunks whose SimHashes differ in at most this many of the 64 bits are near-duplicates (at most 3,
+# the lookup splits the fingerprint into 4 bands of which one has to match exactly)
+DEDUP_MAX_DISTANCE = min(int(os.environ.get("DEDUP_MAX_DISTANCE", "3")), 3)
+# Shorter chunks are only collapsed when they are exact duplicates
+DEDUP_MIN_WORDS = int(os.environ.get("DEDUP_MIN_WORDS", "20"))
+
+WORD_PATTERN = re.compile(r"\w+")
+BANDS = 4
+
+
+def body(document: Document) -> str:
+    """Text of a chunk without the page specific description, which differs for the same box on two pages."""
+    description = document.metadata.get("description")
+    text = document.page_content
+    if description:
+        text = text.replace(f"Description: {description}", "", 1)
+    return text
+
+
+def exact_key(text: str) -> str:
+    return hashlib.sha256(" ".join(WORD_PATTERN.findall(text.lower())).encode("utf-8")).hexdigest()[:32]
+
+
+def simhash(text: str, shingle: int = 3) -> Optional[int]:
+    """64-bit SimHash over word shingles, None for texts shorter than DEDUP_MIN_WORDS."""
+    words = WORD_PATTERN.findall(text.lower())
+    if len(words) < max(DEDUP_MIN_WORDS, shingle):
+        return None
+    shingles = {" ".join(words[i:i + shingle]) for i in range(len(words) - shingle + 1)}
+    hashes = np.array([int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big")
+                       for s in shingles], dtype=np.uint64)
+    bits = np.unpackbits(hashes.byteswap().view(np.uint8).reshape(-1, 8), axis=1)
+    weights = bits.sum(axis=0, dtype=np.int64) * 2 - len(shingles)
+    return int("".join("1" if w > 0 else "0" for w in weights), 2)
+
+
+def bands(fingerprint: int) -> List[int]:
+    return [(fingerprint >> (16 * i)) & 0xFFFF for i in range(BANDS)]
+
+
+def to_signed(value: int) -> int:
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+class ChunkRegistry:
+    """
+    Every distinct chunk of the site, stored once: exact duplicates (same text after normalization)
+    and near-duplicates (SimHash within DEDUP_MAX_DISTANCE bits) of a chunk resolve to its ID. The
+    registry keeps the canonical text and the URLs of all pages that contain it, which go into the
+    `sources` metadata; a chunk is deleted once no page references it anymore.
+    """
+
+    def __init__(self, path: str = DEDUP_REGISTRY_PATH):
+        self.path = path
+        self.exact = 0
+        self.near = 0
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS chunks (id TEXT PRIMARY KEY, simhash INTEGER, "
+                           "b0 INTEGER, b1 INTEGER, b2 INTEGER, b3 INTEGER, content TEXT NOT NULL, "
+                           "metadata TEXT NOT NULL, sources TEXT NOT NULL DEFAULT '[]')")
+        for i in range(BANDS):
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS chunks_b{i} ON chunks (b{i})")
+        self._conn.commit()
+
+    def _near_duplicate(self, fingerprint: int) -> Optional[str]:
+        rows = self._conn.execute(
+            "SELECT id, simhash FROM chunks WHERE " + " OR ".join(f"b{i} = ?" for i in range(BANDS)),
+            bands(fingerprint))
+        for id, other in rows:
+            if other is not None and bin((other & 0xFFFFFFFFFFFFFFFF) ^ fingerprint).count("1") <= DEDUP_MAX_DISTANCE:
+                return id
+        return None
+
+    def _exists(self, id: str) -> bool:
+        return self._conn.execute("SELECT 1 FROM chunks WHERE id = ?", (id,)).fetchone() is not None
+
+    def _sources(self, id: str) -> List[str]:
+        row = self._conn.execute("SELECT sources FROM chunks WHERE id = ?", (id,)).fetchone()
+        return json.loads(row[0]) if row is not None else []
+
+    def resolve(self, document: Document, url: Optional[str] = None, claimed: Set[str] = frozenset()) -> Tuple[str, bool]:
+        """
+        ID of the canonical chunk for `document`, registering it if it is new, and whether that chunk
+        was edited. A near-duplicate of a chunk that only the page `url` contains is an edit of it: its
+        content is replaced, unless the page still contains the chunk itself (its ID is `claimed`).
+        """
+        text = body(document)
+        id = exact_key(text)
+        if self._exists(id):
+            self.exact += 1
+            return id, False
+        fingerprint = simhash(text)
+        if fingerprint is not None:
+            duplicate = self._near_duplicate(fingerprint)
+            if duplicate is not None:
+                if url is not None and duplicate not in claimed and self._sources(duplicate) == [url]:
+                    self._conn.execute(
+                        "UPDATE chunks SET simhash = ?, b0 = ?, b1 = ?, b2 = ?, b3 = ?, content = ?, metadata = ? "
+                        "WHERE id = ?", (to_signed(fingerprint), *bands(fingerprint), document.page_content,
+                                         json.dumps(document.metadata), duplicate))
+                    return duplicate, True
+                self.near += 1
+                return duplicate, False
+        self._conn.execute(
+            "INSERT INTO chunks (id, simhash, b0, b1, b2, b3, content, metadata) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (id, to_signed(fingerprint) if fingerprint is not None else None,
+             *(bands(fingerprint) if fingerprint is not None else [None] * BANDS),
+             document.page_content, json.dumps(document.metadata)))
+        return id, False
+
+    def _update(self, id: str, url: str, add: bool) -> Optional[Document]:
+        row = self._conn.execute("SELECT content, metadata, sources FROM chunks WHERE id = ?", (id,)).fetchone()
+        if row is None:
+            return None
+        content, metadata, sources = row[0], json.loads(row[1]), json.loads(row[2])
+        if add and url not in sources:
+            sources.append(url)
+        elif not add and url in sources:
+            sources.remove(url)
+        if not sources:
+            self._conn.execute("DELETE FROM chunks WHERE id = ?", (id,))
+            return None
+        self._conn.execute("UPDATE chunks SET sources = ? WHERE id = ?", (json.dumps(sources), id))
+        return Document(page_content=content, metadata={**metadata, "sources": sources})
+
+    def attach(self, id: str, url: str) -> Document:
+        """Records that the page `url` contains the chunk and returns the chunk to (re-)upsert."""
+        return self._update(id, url, True)
+
+    def detach(self, id: str, url: str) -> Optional[Document]:
+        """Returns the chunk to re-upsert with its remaining sources, or None when it has to be deleted."""
+        return self._update(id, url, False)
+
+    def diff(self, url: str, documents: List[Document], old_ids: List[str]) -> Tuple[List[str], List[Document], List[str], List[str]]:
+        """
+        Resolves the chunks of the page `url` and returns their IDs, the chunks to upsert with their
+        IDs (new and edited ones and shared ones whose sources changed) and the IDs no page references
+        anymore.
+        """
+        # Exact matches are resolved first, so a near-duplicate on the same page does not replace them
+        claimed = {id for id in (exact_key(body(document)) for document in documents) if self._exists(id)}
+        ids, edited = [], set()
+        for document in documents:
+            id, was_edited = self.resolve(document, url, claimed)
+            claimed.add(id)
+            ids.append(id)
+            if was_edited:
+                edited.add(id)
+        ids = list(dict.fromkeys(ids))
+        old = set(old_ids)
+        upserts, upsert_ids, removed = [], [], []
+        for id in ids:
+            if id not in old or id in edited:
+                upserts.append(self.attach(id, url))
+                upsert_ids.append(id)
+        for id in sorted(old - set(ids)):
+            document = self.detach(id, url)
+            if document is None:
+                removed.append(id)
+            else:
+                upserts.append(document)
+                upsert_ids.append(id)
+        self._conn.commit()
+        return ids, upserts, upsert_ids, removed
+
+    def copy_to(self, path: str):
+        """Replaces the registry at `path` with a consistent copy of this one."""
+        self._conn.commit()
+        target = sqlite3.connect(path)
+        try:
+            self._conn.backup(target)
+        finally:
+            target.close()
+
+    def close(self):
+        self._conn.commit()
+        self._conn.close()
@@ -0,0 +1,134 @@
+import asyncio
+import os
+import sqlite3
+from typing import Iterable, Optional, Set
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+FRONTIER_PATH = os.environ.get("CRAWLER_FRONTIER", "frontier.sqlite3")
+# Number of frontier changes after which they are committed to disk
+FRONTIER_CHECKPOINT_INTERVAL = int(os.environ.get("CRAWLER_FRONTIER_CHECKPOINT", "100"))
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+TRACKING_PARAMS = {"fbclid", "gclid", "dclid", "msclkid", "yclid", "mc_cid", "mc_eid", "_ga", "_gl"}
+
+
+def canonical_url(url: str) -> str:
+    """
+    Key under which a URL is deduplicated: lower-case scheme and host, no default port, fragment,
+    tracking parameters or trailing slash, and the query parameters sorted.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port is not None and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+    path = parts.path.rstrip("/") or "/"
+    query = sorted((key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+                   if key not in TRACKING_PARAMS and not key.startswith("utm_"))
+    return urlunsplit((scheme, host, path, urlencode(query), ""))
+
+
+class Frontier:
+    """FIFO queue of URLs still to crawl, deduplicated by their canonical URL against everything ever queued."""
+
+    def __init__(self):
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._seen: Set[str] = set()
+
+    def add(self, url: str) -> bool:
+        key = canonical_url(url)
+        if key in self._seen:
+            return False
+        self._seen.add(key)
+        self._queue.put_nowait(url.split("#")[0])
+        return True
+
+    def add_all(self, urls: Iterable[str]) -> int:
+        return sum(self.add(url) for url in urls)
+
+    async def get(self) -> Optional[str]:
+        return await self._queue.get()
+
+    def task_done(self, url: str, mark_done: bool = True):
+        self._queue.task_done()
+
+    def mark_done(self, url: str):
+        pass
+
+    def done(self) -> Set[str]:
+        """URLs finished by an earlier, interrupted run that this frontier resumes."""
+        return set()
+
+    async def join(self):
+        await self._queue.join()
+
+    def clear(self):
+        pass
+
+    def __len__(self):
+        return self._queue.qsize()
+
+
+class SqliteFrontier(Frontier):
+    """
+    Frontier persisted in SQLite: queued and finished URLs are checkpointed every
+    `checkpoint_interval` changes, so an interrupted crawl resumes with the URLs it had not finished.
+    A URL handed out by `get` stays queued on disk until it is marked done.
+    """
+
+    def __init__(self, path: str = FRONTIER_PATH, checkpoint_interval: int = FRONTIER_CHECKPOINT_INTERVAL):
+        super().__init__()
+        self.path = path
+        self.checkpoint_interval = checkpoint_interval
+        self._changes = 0
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS frontier (seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                           "key TEXT UNIQUE NOT NULL, url TEXT NOT NULL, done INTEGER NOT NULL DEFAULT 0)")
+        self._conn.commit()
+        self._done: Set[str] = set()
+        for key, url, done in self._conn.execute("SELECT key, url, done FROM frontier ORDER BY seq"):
+            self._seen.add(key)
+            if done:
+                self._done.add(url)
+            else:
+                self._queue.put_nowait(url)
+
+    def _changed(self):
+        self._changes += 1
+        if self._changes >= self.checkpoint_interval:
+            self.checkpoint()
+
+    def checkpoint(self):
+        self._conn.commit()
+        self._changes = 0
+
+    def add(self, url: str) -> bool:
+        if not super().add(url):
+            return False
+        self._conn.execute("INSERT OR IGNORE INTO frontier (key, url) VALUES (?, ?)", (canonical_url(url), url.split("#")[0]))
+        self._changed()
+        return True
+
+    def task_done(self, url: str, mark_done: bool = True):
+        """With `mark_done=False` the URL is only persisted as done by a later `mark_done`, e.g. once its chunks are written."""
+        if mark_done:
+            self.mark_done(url)
+        super().task_done(url)
+
+    def mark_done(self, url: str):
+        self._conn.execute("UPDATE frontier SET done = 1 WHERE key = ?", (canonical_url(url),))
+        self._changed()
+
+    def done(self) -> Set[str]:
+        return set(self._done)
+
+    def clear(self):
+        """Forgets the crawl after it finished, so the next one starts from scratch."""
+        self._conn.execute("DELETE FROM frontier")
+        self.checkpoint()
+
+    def close(self):
+        self.checkpoint()
+        self._conn.close()
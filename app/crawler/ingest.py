@@ -0,0 +1,122 @@
+import asyncio
+import os
+from typing import Callable, List, Optional, Sequence
+
+from langchain.vectorstores.pinecone import Document
+
+import vector_database as db
+from manifest import Manifest
+
+# Number of chunks embedded and upserted together
+INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", "100"))
+# Batches waiting to be written before the parse stage has to wait
+INGEST_MAX_PENDING_BATCHES = int(os.environ.get("INGEST_MAX_PENDING_BATCHES", "2"))
+
+
+class PendingPage:
+    def __init__(self, end: int, removed_ids: Sequence[str], commit: Optional[Callable[[], None]]):
+        # The page is complete once the first `end` buffered chunks are written
+        self.end = end
+        self.removed_ids = list(removed_ids)
+        self.commit = commit
+
+
+class BatchWriter:
+    """
+    Last stage of the ingest pipeline: buffers the chunks of parsed pages and embeds and upserts them
+    in batches of `batch_size` on a background task. A page's stale chunks are deleted and its
+    `commit` (the manifest update) runs only after all of its chunks are written, and the manifest is
+    saved after every batch, so a crash loses at most the batches that were still in flight.
+    Indexes that buffer their writes (the local store) are flushed once, when the writer is closed.
+    """
+
+    def __init__(self, manifest: Optional[Manifest] = None, batch_size: int = INGEST_BATCH_SIZE,
+                 max_pending: int = INGEST_MAX_PENDING_BATCHES, upsert=db.upsert_chunks, delete=db.delete_chunks, flush=db.flush_chunks):
+        self.manifest = manifest
+        self.batch_size = batch_size
+        self.upsert = upsert
+        self.delete = delete
+        self.flush = flush
+        self.written = 0
+        self.deleted = 0
+        self.batches = 0
+        # After a failed batch nothing else is written or committed, the next crawl redoes those pages
+        self.error: Optional[Exception] = None
+        self._chunks: List[Document] = []
+        self._ids: List[str] = []
+        self._pages: List[PendingPage] = []
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max(max_pending, 1))
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def add(self, chunks: List[Document], ids: List[str], removed_ids: Sequence[str] = (),
+                  commit: Optional[Callable[[], None]] = None):
+        """Queues the chunks of one page; blocks while the writer is `max_pending` batches behind."""
+        self.start()
+        if self.error is not None:
+            raise self.error
+        self._chunks.extend(chunks)
+        self._ids.extend(ids)
+        self._pages.append(PendingPage(len(self._chunks), removed_ids, commit))
+        while len(self._chunks) >= self.batch_size:
+            await self._emit(self.batch_size)
+
+    async def _emit(self, size: int):
+        done = [page for page in self._pages if page.end <= size]
+        self._pages = [page for page in self._pages if page.end > size]
+        for page in self._pages:
+            page.end -= size
+        batch = (self._chunks[:size], self._ids[:size], done)
+        self._chunks, self._ids = self._chunks[size:], self._ids[size:]
+        await self._queue.put(batch)
+
+    def _write(self, chunks: List[Document], ids: List[str], removed_ids: List[str]):
+        self.upsert(chunks, ids)
+        self.delete(removed_ids)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._queue.get()
+            if batch is None:
+                return
+            if self.error is not None:
+                continue
+            chunks, ids, pages = batch
+            # A shared chunk can be queued more than once when several pages add it; the last one has all sources
+            latest = dict(zip(ids, chunks))
+            ids, chunks = list(latest.keys()), list(latest.values())
+            removed_ids = [id for page in pages for id in page.removed_ids]
+            try:
+                await loop.run_in_executor(None, self._write, chunks, ids, removed_ids)
+            except Exception as e:
+                print(f"Failed to write a batch of {len(chunks)} chunks: {e!r}")
+                self.error = e
+                continue
+            # Manifest changes happen on the event loop, where the crawl reads the manifest
+            for page in pages:
+                if page.commit is not None:
+                    page.commit()
+            if self.manifest is not None:
+                self.manifest.save()
+            self.written += len(chunks)
+            self.deleted += len(removed_ids)
+            self.batches += 1
+
+    async def close(self):
+        """Writes the remaining chunks and waits until everything is committed."""
+        self.start()
+        if self._chunks or self._pages:
+            await self._emit(len(self._chunks))
+        await self._queue.put(None)
+        await self._task
+        if self.error is not None:
+            raise self.error
+        await asyncio.get_running_loop().run_in_executor(None, self.flush)
+
+    def cancel(self):
+        if self._task is not None:
+            self._task.cancel()
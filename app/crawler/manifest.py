@@ -0,0 +1,82 @@
+import hashlib
+import json
+import os
+from typing import Dict, List, Tuple
+
+from langchain.vectorstores.pinecone import Document
+
+MANIFEST_PATH = os.environ.get("CRAWLER_MANIFEST", "manifest.json")
+
+
+def content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def chunk_id(document: Document) -> str:
+    # Chunk IDs are derived from the content, so an unchanged chunk keeps its ID across crawls
+    return content_hash(f"{document.metadata.get('source', '')}\n{document.page_content}")[:32]
+
+
+class Manifest:
+    """Persisted record of every crawled URL: validators, content hash, outgoing links and chunk IDs."""
+
+    def __init__(self, path: str = MANIFEST_PATH):
+        self.path = path
+        self.entries: Dict[str, dict] = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+
+    def __contains__(self, url):
+        return url in self.entries
+
+    def urls(self):
+        return list(self.entries.keys())
+
+    def get(self, url) -> dict:
+        return self.entries.get(url, {})
+
+    def conditional_headers(self, url) -> dict:
+        entry = self.get(url)
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def links(self, url) -> List[str]:
+        return self.get(url).get("links", [])
+
+    def touch(self, url, etag=None, last_modified=None):
+        entry = self.entries.setdefault(url, {})
+        if etag:
+            entry["etag"] = etag
+        if last_modified:
+            entry["last_modified"] = last_modified
+
+    def diff(self, url, documents: List[Document]) -> Tuple[List[Document], List[str], List[str]]:
+        """Returns the documents (and their IDs) not yet indexed for `url` and the IDs that became stale."""
+        old_ids = set(self.get(url).get("chunk_ids", []))
+        new_ids = [chunk_id(document) for document in documents]
+        added = [(document, id) for document, id in zip(documents, new_ids) if id not in old_ids]
+        removed = sorted(old_ids - set(new_ids))
+        return [document for document, _ in added], [id for _, id in added], removed
+
+    def update(self, url, documents: List[Document], html_hash=None, links=None, etag=None, last_modified=None,
+               chunk_ids: List[str] = None):
+        entry = self.entries.setdefault(url, {})
+        entry["chunk_ids"] = chunk_ids if chunk_ids is not None else [chunk_id(document) for document in documents]
+        entry["hash"] = html_hash
+        entry["links"] = sorted(links or [])
+        entry["etag"] = etag
+        entry["last_modified"] = last_modified
+
+    def remove(self, url) -> List[str]:
+        return self.entries.pop(url, {}).get("chunk_ids", [])
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
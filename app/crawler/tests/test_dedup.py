@@ -0,0 +1,43 @@
+import os
+import sys
+
+from langchain.schema import Document
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dedup import ChunkRegistry  # noqa: E402
+
+URL = "https://www.cit.tum.de/cit/studium"
+WORDS = [f"word{i}" for i in range(120)]
+
+
+def page(words):
+    return [Document(page_content="\nText: " + " ".join(words), metadata={"source": URL})]
+
+
+def test_edited_chunk_of_a_recrawled_page_is_upserted():
+    for i in range(len(WORDS)):
+        registry = ChunkRegistry(":memory:")
+        ids, _, _, _ = registry.diff(URL, page(WORDS), [])
+        edited = WORDS[:i] + ["changed"] + WORDS[i + 1:]
+        new_ids, upserts, upsert_ids, removed = registry.diff(URL, page(edited), ids)
+        assert [document.page_content for document in upserts] == [page(edited)[0].page_content]
+        # Either the chunk was edited in place or, when the edit moved it too far, replaced by a new one
+        assert upsert_ids == new_ids and removed == sorted(set(ids) - set(new_ids))
+
+
+def test_near_duplicates_on_the_same_page_stay_collapsed():
+    registry = ChunkRegistry(":memory:")
+    variant = WORDS[:60] + ["changed"] + WORDS[61:]
+    ids, upserts, _, _ = registry.diff(URL, page(WORDS) + page(variant), [])
+    assert len(ids) == 1 and len(upserts) == 1
+    assert registry.diff(URL, page(WORDS) + page(variant), ids)[1] == []
+
+
+def test_near_duplicate_of_a_chunk_shared_with_another_page_is_collapsed():
+    registry = ChunkRegistry(":memory:")
+    ids, _, _, _ = registry.diff("https://www.cit.tum.de/cit/other", page(WORDS), [])
+    variant = WORDS[:60] + ["changed"] + WORDS[61:]
+    new_ids, upserts, _, _ = registry.diff(URL, page(variant), [])
+    assert new_ids == ids
+    assert upserts[0].page_content == page(WORDS)[0].page_content
@@ -1,62 +1,176 @@
 from bs4 import BeautifulSoup
+import bisect
 import re
 import copy
 import os
-from langchain.vectorstores import Pinecone
 from langchain.vectorstores.pinecone import Document
 from langchain.embeddings import OpenAIEmbeddings
 import markdownify
+from rag_conversation.embedding_cache import CachedEmbeddings
+from rag_conversation.index_versions import versioned_path
+from rag_conversation.keyword_index import KEYWORD_INDEX_PATH, KeywordIndex
+from rag_conversation.vectorstore import VECTOR_STORE, copy_version, delete_version, get_vectorstore
 from langchain.document_loaders import WebBaseLoader
 from os import listdir
 from os.path import isfile, join
 
 PATH = "sites"
 
-if os.environ.get("PINECONE_API_KEY", None) is None:
-    raise Exception("Missing `PINECONE_API_KEY` environment variable.")
+try:
+    import lxml  # noqa: F401
+    DEFAULT_PARSER = "lxml"
+except ImportError:
+    DEFAULT_PARSER = "html.parser"
+# "lxml" is several times faster than the pure Python "html.parser", which is used when lxml is missing
+HTML_PARSER = os.environ.get("CHUNK_PARSER", DEFAULT_PARSER)
 
-if os.environ.get("PINECONE_ENVIRONMENT", None) is None:
-    raise Exception("Missing `PINECONE_ENVIRONMENT` environment variable.")
-
-PINECONE_INDEX_NAME = os.environ.get("PINECONE_INDEX", "langchain-test")
+HEADINGS = ['h2', 'h3', 'h4', 'h5', 'h6']
+WHITESPACE_PATTERNS = [re.compile('\r{2,}'), re.compile('\t{2,}'), re.compile('\n{2,}')]
+SPACES_PATTERN = re.compile(' {2,}')
 
 
 def fix_whitespaces(text):
-    text = re.sub('\r{2,}',' ', text)
-    text = re.sub('\t{2,}',' ', text)
-    text = re.sub('\n{2,}', ' ', text)
-    return re.sub(' {2,}', ' ', text)
+    for pattern in WHITESPACE_PATTERNS:
+        text = pattern.sub(' ', text)
+    return SPACES_PATTERN.sub(' ', text)
+
+
+def get_embeddings():
+    return CachedEmbeddings(OpenAIEmbeddings())
 
 
 def save_chunks(documents):
-    vectorstore = Pinecone.from_documents(
-        documents=documents, embedding=OpenAIEmbeddings(), index_name=PINECONE_INDEX_NAME
-    )
+    vectorstore = get_vectorstore(get_embeddings())
+    vectorstore.add_documents(documents)
+    flush_index(vectorstore)
     retriever = vectorstore.as_retriever()
-    print(f"Content saved to pinecone index {PINECONE_INDEX_NAME}")
+    print(f"Content saved to {VECTOR_STORE} index")
     return retriever
 
 
-def get_description(whole_soup, div):
-    headings = []
-    if whole_soup.find("nav", class_='breadcrumbs').find_all('li') is not None:
-        headings += [breadcrumbs.text for breadcrumbs in whole_soup.find("nav", class_='breadcrumbs').find_all('li')]
-    if whole_soup.find('h1') is not None:
-        headings.append(whole_soup.find('h1').text)
-    headings += [div.find_previous(h).text for h in ['h2', 'h3', 'h4', 'h5', 'h6'] if
-                 div.find_previous(h) is not None]
+_index = None
+_keyword_index = None
+# Index version the chunks are written to, None writes to the unversioned index
+_version = None
+
+
+def use_version(version):
+    global _index, _keyword_index, _version
+    _index, _keyword_index, _version = None, None, version
+
+
+def get_index():
+    # Shared by all batches of an ingest run, so the index is only opened once
+    global _index
+    if _index is None:
+        _index = get_vectorstore(get_embeddings(), version=_version)
+    return _index
+
+
+def get_keyword_index():
+    global _keyword_index
+    if _keyword_index is None:
+        _keyword_index = KeywordIndex(versioned_path(KEYWORD_INDEX_PATH, _version))
+    return _keyword_index
+
+
+def drop_version(version):
+    delete_version(get_embeddings(), version)
+    for suffix in ("", "-wal", "-shm"):
+        path = versioned_path(KEYWORD_INDEX_PATH, version) + suffix
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def flush_index(index):
+    # The local store keeps its writes in memory until it is flushed, Pinecone writes right away
+    if hasattr(index, "flush"):
+        index.flush()
+
+
+def flush_chunks():
+    if _index is not None:
+        flush_index(_index)
+
+
+def seed_version(source, target, ids):
+    """Copies the chunks `ids` of the index version `source` (vectors and keyword rows) into `target`."""
+    copy_version(get_embeddings(), source, target, ids)
+    KeywordIndex(versioned_path(KEYWORD_INDEX_PATH, source)).copy_to(versioned_path(KEYWORD_INDEX_PATH, target))
+    print(f"Copied {len(ids)} chunks from index version {source} to {target}")
+
+
+def upsert_chunks(documents, ids):
+    if not documents:
+        return
+    get_index().add_documents(documents, ids=ids)
+    get_keyword_index().add(documents, ids)
+    print(f"Upserted {len(documents)} chunks into {VECTOR_STORE} index and {get_keyword_index().path}")
+
+
+def delete_chunks(ids):
+    if not ids:
+        return
+    get_index().delete(ids=ids)
+    get_keyword_index().delete(ids)
+    print(f"Deleted {len(ids)} chunks from {VECTOR_STORE} index")
+
+
+class HeadingIndex:
+    """
+    The heading context of a page, built in one pass over the tags in document order: the closest
+    h2-h6 before an element (what `element.find_previous(h)` finds) becomes a binary search, and the
+    breadcrumbs and the h1 are only looked up once per page.
+    """
+
+    def __init__(self, soup):
+        self.soup = soup
+        self.positions = {}
+        self.headings = {h: ([], []) for h in HEADINGS}
+        for position, tag in enumerate(soup.find_all(True)):
+            self.positions[id(tag)] = position
+            if tag.name in self.headings:
+                positions, tags = self.headings[tag.name]
+                positions.append(position)
+                tags.append(tag)
+        self._prefix = None
+
+    @property
+    def prefix(self):
+        if self._prefix is None:
+            self._prefix = [breadcrumbs.text for breadcrumbs in self.soup.find("nav", class_='breadcrumbs').find_all('li')]
+            h1 = self.soup.find('h1')
+            if h1 is not None:
+                self._prefix.append(h1.text)
+        return self._prefix
+
+    def previous(self, tag, name):
+        positions, tags = self.headings[name]
+        i = bisect.bisect_left(positions, self.positions[id(tag)]) - 1
+        # Headings inside tables that were already converted to markdown are gone from the tree
+        while i >= 0 and tags[i].decomposed:
+            i -= 1
+        return tags[i] if i >= 0 else None
+
+
+def get_description(index, div):
+    headings = list(index.prefix)
+    for h in HEADINGS:
+        heading = index.previous(div, h)
+        if heading is not None:
+            headings.append(heading.text)
     description = ">".join(headings)
     return fix_whitespaces(description)
 
 
-def get_documents_content(soup, url, title, ignore):
+def get_documents_content(soup, index, url, title, ignore):
     content = soup.find("div", class_="content")
     top_layer_divs = [child for child in content.children if
                       child.name == 'div' and not (ignore & set(child.get('class', [])))]
-    return get_documents(content, soup, url, title, top_layer_divs)
+    return get_documents(content, index, url, title, top_layer_divs)
 
 
-def get_documents_sidebar(soup, url, title, ignore):
+def get_documents_sidebar(soup, index, url, title, ignore):
     sidebar = soup.find("div", class_="sidebar")
     if sidebar is None:
         return []
@@ -65,29 +179,34 @@ def get_documents_sidebar(soup, url, title, ignore):
     top_layer_divs = []
     for aside in aside_elements:
         top_layer_divs += aside.find_all('div')
-    return get_documents(sidebar, soup, url, title, top_layer_divs, False)
+    return get_documents(sidebar, index, url, title, top_layer_divs, False)
+
+
+def get_chunk(website, url, parser=HTML_PARSER):
+    return get_soup_chunk(BeautifulSoup(website, parser), url)
 
 
-def get_chunk(website, url):
-    soup = BeautifulSoup(website, 'html.parser')
+def get_soup_chunk(soup, url):
+    """Chunks of an already parsed page; tables in `soup` are replaced by their markdown on the way."""
+    index = HeadingIndex(soup)
     documents = []
     if soup.find("title") is None:
         title = "No title"
     else:
         title = soup.find("title").text.strip()
     ignore = {"frame-type-carousel"}
-    documents += get_documents_content(soup, url, title, ignore)
-    documents += get_documents_sidebar(soup, url, title, ignore)
+    documents += get_documents_content(soup, index, url, title, ignore)
+    documents += get_documents_sidebar(soup, index, url, title, ignore)
     return documents
 
 
-def get_documents(current_soup, whole_soup, url, title, top_layer_divs, heading=True, overlapping=1):
+def get_documents(current_soup, index, url, title, top_layer_divs, heading=True, overlapping=1):
     documents = []
     if current_soup is None:
         return documents
 
     for i in range(len(top_layer_divs)):
-        description = get_description(whole_soup, top_layer_divs[i])
+        description = get_description(index, top_layer_divs[i])
         text = ""
         if heading:
             text = "\nDescription: " + description + "\n"
@@ -104,7 +223,7 @@ def get_documents(current_soup, whole_soup, url, title, top_layer_divs, heading=
         text = fix_whitespaces(text)
         document = Document(
             page_content=text,
-            metadata={"source": url, "description": description, "title": title, "text":  text}
+            metadata={"source": url, "description": description, "title": title}
         )
         documents.append(document)
     return documents
@@ -118,7 +237,7 @@ def absence_chunks():
     title = "Beurlaubung"
     doc1 = Document(
         page_content=text,
-        metadata={"source": url, "description": description, "title": title, "text": text, "wizzard": 0}
+        metadata={"source": url, "description": description, "title": title, "wizzard": 0}
     )
     return [doc1]
 
@@ -0,0 +1,79 @@
+import asyncio
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Awaitable, Optional
+
+# Finished jobs are kept around for this many seconds so clients can still fetch the result
+JOB_RESULT_TTL = 15 * 60
+MAX_JOBS = 1000
+# Seconds a client is told to wait before submitting again when every job is still pending
+JOB_RETRY_AFTER = 5
+
+
+class JobStoreFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, coroutine: Awaitable[Any]):
+        self.id = str(uuid.uuid4())
+        self.created = time.time()
+        self.finished: Optional[float] = None
+        self.result = None
+        self.error: Optional[str] = None
+        self.task = asyncio.create_task(self._run(coroutine))
+
+    async def _run(self, coroutine: Awaitable[Any]):
+        try:
+            self.result = await coroutine
+        except Exception as e:
+            self.error = getattr(e, "detail", None) or repr(e)
+        finally:
+            self.finished = time.time()
+
+    @property
+    def status(self) -> str:
+        if self.finished is None:
+            return "pending"
+        return "failed" if self.error is not None else "done"
+
+    async def wait(self, timeout: Optional[float] = None):
+        await asyncio.wait_for(asyncio.shield(self.task), timeout)
+
+    def to_dict(self) -> dict:
+        return {"id": self.id, "status": self.status, "result": self.result, "error": self.error}
+
+
+class JobStore:
+    # Jobs only exist in this process, the server has to run with a single worker for polls to find them
+    def __init__(self):
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+
+    def _expire(self):
+        now = time.time()
+        for id, job in list(self._jobs.items()):
+            if job.finished is not None and now - job.finished > JOB_RESULT_TTL:
+                del self._jobs[id]
+        # Makes room for one more job by dropping the oldest finished ones; pending jobs are never dropped
+        finished = [id for id, job in self._jobs.items() if job.finished is not None]
+        for id in finished[:max(len(self._jobs) - MAX_JOBS + 1, 0)]:
+            del self._jobs[id]
+
+    def submit(self, coroutine: Awaitable[Any]) -> Job:
+        """Starts `coroutine` as a job; raises JobStoreFull when MAX_JOBS jobs are still pending."""
+        self._expire()
+        if len(self._jobs) >= MAX_JOBS:
+            if asyncio.iscoroutine(coroutine):
+                # Never started, closed so it is not reported as never awaited
+                coroutine.close()
+            raise JobStoreFull(f"{len(self._jobs)} jobs are still pending")
+        job = Job(coroutine)
+        self._jobs[job.id] = job
+        return job
+
+    def get(self, id: str) -> Optional[Job]:
+        return self._jobs.get(id)
+
+
+jobs = JobStore()
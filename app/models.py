@@ -1,10 +1,13 @@
 from fireo.models import Model
 from fireo.typedmodels import TypedModel
-from fireo.fields import TextField, DateTime, ListField, IDField, ReferenceField, Field, NestedModelField
+from fireo.fields import TextField, DateTime, ListField, IDField, ReferenceField, NestedModelField, NumberField
 
 
 class FileAttachment(Model):
-    content = Field()
+    # The content lives in the blob store under its SHA-256, the document only holds metadata
+    sha256 = TextField()
+    size = NumberField()
+    content_type = TextField()
     name = TextField()
     created = DateTime(auto=True)
 # class FileAttachment(TypedModel):
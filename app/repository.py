@@ -0,0 +1,144 @@
+import asyncio
+import datetime
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple, Type, TypeVar
+
+import fireo
+from fireo.database import db
+from fireo.models import Model
+from google.cloud.firestore_v1.transforms import Sentinel
+
+# "firestore" (also used with the emulator via FIRESTORE_EMULATOR_HOST) or "memory"
+REPOSITORY_BACKEND = os.environ.get("REPOSITORY_BACKEND", "firestore")
+# FireO is synchronous, its calls run on this many threads so they never block the event loop
+FIRESTORE_MAX_WORKERS = int(os.environ.get("FIRESTORE_MAX_WORKERS", "16"))
+# Firestore rejects batches with more than 500 writes
+FIRESTORE_BATCH_SIZE = 500
+
+ModelType = TypeVar("ModelType", bound=Model)
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def _project(model: Type[Model], id: str, data: dict, fields: Optional[List[str]]) -> dict:
+    if fields is None:
+        instance = model.from_dict(data, by_column_name=True)
+        instance.id = id
+        return instance.to_dict()
+    return {**{field: data.get(field) for field in fields}, "id": id, "key": f"{model.collection_name}/{id}"}
+
+
+class FirestoreRepository:
+    """Async access to the FireO models; every Firestore call runs on a bounded thread pool."""
+
+    def __init__(self, max_workers: int = FIRESTORE_MAX_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="firestore")
+
+    async def _run(self, fn: Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def save(self, instance: ModelType) -> ModelType:
+        return await self._run(instance.save)
+
+    async def save_all(self, instances: List[ModelType]) -> List[ModelType]:
+        def commit():
+            for i in range(0, len(instances), FIRESTORE_BATCH_SIZE):
+                batch = fireo.batch()
+                for instance in instances[i:i + FIRESTORE_BATCH_SIZE]:
+                    instance.save(batch=batch)
+                batch.commit()
+            return instances
+
+        return await self._run(commit)
+
+    async def get(self, model: Type[ModelType], id: str) -> Optional[ModelType]:
+        return await self._run(model.collection.get, id)
+
+    async def fetch_all(self, model: Type[ModelType]) -> List[ModelType]:
+        return await self._run(lambda: list(model.collection.fetch()))
+
+    async def delete(self, model: Type[ModelType], id: str):
+        await self._run(model.collection.delete, id)
+
+    async def list_page(self, model: Type[Model], order_by: str, limit: int, cursor: Optional[str] = None,
+                        fields: Optional[List[str]] = None) -> Tuple[List[dict], Optional[str]]:
+        """
+        Returns up to `limit` documents ordered by `order_by` (prefix "-" for descending), starting after
+        the document ID given as `cursor`, and the cursor of the next page. With `fields` only those
+        fields are read from Firestore.
+        """
+        def query():
+            ref = model.collection.order(order_by).query
+            if fields is not None:
+                ref = ref.select(fields)
+            if cursor:
+                snapshot = db.conn.collection(model.collection_name).document(cursor).get()
+                if not snapshot.exists:
+                    raise InvalidCursor(cursor)
+                ref = ref.start_after(snapshot)
+            docs = list(ref.limit(limit + 1).stream())
+            items = [_project(model, doc.id, doc.to_dict(), fields) for doc in docs[:limit]]
+            return items, docs[limit - 1].id if len(docs) > limit else None
+
+        return await self._run(query)
+
+
+class MemoryRepository:
+    """In-memory stand-in for FirestoreRepository, for tests and benchmarks without Firestore."""
+
+    def __init__(self):
+        self._collections: Dict[str, Dict[str, Model]] = {}
+
+    def _collection(self, model: Type[Model]) -> Dict[str, Model]:
+        return self._collections.setdefault(model.collection_name, {})
+
+    async def save(self, instance: ModelType) -> ModelType:
+        # Emulate the server side timestamps of DateTime(auto=True) fields
+        for name, field in instance._meta.field_list.items():
+            if getattr(instance, name, None) is None and isinstance(field.raw_attributes.get("default"), Sentinel):
+                setattr(instance, name, datetime.datetime.now(datetime.timezone.utc))
+        if instance.id is None:
+            instance.id = uuid.uuid4().hex
+        self._collection(type(instance))[instance.id] = instance
+        return instance
+
+    async def save_all(self, instances: List[ModelType]) -> List[ModelType]:
+        return [await self.save(instance) for instance in instances]
+
+    async def get(self, model: Type[ModelType], id: str) -> Optional[ModelType]:
+        return self._collection(model).get(id)
+
+    async def fetch_all(self, model: Type[ModelType]) -> List[ModelType]:
+        return list(self._collection(model).values())
+
+    async def delete(self, model: Type[ModelType], id: str):
+        self._collection(model).pop(id, None)
+
+    async def list_page(self, model: Type[Model], order_by: str, limit: int, cursor: Optional[str] = None,
+                        fields: Optional[List[str]] = None) -> Tuple[List[dict], Optional[str]]:
+        name = order_by.lstrip("-")
+        instances = sorted(self._collection(model).values(), key=lambda i: getattr(i, name),
+                           reverse=order_by.startswith("-"))
+        start = 0
+        if cursor:
+            ids = [instance.id for instance in instances]
+            if cursor not in ids:
+                raise InvalidCursor(cursor)
+            start = ids.index(cursor) + 1
+        page = instances[start:start + limit]
+        items = [i.to_dict() if fields is None else _project(model, i.id, i.to_dict(), fields) for i in page]
+        return items, page[-1].id if start + limit < len(instances) else None
+
+
+_repository = None
+
+
+def get_repository():
+    global _repository
+    if _repository is None:
+        _repository = MemoryRepository() if REPOSITORY_BACKEND == "memory" else FirestoreRepository()
+    return _repository
@@ -1,11 +1,18 @@
-from fastapi import APIRouter, Depends, HTTPException, UploadFile
+import asyncio
+import hashlib
+import json
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, UploadFile
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
+from ..jobs import JOB_RETRY_AFTER, JobStoreFull, jobs
 from ..models import Message, Conversation, ConversationSummary, Wizard
+from ..repository import InvalidCursor, get_repository
 from langchain.memory import ConversationSummaryMemory, ChatMessageHistory
 from langchain.chains import LLMChain
 from langchain.prompts import PromptTemplate
-from langchain.llms import OpenAI
-from .wizard import wizards
+from rag_conversation import factory
+from .wizard import validate_answers
 
 router = APIRouter(
     prefix="/conversation",
@@ -13,6 +20,8 @@ router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
+MAX_PAGE_SIZE = 200
+
 prompt = """Summarize the following conversation between an user and the assistant:
             Focus on the needs of the user.
             {conversation}
@@ -37,53 +46,105 @@ class ConversationInput(BaseModel):
     wizard_answers: list[str] | None
 
 
-@router.post("/", response_model=None)
-async def new_conv(conv: ConversationInput) -> dict:
+def get_wizard_answers(conv: ConversationInput) -> list[Wizard] | None:
+    if conv.wizard_id is None:
+        return None
+    return validate_answers(conv.wizard_id, conv.wizard_answers).to_models(conv.wizard_answers)
+
+
+async def summarize(conv: ConversationInput, wizard_answers: list[Wizard] | None, repository) -> dict:
     sumconv = ""
     # c = Conversation()
     # c.conversation = conv.conversation
     for message in conv.conversation:
         sumconv += f"{'Assistant' if message.author == 'bot' else 'User'}: {message.content}\n:"
 
-    chain = LLMChain(llm=OpenAI(), prompt=PromptTemplate.from_template(prompt))
-    summary = chain.run(sumconv)
-
-    chain = LLMChain(llm=OpenAI(), prompt=PromptTemplate.from_template(prompt_name))
-    title = chain.run(sumconv)
+    # Summary and title are generated concurrently without blocking the event loop
+    llm = factory.get("summary_llm")
+    summary_chain = LLMChain(llm=llm, prompt=PromptTemplate.from_template(prompt))
+    title_chain = LLMChain(llm=llm, prompt=PromptTemplate.from_template(prompt_name))
+    summary, title = await asyncio.gather(summary_chain.arun(sumconv), title_chain.arun(sumconv))
 
     con_summary = ConversationSummary()
     con_summary.summary = summary
     con_summary.title = title
-    if conv.wizard_id is not None:
-        if wizards[conv.wizard_id] is None:
-            raise HTTPException(status_code=404, detail="Wizard not found")
-        if len(wizards[conv.wizard_id]) != len(conv.wizard_answers):
-            raise HTTPException(status_code=404, detail="Wizard length not matching")
-        con_summary.wizard = []
-        for i in range(len(conv.wizard_answers)):
-            wiz_obj = wizards[conv.wizard_id][i]
-            wiz = Wizard()
-            if wiz_obj["type"] == "text":
-                wiz.question = wiz_obj["question"]
-                wiz.answer = conv.wizard_answers[i]
-            else:
-                wiz.question = wiz_obj["question"]
-                wiz.answer = wiz_obj["options"][int(conv.wizard_answers[i])]
-            con_summary.wizard.append(wiz)
+    if wizard_answers is not None:
+        con_summary.wizard = wizard_answers
     # c.save()
-    con_summary.save()
+    await repository.save(con_summary)
     return con_summary.to_dict()
 
 
+@router.post("/", response_model=None)
+async def new_conv(conv: ConversationInput, background: bool = False, repository=Depends(get_repository)):
+    """With `background=true` the summary is generated after responding; poll or stream it via /conversation/jobs/{id}."""
+    wizard_answers = get_wizard_answers(conv)
+    if background:
+        try:
+            job = jobs.submit(summarize(conv, wizard_answers, repository))
+        except JobStoreFull:
+            raise HTTPException(status_code=503, detail="Too many pending background jobs",
+                                headers={"Retry-After": str(JOB_RETRY_AFTER)})
+        return JSONResponse(job.to_dict(), status_code=202)
+    return await summarize(conv, wizard_answers, repository)
+
+
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+
+@router.get("/jobs/{job_id}/stream")
+async def stream_job(job_id: str):
+    """Server-sent events: `status` heartbeats while the job is pending and one final `result` event."""
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def events():
+        while job.finished is None:
+            try:
+                await job.wait(timeout=15)
+            except asyncio.TimeoutError:
+                yield f"event: status\ndata: {json.dumps({'id': job.id, 'status': job.status})}\n\n"
+        yield f"event: result\ndata: {json.dumps(job.to_dict(), default=str)}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
 @router.get("/")
-async def get_convs():
-    cs = ConversationSummary.collection.fetch()
-    ret = [c.to_dict() for c in cs]
-    ret.sort(key=lambda x: x["date"], reverse=True)
-    return ret
+async def get_convs(request: Request, limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+                    cursor: str | None = None, fields: str | None = None, repository=Depends(get_repository)):
+    """
+    Newest conversations first, `limit` per page. The cursor of the next page is returned in the
+    `X-Next-Cursor` header; `fields=title,date` only loads those fields, e.g. for the list view.
+    """
+    projection = None
+    if fields is not None:
+        projection = [field.strip() for field in fields.split(",") if field.strip()]
+        unknown = set(projection) - set(ConversationSummary._meta.field_list) - {"id"}
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+        projection = [field for field in projection if field != "id"]
+    try:
+        items, next_cursor = await repository.list_page(ConversationSummary, "-date", limit, cursor, projection)
+    except InvalidCursor:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    body = json.dumps(jsonable_encoder(items), separators=(",", ":")).encode("utf-8")
+    etag = f'W/"{hashlib.sha256(body).hexdigest()[:32]}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if next_cursor is not None:
+        headers["X-Next-Cursor"] = next_cursor
+    if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
 
 
 @router.delete("/{id}")
-async def delete_convs(id: str):
-    ConversationSummary.collection.delete(id)
+async def delete_convs(id: str, repository=Depends(get_repository)):
+    await repository.delete(ConversationSummary, id)
     return {"status": "ok"}
@@ -1,5 +1,9 @@
-from fastapi import APIRouter, Depends, HTTPException, UploadFile
+import re
+from fastapi import APIRouter, Depends, HTTPException, Request, UploadFile
+from fastapi.responses import Response, StreamingResponse
+from ..blobstore import BLOB_CHUNK_SIZE, get_blob_store
 from ..models import FileAttachment
+from ..repository import get_repository
 
 router = APIRouter(
     prefix="/file-upload",
@@ -7,13 +11,70 @@ router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+async def _chunks(file: UploadFile):
+    while chunk := await file.read(BLOB_CHUNK_SIZE):
+        yield chunk
+
+
+def parse_range(header: str | None, size: int) -> tuple[int, int] | None:
+    """Returns the inclusive (start, end) of a single byte range; None serves the whole file."""
+    match = RANGE_PATTERN.match(header.strip()) if header else None
+    if match is None or match.groups() == ("", ""):
+        return None
+    start, end = match.groups()
+    if start == "":
+        # Suffix range: the last `end` bytes; "bytes=-0" asks for none of them
+        suffix = int(end)
+        start, end = (max(size - suffix, 0), size - 1) if suffix > 0 else (size, size - 1)
+    else:
+        start = int(start)
+        # A last position before the first makes the header invalid, which is ignored like a missing one
+        if end and int(end) < start:
+            return None
+        end = min(int(end), size - 1) if end else size - 1
+    # Also covers every range of an empty file
+    if start >= size or start > end:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    return start, end
 
 
 @router.post("/")
-async def upload_file(file: UploadFile):
-    content = await file.read()
+async def upload_file(file: UploadFile, repository=Depends(get_repository), blobs=Depends(get_blob_store)):
+    digest, size = await blobs.put(_chunks(file))
     f = FileAttachment()
-    f.content = content
+    f.sha256 = digest
+    f.size = size
+    f.content_type = file.content_type
     f.name = file.filename
-    f.save()
+    await repository.save(f)
     return f.to_dict()
+
+
+@router.get("/{id}")
+async def download_file(id: str, request: Request, repository=Depends(get_repository), blobs=Depends(get_blob_store)):
+    f = await repository.get(FileAttachment, id)
+    if f is None or f.sha256 is None or not blobs.exists(f.sha256):
+        raise HTTPException(status_code=404, detail="File not found")
+    etag = f'"{f.sha256}"'
+    headers = {"Accept-Ranges": "bytes", "ETag": etag, "Cache-Control": "private, max-age=31536000, immutable"}
+    if f.name:
+        headers["Content-Disposition"] = 'attachment; filename="{}"'.format(f.name.replace('"', ""))
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    size = blobs.size(f.sha256)
+    byte_range = None
+    # A stale If-Range means the client's partial copy is outdated, so it gets the whole file
+    if request.headers.get("if-range", etag) == etag:
+        byte_range = parse_range(request.headers.get("range"), size)
+    media_type = f.content_type or "application/octet-stream"
+    if byte_range is None:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(blobs.read(f.sha256), media_type=media_type, headers=headers)
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(blobs.read(f.sha256, start, end), status_code=206, media_type=media_type, headers=headers)
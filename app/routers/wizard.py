@@ -1,7 +1,6 @@
-
-
-import re
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request, Response
+from pydantic import BaseModel
+from ..wizards import WizardDefinition, registry
 
 
 router = APIRouter(
@@ -11,48 +10,53 @@ router = APIRouter(
 )
 
 
-wizards = [
-    [
-        {
-            "id": 0,
-            "question": "What is your name?",
-            "validation": "^[a-zA-Z ]+$",
-            "type": "text"
-        },
-        {
-            "id": 1,
-            "question": "What is your enrollment number?",
-            "validation": "^[0-9]+$",
-            "type": "text"
-        },
-        {
-            "id": 2,
-            "question": "What is the reason of your application for leave of absence?",
-            "type": "checkbox",
-            "options": [
-                "illness",
-                "foreign study",
-                "maternity/parental leave",
-                "internship",
-                "care of a close relative",
-                "Formation of a company",
-                "Other"
-            ],
-            "validation": "^[0-6]$"
-        }
-    ]
-]
+class AnswersInput(BaseModel):
+    answers: list[str]
+
+
+def get_wizard(wizard_id: int) -> WizardDefinition:
+    wizard = registry.get(wizard_id)
+    if wizard is None:
+        raise HTTPException(status_code=404, detail="Wizard not found")
+    return wizard
+
+
+def validate_answers(wizard_id: int, answers: list[str] | None) -> WizardDefinition:
+    """The wizard, once `answers` answered each of its questions validly; raises 422 with the errors otherwise."""
+    wizard = get_wizard(wizard_id)
+    answers = answers or []
+    if len(answers) != len(wizard.questions):
+        raise HTTPException(status_code=422, detail="Wizard length not matching")
+    errors = wizard.errors(answers)
+    if errors:
+        raise HTTPException(status_code=422, detail={"errors": errors})
+    return wizard
 
 
 @router.get("/{wizard_id}")
-def start_wizard(wizard_id: int):
-    return wizards[wizard_id]
+def start_wizard(wizard_id: int, request: Request):
+    wizard = get_wizard(wizard_id)
+    headers = {"ETag": wizard.etag, "Cache-Control": "public, max-age=300"}
+    if wizard.etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(wizard.body, media_type="application/json", headers=headers)
+
+
+@router.post("/{wizard_id}/answers")
+def validate_all_answers(wizard_id: int, answers: AnswersInput):
+    """Validates the answers to all questions at once; the errors are listed by question ID."""
+    wizard = get_wizard(wizard_id)
+    if len(answers.answers) != len(wizard.questions):
+        raise HTTPException(status_code=422, detail="Wizard length not matching")
+    errors = wizard.errors(answers.answers)
+    return {"valid": not errors, "errors": errors}
 
 
 @router.post("/{wizard_id}/{question_id}")
 def validate_answer(wizard_id: int, question_id: int, answer: str):
-    wizard = wizards[wizard_id]
-    question = wizard[question_id]
-    if not re.match(question["validation"], answer): 
-        raise HTTPException(status_code=404, detail="Regex failed: " + question["validation"])
-    
\ No newline at end of file
+    question = get_wizard(wizard_id).question(question_id)
+    if question is None:
+        raise HTTPException(status_code=404, detail="Question not found")
+    error = question.error(answer)
+    if error is not None:
+        raise HTTPException(status_code=404, detail=error)
@@ -1,13 +1,74 @@
-from fastapi import FastAPI, UploadFile
-from fastapi.responses import RedirectResponse
+import asyncio
+import os
+import time
+import uuid
+
+BOOT_STARTED = time.perf_counter()
+
+from fastapi import FastAPI, Request, Response, UploadFile
+from fastapi.responses import PlainTextResponse, RedirectResponse
 from langserve import add_routes
 from rag_conversation import chain as rag_conversation_chain
+from rag_conversation import factory as rag_conversation_factory
+from rag_conversation import metrics, sources
+from starlette.datastructures import MutableHeaders
 from langserve.client import RemoteRunnable
 from fastapi.middleware.cors import CORSMiddleware
 from .routers import conversation, file, wizard
 
+# Build the chain components (LLM clients, vector store) in the background once the server is up
+WARMUP_ON_STARTUP = os.environ.get("WARMUP_ON_STARTUP", "true").lower() == "true"
+
 app = FastAPI()
 
+request_seconds = metrics.register(metrics.Histogram("http_request_duration_seconds", "Duration of HTTP requests"))
+
+
+class ServerTimingMiddleware:
+    """
+    Records the duration of every request and adds a Server-Timing header with the durations of the
+    chain's stages. The header is sent with the response start, so a streamed answer only reports
+    the stages finished before its first chunk.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        timings_id = uuid.uuid4().hex
+        timings = metrics.request_timings[timings_id] = metrics.RequestTimings()
+        scope.setdefault("state", {})[metrics.TIMINGS_KEY] = timings_id
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_timings(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = MutableHeaders(scope=message)
+                headers.append("Server-Timing", timings.header(time.perf_counter() - start))
+                # Lets the frontend read the timings through the Resource Timing API across origins
+                headers.append("Timing-Allow-Origin", "*")
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timings)
+        finally:
+            metrics.request_timings.pop(timings_id, None)
+            handler = getattr(scope.get("endpoint"), "__name__", "unmatched")
+            request_seconds.observe(time.perf_counter() - start, method=scope["method"], handler=handler,
+                                    status=str(status))
+
+
+def with_request_timings(config: dict, request: Request) -> dict:
+    """Tags the chain's runs with the request, so the stage timer reports into its Server-Timing header."""
+    timings_id = getattr(request.state, metrics.TIMINGS_KEY, None)
+    if timings_id is None:
+        return config
+    return {**config, "metadata": {**(config.get("metadata") or {}), metrics.TIMINGS_KEY: timings_id}}
+
 
 app.add_middleware(
     CORSMiddleware,
@@ -15,20 +76,64 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Response headers the frontend reads, browsers hide all others from cross-origin scripts
+    expose_headers=["Server-Timing", "ETag", "X-Next-Cursor", "Accept-Ranges", "Content-Range", "Content-Disposition"],
 )
+app.add_middleware(ServerTimingMiddleware)
 
 
 @app.get("/")
 async def redirect_root_to_docs():
     return RedirectResponse("/docs") 
 
+
+def warmup():
+    try:
+        rag_conversation_factory.warmup()
+    except Exception as e:
+        app.state.warmup_error = repr(e)
+        print(f"Warmup failed: {e!r}")
+
+
+@app.on_event("startup")
+async def startup():
+    app.state.boot_seconds = time.perf_counter() - BOOT_STARTED
+    app.state.warmup_error = None
+    if WARMUP_ON_STARTUP:
+        asyncio.get_running_loop().run_in_executor(None, warmup)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await sources.aclose()
+
+
+@app.get("/ready")
+async def ready(response: Response):
+    is_ready = rag_conversation_factory.is_ready()
+    if not is_ready:
+        response.status_code = 503
+    return {
+        "ready": is_ready,
+        "boot_seconds": getattr(app.state, "boot_seconds", None),
+        "components": rag_conversation_factory.timings,
+        "error": getattr(app.state, "warmup_error", None),
+    }
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics: stage and request latency histograms, LLM tokens and cache hits."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 app.include_router(file.router)
 app.include_router(conversation.router)
 app.include_router(wizard.router)
 
 
 # Edit this to add the chain you want to add
-add_routes(app, rag_conversation_chain, path="/rag-conversation")
+add_routes(app, rag_conversation_chain, path="/rag-conversation", per_req_config_modifier=with_request_timings)
 
 if __name__ == "__main__":
     import uvicorn
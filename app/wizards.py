@@ -0,0 +1,79 @@
+import hashlib
+import json
+import os
+import re
+from typing import Dict, List, NamedTuple, Optional, Pattern, Tuple
+
+from .models import Wizard
+
+# JSON file with the wizards: a list of {"id", "questions"}, read once at import
+WIZARDS_PATH = os.environ.get("WIZARDS_PATH", os.path.join(os.path.dirname(__file__), "wizards.json"))
+
+
+class Question(NamedTuple):
+    id: int
+    question: str
+    type: str
+    # Compiled once when the wizard is loaded, None accepts any answer
+    validation: Optional[Pattern]
+    # Answers of questions with options are indices into `options`
+    options: Tuple[str, ...]
+
+    def error(self, answer: str) -> Optional[str]:
+        """Why `answer` is not valid, or None if it is."""
+        if self.validation is not None and not self.validation.match(answer):
+            return "Regex failed: " + self.validation.pattern
+        if self.options:
+            if not answer.isdecimal() or int(answer) >= len(self.options):
+                return f"Option must be an index between 0 and {len(self.options) - 1}"
+        return None
+
+    def answer_text(self, answer: str) -> str:
+        return self.options[int(answer)] if self.options else answer
+
+
+class WizardDefinition:
+    def __init__(self, id: int, questions: List[dict]):
+        self.id = id
+        self.questions = [Question(question["id"], question["question"], question["type"],
+                                   re.compile(question["validation"]) if question.get("validation") else None,
+                                   tuple(question.get("options", ())))
+                          for question in questions]
+        self._by_id = {question.id: question for question in self.questions}
+        # The response of GET /wizard/{id} never changes while the process runs
+        self.body = json.dumps(questions, separators=(",", ":")).encode("utf-8")
+        self.etag = f'"{hashlib.sha256(self.body).hexdigest()[:32]}"'
+
+    def question(self, question_id: int) -> Optional[Question]:
+        return self._by_id.get(question_id)
+
+    def errors(self, answers: List[str]) -> Dict[int, str]:
+        """Errors by question ID of `answers`, which are given in question order."""
+        errors = {}
+        for question, answer in zip(self.questions, answers):
+            error = question.error(answer)
+            if error is not None:
+                errors[question.id] = error
+        return errors
+
+    def to_models(self, answers: List[str]) -> List[Wizard]:
+        """The validated `answers` as the question/answer pairs stored with a conversation."""
+        models = []
+        for question, answer in zip(self.questions, answers):
+            wizard = Wizard()
+            wizard.question = question.question
+            wizard.answer = question.answer_text(answer)
+            models.append(wizard)
+        return models
+
+
+class WizardRegistry:
+    def __init__(self, path: str = WIZARDS_PATH):
+        with open(path, "r", encoding="utf-8") as f:
+            self._wizards = {wizard["id"]: WizardDefinition(wizard["id"], wizard["questions"]) for wizard in json.load(f)}
+
+    def get(self, wizard_id: int) -> Optional[WizardDefinition]:
+        return self._wizards.get(wizard_id)
+
+
+registry = WizardRegistry()
@@ -0,0 +1,115 @@
+"""
+Benchmark of the HTML chunk extraction (`vector_database.get_chunk`) over a saved `sites/` corpus,
+e.g. the pages written by the crawler with `save_documents=True`.
+
+    python benchmarks/chunker.py [sites directory] [--repeat N]
+
+The original extractor (html.parser, breadcrumbs and `find_previous` per div) is kept here as the
+reference: every page is chunked with it and with the current extractor under each parser, and the
+resulting documents are compared.
+"""
+import argparse
+import os
+import sys
+import time
+
+import markdownify
+from bs4 import BeautifulSoup
+from langchain.schema import Document
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app", "crawler"))
+
+import vector_database as db  # noqa: E402
+
+
+def reference_description(whole_soup, div):
+    headings = []
+    if whole_soup.find("nav", class_='breadcrumbs').find_all('li') is not None:
+        headings += [breadcrumbs.text for breadcrumbs in whole_soup.find("nav", class_='breadcrumbs').find_all('li')]
+    if whole_soup.find('h1') is not None:
+        headings.append(whole_soup.find('h1').text)
+    headings += [div.find_previous(h).text for h in ['h2', 'h3', 'h4', 'h5', 'h6'] if
+                 div.find_previous(h) is not None]
+    return db.fix_whitespaces(">".join(headings))
+
+
+def reference_documents(whole_soup, url, title, top_layer_divs, heading=True, overlapping=1):
+    documents = []
+    for i in range(len(top_layer_divs)):
+        description = reference_description(whole_soup, top_layer_divs[i])
+        text = ""
+        if heading:
+            text = "\nDescription: " + description + "\n"
+        for j in range(i, min(i + overlapping, len(top_layer_divs))):
+            for table in top_layer_divs[j].find_all('table'):
+                try:
+                    text += markdownify.markdownify(str(table)).replace('\\*', '')
+                    table.decompose()
+                except TypeError:
+                    pass
+            text += "\nText: " + top_layer_divs[j].text + "\n"
+        text = db.fix_whitespaces(text)
+        documents.append(Document(
+            page_content=text,
+            metadata={"source": url, "description": description, "title": title}
+        ))
+    return documents
+
+
+def reference_chunk(website, url):
+    soup = BeautifulSoup(website, 'html.parser')
+    title = "No title" if soup.find("title") is None else soup.find("title").text.strip()
+    ignore = {"frame-type-carousel"}
+    content = soup.find("div", class_="content")
+    divs = [child for child in content.children if
+            child.name == 'div' and not (ignore & set(child.get('class', [])))]
+    documents = reference_documents(soup, url, title, divs)
+    sidebar = soup.find("div", class_="sidebar")
+    if sidebar is not None:
+        divs = []
+        for aside in sidebar.children:
+            if aside.name == 'aside' and not (ignore & set(aside.get('class', []))):
+                divs += aside.find_all('div')
+        documents += reference_documents(soup, url, title, divs, False)
+    return documents
+
+
+def run(name, chunk, pages, repeat):
+    results, failures = {}, 0
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for url, html in pages:
+            try:
+                results[url] = chunk(html, url)
+            except Exception:
+                results[url] = None
+                failures += 1
+    elapsed = time.perf_counter() - started
+    count = len(pages) * repeat
+    print(f"{name:<24} {elapsed:8.2f}s {count / elapsed:8.1f} pages/s {failures // repeat:6} failed")
+    return results, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", nargs="?", default=db.PATH)
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+
+    pages = []
+    for file in sorted(os.listdir(args.path)):
+        if os.path.isfile(os.path.join(args.path, file)):
+            with open(os.path.join(args.path, file), encoding="utf-8") as f:
+                pages.append((file, f.read()))
+    print(f"{len(pages)} pages, {sum(len(html) for _, html in pages) / 1e6:.1f} MB, repeat {args.repeat}")
+
+    reference, reference_elapsed = run("reference (html.parser)", reference_chunk, pages, args.repeat)
+    parsers = ["html.parser"] + (["lxml"] if db.DEFAULT_PARSER == "lxml" else [])
+    for name in parsers:
+        results, elapsed = run(f"get_chunk ({name})", lambda html, url: db.get_chunk(html, url, name), pages, args.repeat)
+        identical = sum(results[url] == reference[url] for url, _ in pages)
+        print(f"{'':<24} {reference_elapsed / elapsed:7.1f}x faster, {identical}/{len(pages)} pages identical")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""
+Deterministic local stand-ins for the external services, used by the load benchmark: chat and
+completion models, embeddings, the Mensa/room APIs and a Firestore repository, each with a
+configurable latency that is awaited (or slept on the calling thread for sync calls) per call.
+"""
+import asyncio
+import datetime
+import hashlib
+import random
+import time
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+import numpy as np
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
+from langchain.chat_models.base import BaseChatModel
+from langchain.llms.base import LLM
+from langchain.schema import AIMessage, BaseMessage, ChatGeneration, ChatResult
+from langchain.schema.embeddings import Embeddings
+from langchain.schema.messages import AIMessageChunk
+from langchain.schema.output import ChatGenerationChunk
+
+VOCABULARY = [
+    "studium", "informatik", "master", "bachelor", "modul", "prüfung", "anmeldung", "semester", "garching",
+    "mathematik", "hörsaal", "bibliothek", "tutorium", "vorlesung", "übung", "credits", "ects", "bewerbung",
+    "zulassung", "frist", "studienberatung", "auslandssemester", "praktikum", "thesis", "betreuer",
+    "lehrstuhl", "fakultät", "campus", "mensa", "raum", "stundenplan", "beurlaubung", "rückmeldung",
+    "semesterbeitrag", "immatrikulation", "exmatrikulation", "notenbescheinigung", "wahlmodul", "seminar",
+    "elektrotechnik", "mathematics", "computer", "science", "course", "exam", "registration", "deadline",
+    "application", "admission", "lecture", "exercise", "library", "schedule", "advisor", "department",
+]
+
+
+def words(seed: str, count: int) -> List[str]:
+    rng = random.Random(hashlib.sha256(seed.encode("utf-8")).digest())
+    return [rng.choice(VOCABULARY) for _ in range(count)]
+
+
+def _text(messages_or_prompt: Any) -> str:
+    if isinstance(messages_or_prompt, str):
+        return messages_or_prompt
+    return "\n".join(message.content for message in messages_or_prompt)
+
+
+class FakeChatModel(BaseChatModel):
+    """Answers with `answer_words` words derived from the prompt, after `latency` plus `token_latency` per word."""
+
+    latency: float = 0.0
+    token_latency: float = 0.0
+    answer_words: int = 40
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _tokens(self, messages: List[BaseMessage]) -> List[str]:
+        return [f"{word} " for word in words(_text(messages), self.answer_words)]
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        time.sleep(self.latency + self.token_latency * self.answer_words)
+        message = AIMessage(content="".join(self._tokens(messages)))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        await asyncio.sleep(self.latency + self.token_latency * self.answer_words)
+        message = AIMessage(content="".join(self._tokens(messages)))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self.latency)
+        for token in self._tokens(messages):
+            time.sleep(self.token_latency)
+            if run_manager:
+                run_manager.on_llm_new_token(token)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                       **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        await asyncio.sleep(self.latency)
+        for token in self._tokens(messages):
+            await asyncio.sleep(self.token_latency)
+            if run_manager:
+                await run_manager.on_llm_new_token(token)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+
+class FakeLLM(LLM):
+    """Completion model for the conversation summaries, answers like FakeChatModel."""
+
+    latency: float = 0.0
+    answer_words: int = 20
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-llm"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None,
+              run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> str:
+        time.sleep(self.latency)
+        return " ".join(words(prompt, self.answer_words))
+
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None,
+                     run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> str:
+        await asyncio.sleep(self.latency)
+        return " ".join(words(prompt, self.answer_words))
+
+
+class FakeEmbeddings(Embeddings):
+    """Hashed bag-of-words vectors, so texts sharing words are close, after `latency` per call."""
+
+    def __init__(self, size: int = 256, latency: float = 0.0):
+        self.size = size
+        self.latency = latency
+        self.calls = 0
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.size, dtype=np.float32)
+        for word in text.lower().split():
+            vector[int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=4).digest(), "big") % self.size] += 1
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.calls += 1
+        time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        self.calls += 1
+        time.sleep(self.latency)
+        return self._embed(text)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return self._embed(text)
+
+
+def mensa_week(year: int, week: int) -> dict:
+    monday = datetime.date.fromisocalendar(year, week, 1)
+    return {"days": [{"date": str(monday + datetime.timedelta(days=i)),
+                      "dishes": [{"name": " ".join(words(f"{year}-{week}-{i}-{j}", 3))} for j in range(6)]}
+                     for i in range(5)]}
+
+
+def rooms(count: int = 60) -> List[dict]:
+    return [{"gebaeude_name": "Weihenstephan" if i % 10 == 0 else f"Gebäude {i % 7}",
+             "raum_nr_architekt": f"{i % 7:02d}.0{i % 3}.{i:03d}", "raum_name": " ".join(words(f"room-{i}", 2))}
+            for i in range(count)]
+
+
+def _fixture(url: str):
+    if "eat-api" in url:
+        year, week = url.rsplit("/", 2)[-2:]
+        return mensa_week(int(year), int(week.split(".")[0]))
+    return {"raeume": rooms()}
+
+
+def fake_get_json(latency: float = 0.0):
+    """Replacement for `rag_conversation.sources._get_json` serving the Mensa and room fixtures."""
+
+    def get_json(url: str):
+        time.sleep(latency)
+        return _fixture(url)
+
+    return get_json
+
+
+def fake_aget_json(latency: float = 0.0):
+    """Replacement for `rag_conversation.sources._aget_json`, like `fake_get_json`."""
+
+    async def aget_json(url: str):
+        await asyncio.sleep(latency)
+        return _fixture(url)
+
+    return aget_json
+
+
+def slow_repository(repository_class, latency: float = 0.0):
+    """Subclass of a repository that waits `latency` seconds per call, like a round trip to Firestore."""
+
+    class SlowRepository(repository_class):
+        async def save(self, *args, **kwargs):
+            await asyncio.sleep(latency)
+            return await super().save(*args, **kwargs)
+
+        async def save_all(self, *args, **kwargs):
+            await asyncio.sleep(latency)
+            return await super().save_all(*args, **kwargs)
+
+        async def get(self, *args, **kwargs):
+            await asyncio.sleep(latency)
+            return await super().get(*args, **kwargs)
+
+        async def fetch_all(self, *args, **kwargs):
+            await asyncio.sleep(latency)
+            return await super().fetch_all(*args, **kwargs)
+
+        async def list_page(self, *args, **kwargs):
+            await asyncio.sleep(latency)
+            return await super().list_page(*args, **kwargs)
+
+        async def delete(self, *args, **kwargs):
+            await asyncio.sleep(latency)
+            return await super().delete(*args, **kwargs)
+
+    return SlowRepository()
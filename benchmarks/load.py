@@ -0,0 +1,316 @@
+"""
+Offline load benchmark of the service. OpenAI, Pinecone, Firestore and the Mensa/room APIs are
+replaced by the deterministic stand-ins in `fakes.py` with configurable latencies; requests go
+through the ASGI app in-process, so the numbers include routing, serialization and everything the
+app does on the event loop, but no network.
+
+    python benchmarks/load.py [--scenarios invoke,stream,...] [--concurrency 1,8,32] [--requests 200]
+                              [--llm-latency S] [--token-latency S] [--embedding-latency S]
+                              [--source-latency S] [--repository-latency S] [--pages N] [--json FILE]
+
+Every scenario is run at every concurrency level and reported with p50/p95/p99 latency and
+throughput; the crawler scenario crawls a generated site served from 127.0.0.1 and reports pages/s
+with as many fetch workers as the concurrency level.
+"""
+import argparse
+import asyncio
+import contextlib
+import http.server
+import itertools
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from typing import Awaitable, Callable, List
+
+import numpy as np
+
+WORK_DIR = tempfile.mkdtemp(prefix="benchmark-")
+# Set before the app is imported, its modules read them at import time
+for name, value in {
+    "REPOSITORY_BACKEND": "memory",
+    "WARMUP_ON_STARTUP": "false",
+    "VECTOR_STORE": "local",
+    "LOCAL_INDEX_PATH": os.path.join(WORK_DIR, "index"),
+    "KEYWORD_INDEX_PATH": os.path.join(WORK_DIR, "keywords.sqlite3"),
+    "INDEX_ALIAS_PATH": os.path.join(WORK_DIR, "index_alias.json"),
+    "BLOB_STORE_PATH": os.path.join(WORK_DIR, "blobs"),
+    "EMBEDDING_CACHE_PATH": os.path.join(WORK_DIR, "embeddings.sqlite"),
+}.items():
+    os.environ.setdefault(name, value)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "packages", "rag-conversation"))
+sys.path.insert(0, os.path.join(ROOT, "app", "crawler"))
+
+import httpx  # noqa: E402
+from langchain.schema import Document  # noqa: E402
+
+import fakes  # noqa: E402
+from app.repository import MemoryRepository, get_repository  # noqa: E402
+from app.server import app  # noqa: E402
+from app.models import ConversationSummary  # noqa: E402
+from rag_conversation import factory, sources  # noqa: E402
+from rag_conversation.embedding_cache import BatchedQueryEmbeddings, QueryCachedEmbeddings  # noqa: E402
+from rag_conversation.keyword_index import KeywordIndex  # noqa: E402
+from rag_conversation.local_store import LocalVectorStore  # noqa: E402
+
+SCENARIOS = ["invoke", "invoke-mensa", "stream", "conversation-post", "conversation-get", "file-upload", "crawl"]
+CORPUS_SIZE = 2000
+CONVERSATIONS = 500
+UPLOAD_SIZE = 256 * 1024
+DEVNULL = open(os.devnull, "w")
+
+
+class Result:
+    def __init__(self, scenario: str, concurrency: int, latencies: List[float], errors: int, elapsed: float,
+                 unit: str = "req", count: int = None):
+        self.scenario = scenario
+        self.concurrency = concurrency
+        self.latencies = latencies
+        self.count = len(latencies) if count is None else count
+        self.errors = errors
+        self.elapsed = elapsed
+        self.unit = unit
+
+    def percentile(self, q: float) -> float:
+        return float(np.percentile(self.latencies, q)) * 1000 if self.latencies else float("nan")
+
+    @property
+    def throughput(self) -> float:
+        return self.count / self.elapsed if self.elapsed else 0.0
+
+    def to_dict(self) -> dict:
+        return {"scenario": self.scenario, "concurrency": self.concurrency, "count": self.count,
+                "errors": self.errors, "p50_ms": self.percentile(50), "p95_ms": self.percentile(95),
+                "p99_ms": self.percentile(99), "throughput": self.throughput, "unit": f"{self.unit}/s"}
+
+    def __str__(self):
+        percentiles = " ".join(f"{self.percentile(q):>9.1f}" if self.latencies else f"{'-':>9}" for q in (50, 95, 99))
+        return (f"{self.scenario:<18} {self.concurrency:>5} {self.count:>7} {self.errors:>6} {percentiles} "
+                f"{self.throughput:>9.1f} {self.unit}/s")
+
+
+HEADER = (f"{'scenario':<18} {'conc':>5} {'count':>7} {'errors':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+          f"{'throughput':>13}")
+
+
+async def measure(scenario: str, request: Callable[[int], Awaitable[None]], total: int, concurrency: int,
+                  first: int = 0) -> Result:
+    """Runs requests `first` to `first + total`, `concurrency` at a time, and records the latency of each successful one."""
+    latencies: List[float] = []
+    errors = 0
+    counter = itertools.count(first)
+
+    async def worker():
+        nonlocal errors
+        for i in iter(lambda: next(counter), None):
+            if i >= first + total:
+                return
+            start = time.perf_counter()
+            try:
+                await request(i)
+            except Exception as e:
+                errors += 1
+                if errors == 1:
+                    print(f"{scenario}: {e!r}", file=sys.stderr)
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return Result(scenario, concurrency, latencies, errors, time.perf_counter() - start)
+
+
+def quiet(args):
+    """Silences the app's per-request prints while measuring, unless --verbose is given."""
+    if args.verbose:
+        return contextlib.nullcontext()
+    return contextlib.redirect_stdout(DEVNULL)
+
+
+def question(scenario: str, i: int) -> str:
+    # Distinct questions per scenario, so the answer and embedding caches only help as much as in production
+    return f"{' '.join(fakes.words(f'{scenario}-{i}', 6))} {i}?"
+
+
+def check(response: httpx.Response):
+    if response.status_code >= 400:
+        raise RuntimeError(f"{response.request.method} {response.request.url.path}: "
+                           f"{response.status_code} {response.text[:200]}")
+
+
+def install_fakes(args) -> MemoryRepository:
+    """Puts the stand-ins in place of every external service and builds the index from a generated corpus."""
+    embeddings = QueryCachedEmbeddings(BatchedQueryEmbeddings(fakes.FakeEmbeddings(latency=args.embedding_latency)))
+    documents = [Document(page_content=" ".join(fakes.words(f"chunk-{i}", 80)),
+                          metadata={"source": f"https://www.cit.tum.de/cit/p{i // 5}.html", "title": f"P{i // 5}"})
+                 for i in range(CORPUS_SIZE)]
+    ids = [f"chunk-{i}" for i in range(CORPUS_SIZE)]
+    # Built without latency, only queries pay for it
+    store = LocalVectorStore(fakes.FakeEmbeddings(), path=os.environ["LOCAL_INDEX_PATH"])
+    store.add_documents(documents, ids=ids)
+    store.flush()
+    store._embedding = embeddings
+    keyword_index = None
+    if args.retriever == "hybrid":
+        keyword_index = KeywordIndex(os.environ["KEYWORD_INDEX_PATH"])
+        keyword_index.add(documents, ids)
+
+    chat = fakes.FakeChatModel(latency=args.llm_latency, token_latency=args.token_latency)
+    for name, component in [("embeddings", embeddings), ("vectorstore", store),
+                            ("keyword_index", keyword_index), ("llm", chat), ("condense_llm", chat),
+                            ("summary_llm", fakes.FakeLLM(latency=args.llm_latency))]:
+        factory.override(name, component)
+    factory.warmup()
+    sources._get_json = fakes.fake_get_json(args.source_latency)
+    sources._aget_json = fakes.fake_aget_json(args.source_latency)
+
+    repository = fakes.slow_repository(MemoryRepository, args.repository_latency)
+    app.dependency_overrides[get_repository] = lambda: repository
+    return repository
+
+
+async def seed_conversations(repository):
+    for i in range(CONVERSATIONS):
+        summary = ConversationSummary()
+        summary.title = " ".join(fakes.words(f"title-{i}", 4))
+        summary.summary = " ".join(fakes.words(f"summary-{i}", 60))
+        await MemoryRepository.save(repository, summary)
+
+
+def requests_for(client: httpx.AsyncClient):
+    async def invoke(i):
+        check(await client.post("/rag-conversation/invoke",
+                                json={"input": {"question": question("invoke", i), "chat_history": []}}))
+
+    async def invoke_mensa(i):
+        check(await client.post("/rag-conversation/invoke",
+                                json={"input": {"question": f"What is served in the mensa on day {i}?",
+                                                "chat_history": []}}))
+
+    async def stream(i):
+        async with client.stream("POST", "/rag-conversation/stream",
+                                 json={"input": {"question": question("stream", i), "chat_history": []}}) as response:
+            check(response)
+            async for _ in response.aiter_bytes():
+                pass
+
+    async def conversation_post(i):
+        check(await client.post("/conversation/", json={"conversation": [
+            {"content": question("conversation", i), "author": "user", "created": None},
+            {"content": " ".join(fakes.words(f"answer-{i}", 40)), "author": "bot", "created": None},
+        ], "wizard_id": None, "wizard_answers": None}))
+
+    async def conversation_get(i):
+        check(await client.get("/conversation/", params={"limit": 50, "fields": "title,date"}))
+
+    async def file_upload(i):
+        content = np.random.default_rng(i).bytes(UPLOAD_SIZE)
+        check(await client.post("/file-upload/", files={"file": (f"file-{i}.bin", content, "application/octet-stream")}))
+
+    return {"invoke": invoke, "invoke-mensa": invoke_mensa, "stream": stream,
+            "conversation-post": conversation_post, "conversation-get": conversation_get,
+            "file-upload": file_upload}
+
+
+def write_site(path: str, pages: int):
+    """Linked pages in the layout of the CIT site that `vector_database.get_chunk` expects."""
+    os.makedirs(os.path.join(path, "cit"), exist_ok=True)
+    for i in range(pages):
+        links = "".join(f'<a href="/cit/p{(i * 7 + j) % pages}.html">link</a>' for j in range(1, 6))
+        sections = "".join(f"<h2>Section {j}</h2><div>{' '.join(fakes.words(f'page-{i}-{j}', 120))}</div>"
+                           for j in range(4))
+        html = (f'<html><head><title>P{i}</title></head><body><nav class="breadcrumbs"><ul><li>Home</li>'
+                f'<li>P{i}</li></ul></nav><h1>Page {i}</h1><div class="content">{sections}<div>{links}</div></div>'
+                f'<div class="sidebar"><aside><div>Studienberatung Garching</div></aside></div></body></html>')
+        with open(os.path.join(path, "cit", f"p{i}.html"), "w", encoding="utf-8") as f:
+            f.write(html)
+
+
+def serve_site(path: str) -> http.server.ThreadingHTTPServer:
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=path, **kwargs)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+async def crawl(args, concurrency: int, server) -> Result:
+    import crawler
+    from ingest import BatchWriter
+
+    chunks = {}
+    writer = BatchWriter(upsert=lambda documents, ids: chunks.update(zip(ids, documents)),
+                         delete=lambda ids: [chunks.pop(id, None) for id in ids])
+    with quiet(args):
+        stats = await crawler.crawl_async(f"http://127.0.0.1:{server.server_port}/cit/p0.html", max_pages=args.pages,
+                                          target_host="127.0.0.1", target_path="/cit", workers=concurrency,
+                                          limiter=crawler.HostLimiter(max_per_host=concurrency, delay=0),
+                                          writer=writer)
+    # The crawler does not time single pages, only its throughput is reported
+    return Result("crawl", concurrency, [], stats.errors, stats.elapsed, "pages", count=stats.fetched)
+
+
+async def run(args) -> List[Result]:
+    repository = install_fakes(args)
+    await seed_conversations(repository)
+    results = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+        requests = requests_for(client)
+        server = None
+        print(HEADER)
+        for scenario in args.scenarios:
+            for concurrency in args.concurrency:
+                if scenario == "crawl":
+                    if server is None:
+                        write_site(os.path.join(WORK_DIR, "site"), args.pages)
+                        server = serve_site(os.path.join(WORK_DIR, "site"))
+                    result = await crawl(args, concurrency, server)
+                else:
+                    with quiet(args):
+                        # A few requests first, so one-time costs do not land in the percentiles
+                        await measure(scenario, requests[scenario], min(concurrency, 4), concurrency,
+                                      first=args.requests)
+                        result = await measure(scenario, requests[scenario], args.requests, concurrency)
+                print(result)
+                results.append(result)
+        if server is not None:
+            server.shutdown()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", type=lambda s: s.split(","), default=SCENARIOS,
+                        help=f"comma separated, out of {','.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", type=lambda s: [int(c) for c in s.split(",")], default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario and concurrency level")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="seconds until the first token")
+    parser.add_argument("--token-latency", type=float, default=0.005, help="seconds per generated token")
+    parser.add_argument("--embedding-latency", type=float, default=0.05)
+    parser.add_argument("--source-latency", type=float, default=0.1, help="Mensa and room APIs")
+    parser.add_argument("--repository-latency", type=float, default=0.01, help="Firestore round trip")
+    parser.add_argument("--retriever", choices=["hybrid", "vector"], default="hybrid")
+    parser.add_argument("--pages", type=int, default=200, help="pages of the generated site for the crawl scenario")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="show what the app prints while measuring")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    results = asyncio.run(run(args))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"settings": {key: value for key, value in vars(args).items() if key not in ("json", "verbose")},
+                       "results": [result.to_dict() for result in results]}, f, indent=2)
@@ -1,3 +1,4 @@
 from rag_conversation.chain import chain
+from rag_conversation.factory import is_ready, warmup
 
-__all__ = ["chain"]
+__all__ = ["chain", "is_ready", "warmup"]
@@ -0,0 +1,271 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, Iterator, List, NamedTuple, Optional
+
+import numpy as np
+from langchain.schema.runnable import Runnable, RunnableConfig
+
+from rag_conversation import factory, metrics
+from rag_conversation.embedding_cache import normalize_text
+from rag_conversation.single_flight import SINGLE_FLIGHT_ENABLED, SingleFlight
+
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+# Minimum cosine similarity between two standalone questions to reuse an answer
+ANSWER_CACHE_THRESHOLD = float(os.environ.get("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", "1000"))
+ANSWER_CACHE_TTL = float(os.environ.get("ANSWER_CACHE_TTL", str(60 * 60)))
+
+
+class CachedAnswer(NamedTuple):
+    question: str
+    answer: str
+    index_version: str
+    context_hash: str
+    created: float
+
+
+def context_hash(context: str) -> str:
+    return hashlib.sha256(context.encode("utf-8")).hexdigest()
+
+
+def conversation_hash(question: str, chat_history: list) -> str:
+    # The answer prompt renders the original question and the chat history next to the context
+    history = [(getattr(message, "type", None), getattr(message, "content", message)) for message in chat_history or []]
+    return hashlib.sha256(json.dumps([question, history], default=str).encode("utf-8")).hexdigest()
+
+
+def text_key(question: str) -> str:
+    return normalize_text(question).lower()
+
+
+class SemanticAnswerCache:
+    """
+    LRU/TTL cache of answers keyed by the embedding of the standalone question. A lookup returns
+    the most similar entry above `threshold` that was answered from the same index version and
+    the same retrieved context. Questions without an embedding only match the same text.
+    """
+
+    def __init__(self, threshold: float = ANSWER_CACHE_THRESHOLD, max_entries: int = ANSWER_CACHE_SIZE,
+                 ttl: float = ANSWER_CACHE_TTL):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries: "OrderedDict[int, CachedAnswer]" = OrderedDict()
+        self._vectors: "OrderedDict[int, np.ndarray]" = OrderedDict()
+        self._texts: Dict[str, int] = {}
+        self._matrix = None
+        self._keys: List[int] = []
+        self._next_key = 0
+        self._lock = threading.Lock()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses,
+                "invalidations": self.invalidations, "hit_rate": self.hit_rate}
+
+    def _remove(self, key: int):
+        entry = self._entries.pop(key, None)
+        if entry is not None and self._texts.get(text_key(entry.question)) == key:
+            del self._texts[text_key(entry.question)]
+        if self._vectors.pop(key, None) is not None:
+            self._matrix = None
+
+    def _nearest(self, vector: np.ndarray) -> Optional[int]:
+        if not self._vectors:
+            return None
+        if self._matrix is None:
+            self._keys = list(self._vectors.keys())
+            self._matrix = np.stack(list(self._vectors.values()))
+        scores = self._matrix @ vector
+        best = int(np.argmax(scores))
+        return self._keys[best] if scores[best] >= self.threshold else None
+
+    def lookup(self, question: str, vector: Optional[np.ndarray], index_version: str, context: str) -> Optional[str]:
+        with self._lock:
+            key = self._texts.get(text_key(question))
+            if key is None and vector is not None:
+                key = self._nearest(vector)
+            entry = self._entries.get(key) if key is not None else None
+            if entry is None:
+                self.misses += 1
+                return None
+            if (time.monotonic() - entry.created > self.ttl or entry.index_version != index_version
+                    or entry.context_hash != context_hash(context)):
+                self._remove(key)
+                self.invalidations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.answer
+
+    def store(self, vector: Optional[np.ndarray], question: str, answer: str, index_version: str, context: str):
+        with self._lock:
+            key = self._next_key
+            self._next_key += 1
+            self._entries[key] = CachedAnswer(question, answer, index_version, context_hash(context), time.monotonic())
+            self._texts[text_key(question)] = key
+            if vector is not None:
+                self._vectors[key] = vector
+                self._matrix = None
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._vectors.clear()
+            self._texts.clear()
+            self._matrix = None
+
+
+answer_cache = SemanticAnswerCache()
+metrics.register_cache("answer", answer_cache)
+
+
+def _normalized(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def _cached_vector(question: str) -> Optional[np.ndarray]:
+    # The retriever embedded the question already, unless the keyword fast path answered it: those
+    # requests only match cached answers by their text instead of paying for an embedding
+    cached_query = getattr(factory.get("embeddings"), "cached_query", None)
+    vector = cached_query(question) if cached_query is not None else None
+    return _normalized(vector) if vector is not None else None
+
+
+class AnswerCacheRunnable(Runnable):
+    """
+    Wraps the answer generation of the chain. It expects the prepared chain input with the
+    `standalone_question`, the `context` and the `intent`; answers built from live data sources
+    (an intent was matched) or with a chat history in the prompt are never cached. Concurrent requests for the same question, chat history
+    and context share one LLM call, followers get the leader's chunks as they are generated.
+    """
+
+    def __init__(self, runnable: Runnable, cache: SemanticAnswerCache = answer_cache,
+                 enabled: bool = ANSWER_CACHE_ENABLED, single_flight: bool = SINGLE_FLIGHT_ENABLED):
+        self.runnable = runnable
+        self.cache = cache
+        self.enabled = enabled
+        self.single_flight = single_flight
+        self.flights = SingleFlight("answer")
+
+    @property
+    def InputType(self) -> Any:
+        return self.runnable.InputType
+
+    @property
+    def OutputType(self) -> Any:
+        return self.runnable.OutputType
+
+    def _cacheable(self, input: dict) -> bool:
+        # The answer prompt includes the chat history, an answer to one conversation does not fit another
+        return (self.enabled and input.get("intent") is None and bool(input.get("standalone_question"))
+                and not input.get("chat_history"))
+
+    def _lookup(self, input: dict):
+        if not self._cacheable(input):
+            return None, None
+        vector = _cached_vector(input["standalone_question"])
+        version = factory.index_version()
+        return (vector, version), self.cache.lookup(input["standalone_question"], vector, version, input["context"])
+
+    def _flight_key(self, input: dict):
+        if not self.single_flight or input.get("intent") is not None or not input.get("standalone_question"):
+            return None
+        return (text_key(input["standalone_question"]), context_hash(input["context"]),
+                conversation_hash(input.get("question"), input.get("chat_history")))
+
+    def _store(self, key, input: dict, answer: str):
+        if key is not None and answer:
+            vector, version = key
+            self.cache.store(vector, input["standalone_question"], answer, version, input["context"])
+
+    def invoke(self, input: dict, config: Optional[RunnableConfig] = None, **kwargs: Any) -> str:
+        key, answer = self._lookup(input)
+        if answer is not None:
+            return answer
+
+        def generate():
+            answer = self.runnable.invoke(input, config, **kwargs)
+            self._store(key, input, answer)
+            return answer
+
+        flight_key = self._flight_key(input)
+        return generate() if flight_key is None else self.flights.call(flight_key, generate)
+
+    async def ainvoke(self, input: dict, config: Optional[RunnableConfig] = None, **kwargs: Any) -> str:
+        key, answer = self._lookup(input)
+        if answer is not None:
+            return answer
+
+        async def generate():
+            answer = await self.runnable.ainvoke(input, config, **kwargs)
+            self._store(key, input, answer)
+            return answer
+
+        flight_key = self._flight_key(input)
+        return await (generate() if flight_key is None else self.flights.acall(flight_key, generate))
+
+    def transform(self, input: Iterator[dict], config: Optional[RunnableConfig] = None,
+                  **kwargs: Any) -> Iterator[str]:
+        final = None
+        for chunk in input:
+            final = chunk if final is None else final + chunk
+        yield from self.stream(final, config, **kwargs)
+
+    async def atransform(self, input: AsyncIterator[dict], config: Optional[RunnableConfig] = None,
+                         **kwargs: Any) -> AsyncIterator[str]:
+        final = None
+        async for chunk in input:
+            final = chunk if final is None else final + chunk
+        async for chunk in self.astream(final, config, **kwargs):
+            yield chunk
+
+    def stream(self, input: dict, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Iterator[str]:
+        key, answer = self._lookup(input)
+        if answer is not None:
+            yield answer
+            return
+
+        def generate():
+            chunks = []
+            for chunk in self.runnable.stream(input, config, **kwargs):
+                chunks.append(chunk)
+                yield chunk
+            self._store(key, input, "".join(chunks))
+
+        flight_key = self._flight_key(input)
+        yield from generate() if flight_key is None else self.flights.stream(flight_key, generate)
+
+    async def astream(self, input: dict, config: Optional[RunnableConfig] = None,
+                      **kwargs: Any) -> AsyncIterator[str]:
+        key, answer = self._lookup(input)
+        if answer is not None:
+            yield answer
+            return
+
+        async def generate():
+            chunks = []
+            async for chunk in self.runnable.astream(input, config, **kwargs):
+                chunks.append(chunk)
+                yield chunk
+            self._store(key, input, "".join(chunks))
+
+        flight_key = self._flight_key(input)
+        async for chunk in generate() if flight_key is None else self.flights.astream(flight_key, generate):
+            yield chunk
@@ -0,0 +1,144 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+_refresh_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="cache-refresh")
+# Loads of keys that hash to the same stripe wait for each other; the locks are reentrant, so a
+# loader may load another key of the same cache
+LOCK_STRIPES = 64
+
+
+class TTLCache:
+    """
+    Thread-safe cache whose entries are fresh for `ttl` seconds. For another `stale_ttl` seconds a
+    stale entry is still returned immediately while a single background refresh reloads it; after
+    that the caller waits for the reload. Concurrent misses for the same key share one load, and
+    failed background refreshes keep serving the stale value. `aget` does the same for async loaders
+    on the event loop, without a thread waiting for the load.
+    """
+
+    def __init__(self, ttl: float, stale_ttl: float = 0.0, max_entries: int = 128):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        # A fixed set of locks instead of one per key, which would keep a lock for every key ever loaded
+        self._key_locks = [threading.RLock() for _ in range(LOCK_STRIPES)]
+        self._refreshing = set()
+        # Async loads in progress by key, awaited by concurrent misses
+        self._loading: Dict[Hashable, asyncio.Future] = {}
+        self._tasks = set()
+
+    def _store(self, key: Hashable, value: Any):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _load(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        with self._key_locks[hash(key) % LOCK_STRIPES]:
+            # Another thread may have loaded the value while we were waiting
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                return entry[1]
+            value = loader()
+            self._store(key, value)
+            return value
+
+    def _refresh(self, key: Hashable, loader: Callable[[], Any]):
+        try:
+            self._store(key, loader())
+        except Exception as e:
+            print(f"Background refresh of {key!r} failed: {e!r}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def peek(self, key: Hashable) -> Any:
+        """The fresh value of `key`, or None; never loads and does not count as a hit or miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry[0] >= self.ttl:
+            return None
+        return entry[1]
+
+    def get(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None:
+            age = time.monotonic() - entry[0]
+            if age < self.ttl:
+                self.hits += 1
+                return entry[1]
+            if age < self.ttl + self.stale_ttl:
+                self.stale_hits += 1
+                with self._lock:
+                    schedule = key not in self._refreshing
+                    self._refreshing.add(key)
+                if schedule:
+                    _refresh_executor.submit(self._refresh, key, loader)
+                return entry[1]
+        self.misses += 1
+        return self._load(key, loader)
+
+    async def _aload(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        future = self._loading.get(key)
+        if future is not None and future.get_loop() is asyncio.get_running_loop():
+            return await asyncio.shield(future)
+        future = self._loading[key] = asyncio.get_running_loop().create_future()
+        try:
+            value = await loader()
+        except BaseException as e:
+            future.set_exception(e if isinstance(e, Exception) else RuntimeError(f"Loading {key!r} was interrupted"))
+            # Marks the exception as retrieved when nobody else was waiting for it
+            future.exception()
+            raise
+        else:
+            self._store(key, value)
+            future.set_result(value)
+            return value
+        finally:
+            if self._loading.get(key) is future:
+                del self._loading[key]
+
+    async def _arefresh(self, key: Hashable, loader: Callable[[], Awaitable[Any]]):
+        try:
+            self._store(key, await loader())
+        except Exception as e:
+            print(f"Background refresh of {key!r} failed: {e!r}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    async def aget(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None:
+            age = time.monotonic() - entry[0]
+            if age < self.ttl:
+                self.hits += 1
+                return entry[1]
+            if age < self.ttl + self.stale_ttl:
+                self.stale_hits += 1
+                with self._lock:
+                    schedule = key not in self._refreshing
+                    self._refreshing.add(key)
+                if schedule:
+                    task = asyncio.ensure_future(self._arefresh(key, loader))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+                return entry[1]
+        self.misses += 1
+        return await self._aload(key, loader)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
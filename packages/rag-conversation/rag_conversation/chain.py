@@ -1,57 +1,48 @@
 import datetime
 import json
-import os
-import requests
 from operator import itemgetter
 from typing import List, Tuple
-import regex as re
-from langchain.chat_models import ChatOpenAI
-from langchain.embeddings import OpenAIEmbeddings
 from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain.prompts.prompt import PromptTemplate
-from langchain.schema import AIMessage, HumanMessage, format_document
+from langchain.schema import AIMessage, Document, HumanMessage, format_document
 from langchain.schema.output_parser import StrOutputParser
 from langchain.schema.runnable import (
     RunnableBranch,
-    RunnableLambda,
     RunnableMap,
     RunnablePassthrough,
 )
-from langchain.vectorstores import Pinecone
 from pydantic import BaseModel, Field
 
-if os.environ.get("PINECONE_API_KEY", None) is None:
-    raise Exception("Missing `PINECONE_API_KEY` environment variable.")
-
-if os.environ.get("PINECONE_ENVIRONMENT", None) is None:
-    raise Exception("Missing `PINECONE_ENVIRONMENT` environment variable.")
-
-PINECONE_INDEX_NAME = os.environ.get("PINECONE_INDEX", "langchain-test")
+from rag_conversation import condense, context, factory, intent, metrics, sources
+from rag_conversation.answer_cache import AnswerCacheRunnable
+from rag_conversation.embedding_cache import normalize_text
+from rag_conversation.factory import CachedReprLambda, InlineRunnable, LazyRunnable
+from rag_conversation.single_flight import SingleFlightRunnable
 
 ### Ingest code - you may need to run this the first time
 # # Load
-from langchain.document_loaders import WebBaseLoader
-
-loader = WebBaseLoader("https://www.cit.tum.de/cit/startseite/")
-data = loader.load()
-# print(data)
-
+# from langchain.document_loaders import WebBaseLoader
+#
+# loader = WebBaseLoader("https://www.cit.tum.de/cit/startseite/")
+# data = loader.load()
 
 # # Split
-
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-
-text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=0)
-all_splits = text_splitter.split_documents(data)
+# from langchain.text_splitter import RecursiveCharacterTextSplitter
+#
+# text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=0)
+# all_splits = text_splitter.split_documents(data)
 
 # # Add to vectorDB
 # vectorstore = Pinecone.from_documents(
 #    documents=all_splits, embedding=OpenAIEmbeddings(), index_name=PINECONE_INDEX_NAME
 # )
-# retriever = vectorstore.as_retriever()
 
-vectorstore = Pinecone.from_existing_index(PINECONE_INDEX_NAME, OpenAIEmbeddings())
-retriever = vectorstore.as_retriever()
+# The retriever and LLM clients are built on first use, see rag_conversation.factory. Concurrent
+# requests for the same standalone question share one retrieval.
+retriever = SingleFlightRunnable(
+    LazyRunnable("retriever"), key=lambda question: (normalize_text(question).lower(), factory.index_version()),
+    name="retrieve"
+)
 
 # Condense a chat history and follow-up question into a standalone question
 _template = """Given the following conversation and a follow up question, rephrase the follow up question to be a standalone question.
@@ -79,9 +70,12 @@ DEFAULT_DOCUMENT_PROMPT = PromptTemplate.from_template(template="{page_content}"
 
 
 def _combine_documents(
-        docs, document_prompt=DEFAULT_DOCUMENT_PROMPT, document_separator="\n\n"
+        docs, question=None, document_prompt=DEFAULT_DOCUMENT_PROMPT, document_separator="\n\n",
+        budget=context.CONTEXT_TOKEN_BUDGET
 ):
-    doc_strings = [format_document(doc, document_prompt) for doc in docs]
+    # Overlapping chunks are dropped, the rest reranked against the question and cut to the token budget
+    docs = [Document(page_content=format_document(doc, document_prompt), metadata=doc.metadata) for doc in docs]
+    doc_strings, _ = context.pack(docs, question, budget, document_separator)
     return document_separator.join(doc_strings)
 
 
@@ -101,20 +95,6 @@ class ChatHistory(BaseModel):
 
 # RAG Conversation Chain
 
-get_context_chain = (
-    PromptTemplate.from_template(
-        template="""You are a preprocessor for prompts to another GPT. You need to figure out, what the prompt is about. 
-        Pick exactly one of the following options that describes the main idea based on the input prompt you will receive the best:
-1: A meal served in the Mensa at a certain date
-2: Study rooms
-0: Something else
-
-Answer with only with 0, 1 or 2. This is the prompt:".
-        Input: {question}
-        Answer:"""
-    )
-)
-
 mensa_prompt = """This is the following meal plan for the next week:
 <meal plan>
     {context}
@@ -148,22 +128,22 @@ def create_date_string(week, max_dishes=4):
 
 def create_room_data_string(room_data, max=15):
     ret = ""
+    count = 0
     for room in room_data:
+        if count >= max:
+            break
         if "Weihenstephan" not in room["gebaeude_name"]:
             ret += f"<{room['raum_nr_architekt']}>: {room['gebaeude_name']}({room['raum_name']})\n\n"
+            count += 1
     return ret
 
 
-PATTERN_MENSA = "mensa|essen|food|meal|lunch|dinner|breakfast|frühstück|mittagessen|abendessen|essen|kantine|cafeteria|restaurant|essen"
-PATTERN_ROOM = "room|räume"
+KEYWORDS_MENSA = ["mensa", "essen", "food", "meal", "lunch", "dinner", "breakfast", "frühstück", "mittagessen",
+                  "abendessen", "kantine", "cafeteria", "restaurant"]
+KEYWORDS_ROOM = ["room", "räume"]
 
-def get_mensa(text):
-    if not re.search(PATTERN_MENSA, text, re.IGNORECASE):
-        return None
-    today = datetime.datetime.today()
-    next_week = today + datetime.timedelta(days=7)
-    mensa_data = requests.get(f"https://tum-dev.github.io/eat-api/en/mensa-garching/{today.year}/{today.isocalendar()[1]}.json").json()
-    mensa_data_next = requests.get(f"https://tum-dev.github.io/eat-api/en/mensa-garching/{next_week.year}/{next_week.isocalendar()[1]}.json").json()
+def _mensa_context(weeks, today):
+    mensa_data, mensa_data_next = weeks
     mensa_data_str = f"""
         {json.dumps(create_date_string(mensa_data), indent=4)}\n
         {json.dumps(create_date_string(mensa_data_next), indent=4)}
@@ -172,53 +152,118 @@ def get_mensa(text):
 
     return mensa_prompt.format(context=mensa_data_str, day=today.strftime("%Y-%m-%d"))
 
-def get_room(text):
-    if not re.search(PATTERN_ROOM, text, re.IGNORECASE):
-        return None
-    room_data = requests.get("https://iris.asta.tum.de/api/").json()["raeume"]
+def get_mensa(text):
+    today = datetime.datetime.today()
+    return _mensa_context(sources.get_mensa_weeks(today.date()), today)
+
+async def aget_mensa(text):
+    today = datetime.datetime.today()
+    return _mensa_context(await sources.aget_mensa_weeks(today.date()), today)
+
+def _room_context(room_data):
     room_data_str = json.dumps(create_room_data_string(room_data), indent=4)
     return room_prompt.format(context=room_data_str)
 
+def get_room(text):
+    return _room_context(sources.get_rooms())
+
+async def aget_room(text):
+    return _room_context(await sources.aget_rooms())
+
+
+# Questions matching these keywords are answered from live data instead of the vector store
+intent.register("mensa", KEYWORDS_MENSA, get_mensa, "A meal served in the Mensa at a certain date", aget_mensa)
+intent.register("room", KEYWORDS_ROOM, get_room, "Study rooms", aget_room)
+
+
+def _inline(func) -> InlineRunnable:
+    # Cheap steps run on the event loop in async runs instead of taking a thread of the executor
+    return InlineRunnable(CachedReprLambda(func))
+
+
+_condense_question = (
+    InlineRunnable(CONDENSE_QUESTION_PROMPT) | LazyRunnable("condense_llm") | InlineRunnable(StrOutputParser())
+)
+
+
+def _condense(x, config):
+    return condense.cached_condense(
+        x["chat_history"],
+        x["question"],
+        lambda history, question: _condense_question.invoke(
+            {"chat_history": _format_chat_history(history), "question": question}, config
+        ),
+    )
+
+
+async def _acondense(x, config):
+    return await condense.acached_condense(
+        x["chat_history"],
+        x["question"],
+        lambda history, question: _condense_question.ainvoke(
+            {"chat_history": _format_chat_history(history), "question": question}, config
+        ),
+    )
+
+
+async def _alive_data(x):
+    return context.fit(await intent.ahandle(x["intent"], x["question"]))
+
+
 _search_query = RunnableBranch(
-    # If input includes chat_history, we condense it with the follow-up question
+    # If input includes chat_history and the question refers back to it, we condense it with the follow-up question
     (
-        RunnableLambda(lambda x: bool(x.get("chat_history"))).with_config(
+        _inline(
+            lambda x: bool(x.get("chat_history")) and condense.needs_condensation(x["question"])
+        ).with_config(
             run_name="HasChatHistoryCheck"
-        ),  # Condense follow-up question and chat into a standalone_question
-        RunnablePassthrough.assign(
-            chat_history=lambda x: _format_chat_history(x["chat_history"])
-        )
-        | CONDENSE_QUESTION_PROMPT
-        | ChatOpenAI(temperature=0, model="gpt-3.5-turbo-16k")
-        | StrOutputParser(),
+        ),  # Condense follow-up question and the last turns of the chat into a standalone_question
+        CachedReprLambda(_condense, _acondense).with_config(run_name="CondenseQuestion"),
     ),
-    # Else, we have no chat history, so just pass through the question
-    RunnableLambda(itemgetter("question")),
+    # Else, the question is self-contained, so just pass through the question
+    _inline(itemgetter("question")),
 )
 
-def regex_content(text):
-    mensa = get_mensa(text)
-    if mensa is not None:
-        return mensa
-    room = get_room(text)
-    if room is not None:
-        return room
-    return None
-
-
-_inputs = RunnableMap(
-    {
-        "question": lambda x: x["question"],
-        "chat_history": lambda x: _format_chat_history(x["chat_history"]),
-        "context": RunnableBranch(
-            (
-                RunnableLambda(lambda x: regex_content(x["question"]) is not None),
-                RunnableLambda(lambda x: regex_content(x["question"]))
-            ), 
-            _search_query | retriever | _combine_documents
-        ),
-    }
+# The intent is resolved once per request and handed to the context branch. Only questions answered
+# from the vector store need a standalone question.
+_inputs = (
+    RunnablePassthrough.assign(
+        intent=CachedReprLambda(lambda x: intent.route(x["question"]),
+                                lambda x: intent.aroute(x["question"])).with_config(run_name="RouteIntent")
+    )
+    | RunnablePassthrough.assign(
+        standalone_question=RunnableBranch(
+            (_inline(lambda x: x["intent"] is not None), _inline(lambda x: None)),
+            _search_query,
+        )
+    )
+    | RunnableMap(
+        {
+            "question": _inline(lambda x: x["question"]),
+            "chat_history": _inline(lambda x: _format_chat_history(x["chat_history"])),
+            "intent": _inline(itemgetter("intent")),
+            "standalone_question": _inline(itemgetter("standalone_question")),
+            "context": RunnableBranch(
+                (
+                    _inline(lambda x: x["intent"] is not None),
+                    CachedReprLambda(lambda x: context.fit(intent.handle(x["intent"], x["question"])),
+                                     _alive_data).with_config(run_name="FetchLiveData")
+                ),
+                RunnableMap({"docs": _inline(itemgetter("standalone_question")) | retriever,
+                             "question": _inline(itemgetter("standalone_question"))})
+                | _inline(lambda x: _combine_documents(x["docs"], x["question"])).with_config(
+                    run_name="CombineDocuments")
+            ),
+        }
+    )
 ).with_types(input_type=ChatHistory)
 
+_answer = InlineRunnable(ANSWER_PROMPT) | LazyRunnable("llm") | StrOutputParser()
+
+# Times the named runs, retrievers and LLM calls of every request, see rag_conversation.metrics
+stage_timer = metrics.StageTimer(
+    {"RouteIntent": "intent", "CondenseQuestion": "condense", "FetchLiveData": "live_data", "CombineDocuments": "context"}
+)
 
-chain = _inputs | ANSWER_PROMPT | ChatOpenAI() | StrOutputParser()
+# Answers to questions similar to a recently answered one are served from the semantic answer cache
+chain = (_inputs | AnswerCacheRunnable(_answer)).with_config(callbacks=[stage_timer])
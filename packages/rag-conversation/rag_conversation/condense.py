@@ -0,0 +1,53 @@
+import hashlib
+import json
+import os
+from typing import Awaitable, Callable, List, Tuple
+
+import regex as re
+
+from rag_conversation import metrics
+from rag_conversation.cache import TTLCache
+
+# Number of most recent (human, ai) turns sent to the LLM when condensing a follow-up question
+CONDENSE_HISTORY_TURNS = int(os.environ.get("CONDENSE_HISTORY_TURNS", "3"))
+# Questions with at most this many words are treated as follow-ups, e.g. "and in summer?"
+CONDENSE_MIN_WORDS = int(os.environ.get("CONDENSE_MIN_WORDS", "4"))
+
+# Anaphora and ellipsis markers that only make sense after an earlier turn, in English and German
+REFERENCE_PATTERN = re.compile(
+    r"\b(they|them|their|the same|the former|the latter|the (first|second|third|last|other) ones?|"
+    r"(this|that) one|mentioned|above|previous|what about|how about|what else|anything else|"
+    r"davon|dafür|damit|darüber|dazu|dabei|daran|darauf|darin|derselbe|dieselbe|dasselbe|"
+    r"(der|die|das|den|dem) (erste|zweite|dritte|letzte|andere)n?|erwähnt\w*|genannt\w*|"
+    r"was ist mit|wie ist es mit|wie sieht es mit)\b|^\s*(and|und|or|oder|but|aber)\b",
+    re.IGNORECASE,
+)
+
+condense_cache = TTLCache(ttl=60 * 60, max_entries=4096)
+metrics.register_cache("condense", condense_cache)
+
+
+def history_tail(chat_history: List[Tuple[str, str]], turns: int = CONDENSE_HISTORY_TURNS) -> List[Tuple[str, str]]:
+    return list(chat_history[-turns:]) if turns > 0 else []
+
+
+def needs_condensation(question: str) -> bool:
+    """Cheap check whether `question` depends on earlier turns; self-contained questions skip the LLM."""
+    return len(question.split()) <= CONDENSE_MIN_WORDS or REFERENCE_PATTERN.search(question) is not None
+
+
+def _key(tail: List[Tuple[str, str]], question: str) -> str:
+    return hashlib.sha256(json.dumps([tail, " ".join(question.split())]).encode("utf-8")).hexdigest()
+
+
+def cached_condense(chat_history: List[Tuple[str, str]], question: str,
+                    condense: Callable[[List[Tuple[str, str]], str], str]) -> str:
+    """Condenses `question` against the tail of `chat_history`, reusing earlier results for the same input."""
+    tail = history_tail(chat_history)
+    return condense_cache.get(_key(tail, question), lambda: condense(tail, question))
+
+
+async def acached_condense(chat_history: List[Tuple[str, str]], question: str,
+                           condense: Callable[[List[Tuple[str, str]], str], Awaitable[str]]) -> str:
+    tail = history_tail(chat_history)
+    return await condense_cache.aget(_key(tail, question), lambda: condense(tail, question))
@@ -0,0 +1,139 @@
+import os
+import threading
+from typing import List, Optional, Sequence, Tuple
+
+from langchain.schema import Document
+
+from rag_conversation import metrics
+from rag_conversation.keyword_index import tokenize
+
+# Maximum number of tokens of context put into the answer prompt
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "3000"))
+# A document is only cut to fit the rest of the budget if at least this many tokens are left
+CONTEXT_MIN_TRUNCATED_TOKENS = int(os.environ.get("CONTEXT_MIN_TRUNCATED_TOKENS", "100"))
+# Documents sharing at least this fraction of their words with a better ranked one are dropped
+CONTEXT_OVERLAP_THRESHOLD = float(os.environ.get("CONTEXT_OVERLAP_THRESHOLD", "0.8"))
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding():
+    global _encoding
+    if _encoding is None:
+        with _encoding_lock:
+            if _encoding is None:
+                try:
+                    import tiktoken
+
+                    _encoding = tiktoken.get_encoding("cl100k_base")
+                except Exception as e:
+                    # tiktoken downloads its vocabulary on first use, offline we estimate instead
+                    print(f"Falling back to estimated token counts: {e!r}")
+                    _encoding = False
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    encoding = _get_encoding()
+    return len(encoding.encode(text)) if encoding else (len(text) + 3) // 4
+
+
+def truncate(text: str, max_tokens: int) -> str:
+    encoding = _get_encoding()
+    if encoding:
+        tokens = encoding.encode(text)
+        return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+    return text[:max_tokens * 4]
+
+
+class ContextUsage:
+    """Token usage of the contexts put into the answer prompt, summed over all requests."""
+
+    def __init__(self):
+        self.requests = 0
+        self.tokens = 0
+        self.documents = 0
+        self.dropped = 0
+        self.truncated = 0
+        self._lock = threading.Lock()
+
+    def record(self, tokens: int, documents: int = 0, dropped: int = 0, truncated: int = 0):
+        with self._lock:
+            self.requests += 1
+            self.tokens += tokens
+            self.documents += documents
+            self.dropped += dropped
+            self.truncated += truncated
+
+    def stats(self) -> dict:
+        return {"requests": self.requests, "tokens": self.tokens, "documents": self.documents,
+                "dropped": self.dropped, "truncated": self.truncated,
+                "tokens_per_request": self.tokens / self.requests if self.requests else 0.0}
+
+
+usage = ContextUsage()
+
+
+def deduplicate(documents: Sequence[Document], threshold: float = CONTEXT_OVERLAP_THRESHOLD) -> List[Document]:
+    """Drops documents whose words mostly appear in a better ranked one, e.g. overlapping chunks of a page."""
+    kept: List[Tuple[Document, set]] = []
+    for document in documents:
+        words = set(tokenize(document.page_content))
+        if any(len(words & other) >= threshold * max(len(words), 1) for _, other in kept):
+            continue
+        kept.append((document, words))
+    return [document for document, _ in kept]
+
+
+def rerank(documents: Sequence[Document], question: str) -> List[Document]:
+    """
+    Orders the documents by the share of the question's terms they contain, with the retrieval rank
+    as tie-breaker and a small prior, so a lexically better match moves up without a model call.
+    """
+    terms = set(tokenize(question))
+    if not terms:
+        return list(documents)
+
+    def score(item):
+        rank, document = item
+        coverage = len(terms & set(tokenize(document.page_content))) / len(terms)
+        return coverage + 0.5 / (rank + 1)
+
+    return [document for _, document in sorted(enumerate(documents), key=score, reverse=True)]
+
+
+def pack(documents: Sequence[Document], question: Optional[str], budget: int = CONTEXT_TOKEN_BUDGET,
+         separator: str = "\n\n") -> Tuple[List[str], dict]:
+    """Selects the texts to put into the prompt within `budget` tokens and reports what was used."""
+    unique = deduplicate(documents)
+    ranked = rerank(unique, question) if question else unique
+    texts, used, truncated = [], 0, 0
+    separator_tokens = count_tokens(separator)
+    for document in ranked:
+        remaining = budget - used - (separator_tokens if texts else 0)
+        tokens = count_tokens(document.page_content)
+        if tokens <= remaining:
+            texts.append(document.page_content)
+        elif remaining >= CONTEXT_MIN_TRUNCATED_TOKENS:
+            texts.append(truncate(document.page_content, remaining))
+            tokens = remaining
+            truncated += 1
+        else:
+            continue
+        used += tokens + (separator_tokens if len(texts) > 1 else 0)
+    report = {"tokens": used, "budget": budget, "documents": len(texts), "retrieved": len(documents),
+              "dropped": len(documents) - len(texts), "truncated": truncated}
+    usage.record(used, len(texts), len(documents) - len(texts), truncated)
+    metrics.context_tokens.observe(used, source="documents")
+    return texts, report
+
+
+def fit(text: str, budget: int = CONTEXT_TOKEN_BUDGET) -> str:
+    """Cuts a context that is not built from documents (live data) to the token budget."""
+    tokens = count_tokens(text)
+    if tokens > budget:
+        text = truncate(text, budget)
+    usage.record(min(tokens, budget), truncated=int(tokens > budget))
+    metrics.context_tokens.observe(min(tokens, budget), source="live_data")
+    return text
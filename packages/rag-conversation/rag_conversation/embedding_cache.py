@@ -0,0 +1,296 @@
+import asyncio
+import hashlib
+import os
+import random
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from langchain.schema.embeddings import Embeddings
+
+from rag_conversation import metrics
+from rag_conversation.cache import TTLCache
+
+EMBEDDING_CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH", "embeddings.sqlite")
+EMBEDDING_CACHE_MAX_BYTES = int(float(os.environ.get("EMBEDDING_CACHE_MAX_MB", "1024")) * 1024 * 1024)
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", "256"))
+EMBEDDING_CONCURRENCY = int(os.environ.get("EMBEDDING_CONCURRENCY", "4"))
+EMBEDDING_MAX_RETRIES = int(os.environ.get("EMBEDDING_MAX_RETRIES", "6"))
+QUERY_EMBEDDING_CACHE_SIZE = int(os.environ.get("QUERY_EMBEDDING_CACHE_SIZE", "4096"))
+# Queries arriving within this many milliseconds are embedded with one request, 0 disables batching
+QUERY_EMBEDDING_BATCH_WINDOW = float(os.environ.get("QUERY_EMBEDDING_BATCH_WINDOW_MS", "5")) / 1000
+QUERY_EMBEDDING_BATCH_SIZE = int(os.environ.get("QUERY_EMBEDDING_BATCH_SIZE", "64"))
+
+query_batch_size = metrics.register(metrics.Histogram(
+    "rag_query_embedding_batch_size", "Queries embedded per request to the embedding model", (1, 2, 4, 8, 16, 32, 64, 128)))
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def _model_name(embedding: Embeddings) -> str:
+    return getattr(embedding, "model", None) or type(embedding).__name__
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper backed by an on-disk SQLite cache keyed by the hash of the normalized text.
+    Misses are sent to the underlying model in batches of `batch_size`, at most `max_concurrency`
+    batches at a time, retrying failed batches with exponential backoff. Once the cache grows past
+    `max_bytes` the least recently used vectors are evicted.
+    """
+
+    def __init__(
+            self,
+            underlying: Embeddings,
+            path: str = EMBEDDING_CACHE_PATH,
+            max_bytes: int = EMBEDDING_CACHE_MAX_BYTES,
+            batch_size: int = EMBEDDING_BATCH_SIZE,
+            max_concurrency: int = EMBEDDING_CONCURRENCY,
+            max_retries: int = EMBEDDING_MAX_RETRIES,
+            namespace: Optional[str] = None,
+    ):
+        self.underlying = underlying
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.namespace = namespace or _model_name(underlying)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings(last_used)")
+        self._db.commit()
+
+    def key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.namespace}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    def _lookup(self, keys: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                rows = self._db.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = array("f", blob).tolist()
+            if found:
+                now = time.time()
+                self._db.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?",
+                                     [(now, key) for key in found])
+                self._db.commit()
+        return found
+
+    def _store(self, vectors: Dict[str, List[float]]):
+        now = time.time()
+        rows = []
+        for key, vector in vectors.items():
+            blob = array("f", vector).tobytes()
+            rows.append((key, blob, len(blob), now))
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows)
+            self._db.commit()
+        self._evict()
+
+    def size(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+
+    def _evict(self):
+        total = self.size()
+        if total <= self.max_bytes:
+            return
+        # Evict down to 90% of the limit so we do not evict again on the next insert
+        excess = total - int(self.max_bytes * 0.9)
+        with self._lock:
+            rows = self._db.execute("SELECT key, size FROM embeddings ORDER BY last_used").fetchall()
+            evicted = []
+            for key, size in rows:
+                if excess <= 0:
+                    break
+                evicted.append((key,))
+                excess -= size
+            self._db.executemany("DELETE FROM embeddings WHERE key = ?", evicted)
+            self._db.commit()
+
+    def _embed_with_backoff(self, texts: List[str]) -> List[List[float]]:
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self.underlying.embed_documents(texts)
+            except Exception:
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(min(60.0, 2 ** attempt) * (0.5 + random.random() / 2))
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self.key(text) for text in texts]
+        vectors = self._lookup(list(set(keys)))
+        # Identical texts are embedded only once
+        missing: Dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors and key not in missing:
+                missing[key] = text
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            missing_keys = list(missing.keys())
+            batches = [missing_keys[i:i + self.batch_size] for i in range(0, len(missing_keys), self.batch_size)]
+            with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+                futures = [executor.submit(self._embed_with_backoff, [missing[key] for key in batch])
+                           for batch in batches]
+                for batch, future in zip(batches, futures):
+                    embedded = dict(zip(batch, future.result()))
+                    self._store(embedded)
+                    vectors.update(embedded)
+        return [vectors[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+class QueryCachedEmbeddings(Embeddings):
+    """Keeps recent query embeddings in memory, so every stage of a request can embed the same question for free."""
+
+    def __init__(self, underlying: Embeddings, max_entries: int = QUERY_EMBEDDING_CACHE_SIZE, ttl: float = 60 * 60):
+        self.underlying = underlying
+        self.cache = TTLCache(ttl, max_entries=max_entries)
+        metrics.register_cache("query_embedding", self.cache)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.underlying.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.cache.get(normalize_text(text), lambda: self._embed_query(text))
+
+    def cached_query(self, text: str) -> Optional[List[float]]:
+        """The embedding of `text` if a recent request already paid for it, without embedding it."""
+        return self.cache.peek(normalize_text(text))
+
+    def _embed_query(self, text: str) -> List[float]:
+        with metrics.timed_call("embeddings"):
+            return self.underlying.embed_query(text)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await self.cache.aget(normalize_text(text), lambda: self._aembed_query(text))
+
+    async def _aembed_query(self, text: str) -> List[float]:
+        with metrics.timed_call("embeddings"):
+            return await self.underlying.aembed_query(text)
+
+
+class BatchedQueryEmbeddings(Embeddings):
+    """
+    Collects the queries of concurrent requests for up to `window` seconds, or until `max_batch` are
+    waiting, and embeds them with a single `embed_documents` call, so a burst of questions costs a
+    few embedding requests instead of one each. Only for models that embed queries and documents
+    the same way, like OpenAI's. Sync queries are collected by a thread, async ones on their event
+    loop and embedded with `aembed_documents`, without a thread waiting for them.
+    """
+
+    def __init__(self, underlying: Embeddings, window: float = QUERY_EMBEDDING_BATCH_WINDOW,
+                 max_batch: int = QUERY_EMBEDDING_BATCH_SIZE, max_concurrency: int = EMBEDDING_CONCURRENCY):
+        self.underlying = underlying
+        self.window = window
+        self.max_batch = max_batch
+        self._pending: List[Tuple[str, Future]] = []
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="query-embedding")
+        self._collector: Optional[threading.Thread] = None
+        # The async batch being collected on each event loop, with the timer that flushes it
+        self._abatches: Dict[asyncio.AbstractEventLoop, Tuple[List[Tuple[str, asyncio.Future]], asyncio.TimerHandle]] = {}
+        # Async batches being embedded, referenced until they finish
+        self._tasks = set()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.underlying.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        if self.window <= 0:
+            return self.underlying.embed_query(text)
+        return self._submit(text).result()
+
+    async def aembed_query(self, text: str) -> List[float]:
+        if self.window <= 0:
+            return await self.underlying.aembed_query(text)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if loop not in self._abatches:
+            self._abatches[loop] = ([], loop.call_later(self.window, self._aflush, loop))
+        batch, _ = self._abatches[loop]
+        batch.append((text, future))
+        if len(batch) >= self.max_batch:
+            self._aflush(loop)
+        return await future
+
+    def _aflush(self, loop: asyncio.AbstractEventLoop):
+        batch, timer = self._abatches.pop(loop)
+        timer.cancel()
+        task = loop.create_task(self._aembed(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _aembed(self, batch: List[Tuple[str, asyncio.Future]]):
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        query_batch_size.observe(len(texts))
+        try:
+            vectors = dict(zip(texts, await self.underlying.aembed_documents(texts)))
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for text, future in batch:
+            # A request that was cancelled while waiting no longer wants its result
+            if not future.done():
+                future.set_result(vectors[text])
+
+    def _submit(self, text: str) -> Future:
+        future = Future()
+        with self._condition:
+            if self._collector is None:
+                self._collector = threading.Thread(target=self._collect, name="query-embedding-batcher", daemon=True)
+                self._collector.start()
+            self._pending.append((text, future))
+            self._condition.notify()
+        return future
+
+    def _collect(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                deadline = time.monotonic() + self.window
+                while len(self._pending) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                batch = self._pending[:self.max_batch]
+                del self._pending[:self.max_batch]
+            # The next batch is collected while this one is embedded
+            self._executor.submit(self._embed, batch)
+
+    def _embed(self, batch: List[Tuple[str, Future]]):
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        query_batch_size.observe(len(texts))
+        try:
+            vectors = dict(zip(texts, self.underlying.embed_documents(texts)))
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for text, future in batch:
+            future.set_result(vectors[text])
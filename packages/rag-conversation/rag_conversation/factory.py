@@ -0,0 +1,189 @@
+import os
+import threading
+import time
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, Optional
+
+from langchain.chat_models import ChatOpenAI
+from langchain.embeddings import OpenAIEmbeddings
+from langchain.llms import OpenAI
+from langchain.schema.runnable import Runnable, RunnableConfig, RunnableLambda
+
+from rag_conversation import vectorstore
+from rag_conversation.embedding_cache import BatchedQueryEmbeddings, QueryCachedEmbeddings
+from rag_conversation.hybrid import HybridRetriever
+from rag_conversation.index_versions import aliases, versioned_path
+from rag_conversation.keyword_index import KEYWORD_INDEX_PATH, KeywordIndex
+
+# "hybrid" fuses the keyword index (if the crawler built one) with the vector search, "vector" only searches the vector store
+RETRIEVER_MODE = os.environ.get("RETRIEVER_MODE", "hybrid")
+
+
+def _keyword_index():
+    path = versioned_path(KEYWORD_INDEX_PATH, _served_version)
+    return KeywordIndex(path) if RETRIEVER_MODE == "hybrid" and os.path.exists(path) else None
+
+
+def _retriever():
+    vector_retriever = get("vectorstore").as_retriever()
+    keyword_index = get("keyword_index")
+    if keyword_index is None:
+        return vector_retriever
+    return HybridRetriever(vector_retriever=vector_retriever, keyword_index=keyword_index)
+
+
+# Chain components are built on first use instead of at import time, so importing the package
+# does no network work and needs no credentials.
+_builders: Dict[str, Callable[[], Any]] = {
+    # Repeated queries are answered from memory, the others batched with concurrent ones
+    "embeddings": lambda: QueryCachedEmbeddings(BatchedQueryEmbeddings(OpenAIEmbeddings())),
+    "vectorstore": lambda: vectorstore.get_vectorstore(get("embeddings"), version=_served_version),
+    "keyword_index": _keyword_index,
+    "retriever": _retriever,
+    "condense_llm": lambda: ChatOpenAI(temperature=0, model="gpt-3.5-turbo-16k"),
+    "llm": lambda: ChatOpenAI(),
+    # Summarizes stored conversations, see app/routers/conversation.py
+    "summary_llm": lambda: OpenAI(),
+}
+_components: Dict[str, Any] = {}
+_lock = threading.RLock()
+# Seconds it took to build each component
+timings: Dict[str, float] = {}
+_ready = threading.Event()
+# Components that read the index; they are rebuilt when the alias switches to another version
+INDEX_COMPONENTS = ("vectorstore", "keyword_index", "retriever")
+_served_version = aliases.live()
+
+
+def sync_index_version():
+    """Follows a switch of the index alias; requests started before it finish on the old version."""
+    global _served_version
+    live = aliases.live()
+    if live != _served_version:
+        with _lock:
+            if live != _served_version:
+                print(f"Switching from index version {_served_version} to {live}")
+                _served_version = live
+                for name in INDEX_COMPONENTS:
+                    _components.pop(name, None)
+
+
+def get(name: str) -> Any:
+    component = _components.get(name)
+    if component is not None:
+        return component
+    with _lock:
+        if name not in _components:
+            start = time.perf_counter()
+            _components[name] = _builders[name]()
+            timings[name] = time.perf_counter() - start
+        return _components[name]
+
+
+def override(name: str, component: Any):
+    """Replaces a component, e.g. with a fake for offline runs, and drops everything built from it."""
+    with _lock:
+        reset()
+        _builders[name] = lambda: component
+
+
+def reset():
+    with _lock:
+        _components.clear()
+        timings.clear()
+        _ready.clear()
+
+
+def warmup() -> Dict[str, float]:
+    """Builds every component so the first request does not pay for it and returns the build times."""
+    for name in list(_builders):
+        get(name)
+    _ready.set()
+    return dict(timings)
+
+
+def is_ready() -> bool:
+    return _ready.is_set()
+
+
+def index_version() -> str:
+    """Identifies the content of the served index; answers cached for another version are discarded."""
+    sync_index_version()
+    return _served_version or str(getattr(get("vectorstore"), "version", None) or vectorstore.INDEX_VERSION)
+
+
+class LazyRunnable(Runnable):
+    """Runnable that resolves a factory component on first use and delegates to it, including streaming."""
+
+    def __init__(self, name: str):
+        self.name = name
+
+    @property
+    def runnable(self) -> Runnable:
+        if self.name in INDEX_COMPONENTS:
+            sync_index_version()
+        return get(self.name)
+
+    def invoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        return self.runnable.invoke(input, config, **kwargs)
+
+    async def ainvoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        return await self.runnable.ainvoke(input, config, **kwargs)
+
+    def stream(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Iterator[Any]:
+        yield from self.runnable.stream(input, config, **kwargs)
+
+    async def astream(self, input: Any, config: Optional[RunnableConfig] = None,
+                      **kwargs: Any) -> AsyncIterator[Any]:
+        async for chunk in self.runnable.astream(input, config, **kwargs):
+            yield chunk
+
+    def transform(self, input: Iterator[Any], config: Optional[RunnableConfig] = None,
+                  **kwargs: Any) -> Iterator[Any]:
+        yield from self.runnable.transform(input, config, **kwargs)
+
+    async def atransform(self, input: AsyncIterator[Any], config: Optional[RunnableConfig] = None,
+                         **kwargs: Any) -> AsyncIterator[Any]:
+        async for chunk in self.runnable.atransform(input, config, **kwargs):
+            yield chunk
+
+    def __repr__(self) -> str:
+        return f"LazyRunnable({self.name!r})"
+
+
+class InlineRunnable(Runnable):
+    """
+    Runs a cheap runnable without an async implementation of its own (prompt templates, small lambdas)
+    inline on the event loop in async runs; LangChain would run it on a thread of the executor.
+    """
+
+    def __init__(self, runnable: Runnable):
+        self.runnable = runnable
+
+    @property
+    def InputType(self) -> Any:
+        return self.runnable.InputType
+
+    @property
+    def OutputType(self) -> Any:
+        return self.runnable.OutputType
+
+    def invoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        return self.runnable.invoke(input, config, **kwargs)
+
+    async def ainvoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        return self.runnable.invoke(input, config, **kwargs)
+
+    def __repr__(self) -> str:
+        return f"InlineRunnable({self.runnable!r})"
+
+
+class CachedReprLambda(RunnableLambda):
+    """
+    RunnableLambda whose repr is built once. The repr goes into the serialized run of every step of
+    every request, and RunnableLambda parses the source of its function for it each time.
+    """
+
+    def __repr__(self) -> str:
+        if "_repr" not in self.__dict__:
+            self.__dict__["_repr"] = super().__repr__()
+        return self.__dict__["_repr"]
@@ -0,0 +1,92 @@
+import hashlib
+import os
+from typing import Any, Dict, List
+
+from langchain.callbacks.manager import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain.schema import BaseRetriever, Document
+
+from rag_conversation import metrics
+from rag_conversation.keyword_index import tokenize
+
+# Candidates taken from each of the keyword and the vector search before fusing them
+HYBRID_FETCH_K = int(os.environ.get("HYBRID_FETCH_K", "20"))
+# Constant of reciprocal rank fusion, higher values flatten the influence of the top ranks
+HYBRID_RRF_K = int(os.environ.get("HYBRID_RRF_K", "60"))
+# Keyword results are used alone for short or identifier queries (module codes, room numbers) when
+# the best one contains every query term and scores this many times higher than the second best;
+# 0 disables the fast path
+HYBRID_FASTPATH_RATIO = float(os.environ.get("HYBRID_FASTPATH_RATIO", "1.5"))
+HYBRID_FASTPATH_MAX_TERMS = int(os.environ.get("HYBRID_FASTPATH_MAX_TERMS", "3"))
+
+
+def _key(document: Document) -> str:
+    # The vector store does not return chunk IDs, the same chunk has the same text in both indexes
+    return hashlib.sha256(document.page_content.encode("utf-8")).hexdigest()
+
+
+def reciprocal_rank_fusion(rankings: List[List[Document]], k: int = HYBRID_RRF_K) -> List[Document]:
+    scores: Dict[str, float] = {}
+    documents: Dict[str, Document] = {}
+    for ranking in rankings:
+        for rank, document in enumerate(ranking):
+            key = _key(document)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank + 1)
+            documents.setdefault(key, document)
+    return [documents[key] for key in sorted(scores, key=scores.get, reverse=True)]
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Fuses BM25 keyword results with vector search results via reciprocal rank fusion. Module codes,
+    room numbers and form names that clearly match one chunk skip the vector search (and with it the
+    embedding of the query) altogether.
+    """
+
+    vector_retriever: BaseRetriever
+    keyword_index: Any
+    k: int = 4
+    fetch_k: int = HYBRID_FETCH_K
+    rrf_k: int = HYBRID_RRF_K
+    fastpath_ratio: float = HYBRID_FASTPATH_RATIO
+    fastpath_max_terms: int = HYBRID_FASTPATH_MAX_TERMS
+    fastpath_hits: int = 0
+
+    def keyword_fastpath(self, query: str, results) -> bool:
+        if not self.fastpath_ratio or not results or results[0][2] < 1.0:
+            return False
+        terms = set(tokenize(query))
+        if len(terms) > self.fastpath_max_terms and not any(any(c.isdigit() for c in term) for term in terms):
+            return False
+        return len(results) == 1 or results[0][1] >= self.fastpath_ratio * results[1][1]
+
+    def _keyword_search(self, query: str):
+        """The keyword results and whether they answer the query alone."""
+        with metrics.stage_seconds.time(stage="keyword_search"):
+            keyword_results = self.keyword_index.search(query, self.fetch_k)
+        if self.keyword_fastpath(query, keyword_results):
+            self.fastpath_hits += 1
+            metrics.keyword_fastpath.inc()
+            return keyword_results, True
+        return keyword_results, False
+
+    def _fuse(self, keyword_results, vector_results: List[Document]) -> List[Document]:
+        fused = reciprocal_rank_fusion([[document for document, _, _ in keyword_results], vector_results], self.rrf_k)
+        return fused[:self.k]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        keyword_results, fastpath = self._keyword_search(query)
+        if fastpath:
+            return [document for document, _, _ in keyword_results[:self.k]]
+        vector_results = self.vector_retriever.get_relevant_documents(
+            query, callbacks=run_manager.get_child())
+        return self._fuse(keyword_results, vector_results)
+
+    async def _aget_relevant_documents(self, query: str, *,
+                                       run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        # The keyword index is a local SQLite file, it is searched inline
+        keyword_results, fastpath = self._keyword_search(query)
+        if fastpath:
+            return [document for document, _, _ in keyword_results[:self.k]]
+        vector_results = await self.vector_retriever.aget_relevant_documents(
+            query, callbacks=run_manager.get_child())
+        return self._fuse(keyword_results, vector_results)
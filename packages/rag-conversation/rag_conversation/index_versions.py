@@ -0,0 +1,119 @@
+import datetime
+import json
+import os
+import threading
+from typing import Dict, List, Optional
+
+# Registry of the index versions and the alias naming the one that is served
+INDEX_ALIAS_PATH = os.environ.get("INDEX_ALIAS_PATH", "index_alias.json")
+# Versions kept after a switch, including the live one; older ones are deleted. Keep at least 2 to be able to roll back
+INDEX_KEEP_VERSIONS = max(int(os.environ.get("INDEX_KEEP_VERSIONS", "2")), 1)
+
+BUILDING = "building"
+READY = "ready"
+FAILED = "failed"
+
+
+def versioned_path(path: str, version: Optional[str]) -> str:
+    """Location of a file backed index (keyword index, crawler state) for `version`, e.g. keywords.v1.sqlite3."""
+    if not version:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{version}{ext}"
+
+
+class IndexAliases:
+    """
+    Index versions are built next to the served one (a Pinecone namespace or a directory of the local
+    store, plus their keyword index) and only served once the alias `live` points at them. The alias
+    file is replaced atomically, so readers see either the old or the new version, never a mix.
+    Without an alias file the unversioned index is served, as before versioning.
+    """
+
+    def __init__(self, path: str = INDEX_ALIAS_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._cache = (None, {"live": None, "versions": {}})
+
+    def read(self) -> dict:
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return {"live": None, "versions": {}}
+        with self._lock:
+            if self._cache[0] != mtime:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._cache = (mtime, json.load(f))
+            return self._cache[1]
+
+    def _write(self, data: dict):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, self.path)
+        with self._lock:
+            self._cache = (os.stat(self.path).st_mtime_ns, data)
+
+    def live(self) -> Optional[str]:
+        return self.read()["live"]
+
+    def versions(self) -> Dict[str, dict]:
+        return self.read()["versions"]
+
+    def building(self) -> Optional[str]:
+        """The newest version whose build did not finish, so an interrupted build can be resumed."""
+        candidates = [name for name, version in self.versions().items() if version["state"] == BUILDING]
+        return max(candidates) if candidates else None
+
+    def create(self) -> str:
+        data = self.read()
+        name = base = "v" + datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S")
+        suffix = 1
+        while name in data["versions"]:
+            name = f"{base}-{suffix}"
+            suffix += 1
+        data = {**data, "versions": {**data["versions"], name: {
+            "state": BUILDING, "created": datetime.datetime.utcnow().isoformat(), "chunks": None}}}
+        self._write(data)
+        return name
+
+    def update(self, name: str, **fields):
+        data = self.read()
+        versions = dict(data["versions"])
+        versions[name] = {**versions[name], **fields}
+        self._write({**data, "versions": versions})
+
+    def switch(self, name: str) -> Optional[str]:
+        """Points the alias at the ready version `name` and returns the version served before."""
+        data = self.read()
+        if data["versions"].get(name, {}).get("state") != READY:
+            raise ValueError(f"Index version {name} is not ready")
+        self._write({**data, "live": name})
+        return data["live"]
+
+    def previous(self) -> Optional[str]:
+        """Newest ready version older than the live one, the target of a rollback."""
+        live = self.live()
+        candidates = [name for name, version in self.versions().items()
+                      if version["state"] == READY and name != live and (live is None or name < live)]
+        return max(candidates) if candidates else None
+
+    def expired(self, keep: int = INDEX_KEEP_VERSIONS) -> List[str]:
+        """
+        Versions to delete: failed builds and ready versions beyond the newest `keep`, always keeping
+        the live one. Unfinished builds are kept so they can be resumed.
+        """
+        live = self.live()
+        versions = self.versions()
+        finished = sorted((name for name, version in versions.items() if version["state"] != BUILDING), reverse=True)
+        kept = [name for name in finished if name == live][:1]
+        kept += [name for name in finished
+                 if name != live and versions[name]["state"] == READY][:max(keep - len(kept), 0)]
+        return [name for name in finished if name not in kept]
+
+    def remove(self, name: str):
+        data = self.read()
+        self._write({**data, "versions": {key: value for key, value in data["versions"].items() if key != name}})
+
+
+aliases = IndexAliases()
@@ -0,0 +1,120 @@
+import asyncio
+import os
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional
+
+import regex as re
+from langchain.prompts.prompt import PromptTemplate
+from langchain.schema.output_parser import StrOutputParser
+
+from rag_conversation import factory, metrics
+from rag_conversation.cache import TTLCache
+
+# "off": keyword matching only, "ambiguous": ask the LLM when keywords of several intents match,
+# "always": also ask the LLM when no keyword matches
+INTENT_LLM_FALLBACK = os.environ.get("INTENT_LLM_FALLBACK", "off")
+
+
+class IntentHandler(NamedTuple):
+    name: str
+    keywords: List[str]
+    handler: Callable[[str], str]
+    description: str
+    # Used by `ahandle`; without it the handler runs on a thread of the executor
+    ahandler: Optional[Callable[[str], Awaitable[str]]] = None
+
+
+_handlers: Dict[str, IntentHandler] = {}
+_pattern: Optional[re.Pattern] = None
+_fallback_cache = TTLCache(ttl=24 * 60 * 60, max_entries=4096)
+metrics.register_cache("intent_fallback", _fallback_cache)
+
+CLASSIFIER_PROMPT = PromptTemplate.from_template(
+    """You are a preprocessor for prompts to another GPT. You need to figure out, what the prompt is about.
+Pick exactly one of the following options that describes the main idea based on the input prompt you will receive the best:
+{options}
+0: Something else
+
+Answer only with the number of the option. This is the prompt:
+Input: {question}
+Answer:"""
+)
+
+
+def register(name: str, keywords: List[str], handler: Callable[[str], str], description: str,
+             ahandler: Optional[Callable[[str], Awaitable[str]]] = None):
+    """Registers a data source answering questions that mention one of `keywords`; earlier ones win ties."""
+    global _pattern
+    _handlers[name] = IntentHandler(name, list(dict.fromkeys(keywords)), handler, description, ahandler)
+    # One alternation with a named group per intent, so a question is scanned only once
+    groups = []
+    for intent in _handlers.values():
+        keywords = sorted(intent.keywords, key=len, reverse=True)
+        groups.append(f"(?P<{intent.name}>{'|'.join(re.escape(keyword) for keyword in keywords)})")
+    _pattern = re.compile("|".join(groups), re.IGNORECASE)
+
+
+def match(question: str) -> List[str]:
+    """Returns the names of all intents whose keywords occur in `question`, in registration order."""
+    if _pattern is None:
+        return []
+    found = {name for m in _pattern.finditer(question) for name, value in m.groupdict().items() if value}
+    return [name for name in _handlers if name in found]
+
+
+def _classifier_input(question: str, candidates: List[str]) -> dict:
+    options = "\n".join(f"{i}: {_handlers[name].description}" for i, name in enumerate(candidates, start=1))
+    return {"options": options, "question": question}
+
+
+def _parse_choice(answer: str, candidates: List[str]) -> Optional[str]:
+    answer = answer.strip()
+    index = int(answer[0]) if answer[:1].isdigit() else 0
+    return candidates[index - 1] if 0 < index <= len(candidates) else None
+
+
+def _classify(question: str, candidates: List[str]) -> Optional[str]:
+    classifier = CLASSIFIER_PROMPT | factory.get("condense_llm") | StrOutputParser()
+    return _parse_choice(classifier.invoke(_classifier_input(question, candidates)), candidates)
+
+
+async def _aclassify(question: str, candidates: List[str]) -> Optional[str]:
+    classifier = (factory.InlineRunnable(CLASSIFIER_PROMPT) | factory.get("condense_llm")
+                  | factory.InlineRunnable(StrOutputParser()))
+    return _parse_choice(await classifier.ainvoke(_classifier_input(question, candidates)), candidates)
+
+
+def _fallback_candidates(matched: List[str]) -> Optional[List[str]]:
+    """The intents to let the LLM choose from, or None if the keywords decide."""
+    ambiguous = len(matched) > 1 or (not matched and INTENT_LLM_FALLBACK == "always")
+    if ambiguous and INTENT_LLM_FALLBACK in ("ambiguous", "always"):
+        return matched or list(_handlers)
+    return None
+
+
+def route(question: str) -> Optional[str]:
+    matched = match(question)
+    candidates = _fallback_candidates(matched)
+    if candidates is not None:
+        key = (" ".join(question.lower().split()), tuple(candidates))
+        return _fallback_cache.get(key, lambda: _classify(question, candidates))
+    return matched[0] if matched else None
+
+
+async def aroute(question: str) -> Optional[str]:
+    matched = match(question)
+    candidates = _fallback_candidates(matched)
+    if candidates is not None:
+        key = (" ".join(question.lower().split()), tuple(candidates))
+        return await _fallback_cache.aget(key, lambda: _aclassify(question, candidates))
+    return matched[0] if matched else None
+
+
+def handle(name: str, question: str) -> str:
+    return _handlers[name].handler(question)
+
+
+async def ahandle(name: str, question: str) -> str:
+    intent = _handlers[name]
+    if intent.ahandler is None:
+        return await asyncio.get_running_loop().run_in_executor(None, intent.handler, question)
+    return await intent.ahandler(question)
@@ -0,0 +1,129 @@
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+from collections import Counter
+from typing import Dict, List, Sequence, Tuple
+
+from langchain.schema import Document
+
+KEYWORD_INDEX_PATH = os.environ.get("KEYWORD_INDEX_PATH", "keywords.sqlite3")
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Keeps identifiers like "IN2064", "00.08.038" or "5602.EG.001" together; their parts are indexed as well
+TOKEN_PATTERN = re.compile(r"\w+(?:[./-]\w+)*")
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "for", "from", "how", "i", "in", "is", "it",
+    "me", "my", "of", "on", "or", "the", "to", "what", "when", "where", "which", "who", "with", "you",
+    "am", "auf", "bei", "das", "dem", "den", "der", "die", "ein", "eine", "einen", "für", "gibt", "ich", "im",
+    "ist", "mit", "und", "von", "was", "wie", "wo", "zu", "zum", "zur",
+}
+
+
+def tokenize(text: str) -> List[str]:
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        parts = re.split(r"[./-]", token)
+        if len(parts) > 1:
+            tokens.append(token)
+        tokens.extend(part for part in parts if part not in STOPWORDS)
+    return tokens
+
+
+class KeywordIndex:
+    """
+    BM25 inverted index of the chunks in SQLite. The crawler writes it next to the vector index;
+    the server opens the same file and only reads from it.
+    """
+
+    def __init__(self, path: str = KEYWORD_INDEX_PATH):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn
+        conn.execute("CREATE TABLE IF NOT EXISTS docs (id TEXT PRIMARY KEY, content TEXT NOT NULL, "
+                     "metadata TEXT NOT NULL, length INTEGER NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS postings (term TEXT NOT NULL, id TEXT NOT NULL, tf INTEGER NOT NULL, "
+                     "PRIMARY KEY (term, id)) WITHOUT ROWID")
+        conn.execute("CREATE INDEX IF NOT EXISTS postings_id ON postings (id)")
+        conn.commit()
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3 connections must not be shared between threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def __len__(self):
+        return self._collection_stats()[0]
+
+    def add(self, documents: Sequence[Document], ids: Sequence[str]):
+        conn = self._conn
+        for document, id in zip(documents, ids):
+            counts = Counter(tokenize(document.page_content))
+            conn.execute("DELETE FROM postings WHERE id = ?", (id,))
+            conn.execute("INSERT OR REPLACE INTO docs (id, content, metadata, length) VALUES (?, ?, ?, ?)",
+                         (id, document.page_content, json.dumps(document.metadata), sum(counts.values())))
+            conn.executemany("INSERT INTO postings (term, id, tf) VALUES (?, ?, ?)",
+                             [(term, id, tf) for term, tf in counts.items()])
+        conn.commit()
+
+    def delete(self, ids: Sequence[str]):
+        conn = self._conn
+        conn.executemany("DELETE FROM postings WHERE id = ?", [(id,) for id in ids])
+        conn.executemany("DELETE FROM docs WHERE id = ?", [(id,) for id in ids])
+        conn.commit()
+
+    def copy_to(self, path: str):
+        """Replaces the index at `path` with a consistent copy of this one."""
+        target = sqlite3.connect(path)
+        try:
+            self._conn.backup(target)
+        finally:
+            target.close()
+
+    def _collection_stats(self) -> Tuple[int, float]:
+        # data_version of a connection changes whenever another connection (the crawler) committed
+        version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        stats = getattr(self._local, "stats", None)
+        if stats is None or stats[0] != version:
+            count, avg_length = self._conn.execute("SELECT COUNT(*), AVG(length) FROM docs").fetchone()
+            stats = self._local.stats = (version, count, avg_length or 0.0)
+        return stats[1], stats[2]
+
+    def search(self, query: str, k: int = 4) -> List[Tuple[Document, float, float]]:
+        """
+        Returns the best `k` chunks with their BM25 score and the share of the query terms they
+        contain (1.0 if all of them).
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        count, avg_length = self._collection_stats()
+        if not terms or count == 0:
+            return []
+        scores: Dict[str, float] = {}
+        matched: Dict[str, int] = {}
+        conn = self._conn
+        for term in terms:
+            postings = conn.execute(
+                "SELECT p.id, p.tf, d.length FROM postings p JOIN docs d ON d.id = p.id WHERE p.term = ?",
+                (term,)).fetchall()
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for id, tf, length in postings:
+                norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+                scores[id] = scores.get(id, 0.0) + idf * tf * (BM25_K1 + 1) / norm
+                matched[id] = matched.get(id, 0) + 1
+        best = sorted(scores, key=scores.get, reverse=True)[:k]
+        results = []
+        for id in best:
+            content, metadata = conn.execute("SELECT content, metadata FROM docs WHERE id = ?", (id,)).fetchone()
+            results.append((Document(page_content=content, metadata=json.loads(metadata)), scores[id],
+                            matched[id] / len(terms)))
+        return results
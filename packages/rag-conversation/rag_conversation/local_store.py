@@ -0,0 +1,285 @@
+import json
+import os
+import uuid
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+from langchain.schema import Document
+from langchain.schema.embeddings import Embeddings
+from langchain.schema.vectorstore import VectorStore
+
+LOCAL_INDEX_PATH = os.environ.get("LOCAL_INDEX_PATH", "index")
+# "exact" scans every vector, "ivf" only probes the closest clusters using int8-quantized vectors
+LOCAL_INDEX_MODE = os.environ.get("LOCAL_INDEX_MODE", "exact")
+LOCAL_INDEX_NPROBE = int(os.environ.get("LOCAL_INDEX_NPROBE", "8"))
+# Candidates per requested result that are re-scored with the full precision vectors in ivf mode
+LOCAL_INDEX_RERANK = int(os.environ.get("LOCAL_INDEX_RERANK", "4"))
+
+VECTORS_FILE = "vectors.npy"
+DOCUMENTS_FILE = "documents.jsonl"
+META_FILE = "meta.json"
+IVF_FILES = ("ivf_centroids.npy", "ivf_order.npy", "ivf_offsets.npy", "ivf_codes.npy", "ivf_scales.npy")
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return (vectors / norms).astype(np.float32)
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    if k >= len(scores):
+        return np.argsort(-scores)
+    top = np.argpartition(-scores, k)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+def _kmeans(vectors: np.ndarray, n_lists: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        for i in range(n_lists):
+            members = vectors[assignments == i]
+            if len(members):
+                centroids[i] = members.mean(axis=0)
+        centroids = _normalize(centroids)
+    return centroids
+
+
+def _save_array(path: str, array: np.ndarray):
+    # np.save appends ".npy" to paths without that suffix, so write through a file object
+    with open(path, "wb") as f:
+        np.save(f, array)
+
+
+class LocalVectorStore(VectorStore):
+    """
+    In-process vector store persisted as a float32 matrix that is memory-mapped for searching.
+    Vectors are L2-normalized, so a dot product is the cosine similarity. In "exact" mode every
+    vector is scored; in "ivf" mode only the `nprobe` closest k-means clusters are scanned with
+    int8-quantized vectors and the best candidates are re-scored exactly. Added, replaced and deleted
+    vectors are kept aside and merged into the matrix once, on `flush` or the next search, so an
+    ingest copies the matrix and rewrites the files (and reclusters) only once.
+    """
+
+    def __init__(self, embedding: Embeddings, path: str = LOCAL_INDEX_PATH, mode: str = LOCAL_INDEX_MODE,
+                 nprobe: int = LOCAL_INDEX_NPROBE):
+        self._embedding = embedding
+        self.path = path
+        self.mode = mode
+        self.nprobe = nprobe
+        self.ids: List[str] = []
+        self.documents: List[Document] = []
+        self._positions = {}
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+        # Changes not merged into `_vectors` yet: rows appended after it, replaced rows by position
+        # and the positions of deleted rows
+        self._appended: List[np.ndarray] = []
+        self._replaced: Dict[int, np.ndarray] = {}
+        self._deleted: Set[int] = set()
+        self._ivf = None
+        # Whether there are changes that `flush` still has to write
+        self._dirty = False
+        # Modification time of the loaded vectors, identifies the served content
+        self.version: Optional[str] = None
+        self.load()
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return self._embedding
+
+    def __len__(self):
+        return len(self._positions)
+
+    def load(self):
+        vectors_path = os.path.join(self.path, VECTORS_FILE)
+        if not os.path.exists(vectors_path):
+            return
+        self._vectors = np.load(vectors_path, mmap_mode="r")
+        self.version = str(os.stat(vectors_path).st_mtime_ns)
+        self.ids, self.documents = [], []
+        with open(os.path.join(self.path, DOCUMENTS_FILE), "r", encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                self.ids.append(record["id"])
+                self.documents.append(Document(page_content=record["page_content"], metadata=record["metadata"]))
+        self._positions = {id: i for i, id in enumerate(self.ids)}
+        self._appended, self._replaced, self._deleted = [], {}, set()
+        self._ivf = None
+        if self.mode == "ivf" and os.path.exists(os.path.join(self.path, IVF_FILES[0])):
+            self._ivf = [np.load(os.path.join(self.path, name), mmap_mode="r") for name in IVF_FILES]
+
+    def _merge(self):
+        """Applies the pending changes to the matrix in one copy."""
+        if not (self._appended or self._replaced or self._deleted):
+            return
+        vectors = np.asarray(self._vectors, dtype=np.float32)
+        if self._appended:
+            dim = self._appended[0].shape[-1]
+            vectors = np.concatenate([vectors.reshape(-1, dim), np.stack(self._appended)])
+        else:
+            vectors = vectors.copy()
+        for position, vector in self._replaced.items():
+            vectors[position] = vector
+        if self._deleted:
+            keep = [i for i in range(len(self.ids)) if i not in self._deleted]
+            vectors = vectors[keep]
+            self.ids = [self.ids[i] for i in keep]
+            self.documents = [self.documents[i] for i in keep]
+            self._positions = {id: i for i, id in enumerate(self.ids)}
+        self._vectors = vectors
+        self._appended, self._replaced, self._deleted = [], {}, set()
+        # The clusters refer to the old rows, search exactly until the next save reclusters
+        self._ivf = None
+
+    def save(self):
+        """
+        Writes all files next to the current ones first and only then swaps them in, the vectors
+        last: their modification time is the version, so readers never see a new version with
+        old files.
+        """
+        self._merge()
+        os.makedirs(self.path, exist_ok=True)
+        vectors = np.asarray(self._vectors, dtype=np.float32)
+        files = []
+
+        def write(name: str, write_file: Callable[[str], None]):
+            tmp_path = os.path.join(self.path, f"{name}.tmp")
+            write_file(tmp_path)
+            files.append((tmp_path, os.path.join(self.path, name)))
+
+        if self.mode == "ivf" and len(vectors):
+            for name, array in zip(IVF_FILES, self._build_ivf(vectors)):
+                write(name, lambda tmp_path, array=array: _save_array(tmp_path, array))
+
+        def write_documents(tmp_path):
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for id, document in zip(self.ids, self.documents):
+                    f.write(json.dumps({"id": id, "page_content": document.page_content,
+                                        "metadata": document.metadata}) + "\n")
+
+        def write_meta(tmp_path):
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"count": len(self.ids), "dim": int(vectors.shape[1]) if vectors.ndim == 2 else 0,
+                           "mode": self.mode}, f)
+
+        write(DOCUMENTS_FILE, write_documents)
+        write(META_FILE, write_meta)
+        write(VECTORS_FILE, lambda tmp_path: _save_array(tmp_path, vectors))
+        if self.mode != "ivf" or not len(vectors):
+            # Drop a stale cluster index so readers in ivf mode fall back to exact search
+            for name in IVF_FILES:
+                if os.path.exists(os.path.join(self.path, name)):
+                    os.remove(os.path.join(self.path, name))
+        for tmp_path, path in files:
+            os.replace(tmp_path, path)
+        self._dirty = False
+        self.load()
+
+    def flush(self):
+        """Persists the vectors added or deleted since the last save."""
+        if self._dirty:
+            self.save()
+
+    def _build_ivf(self, vectors: np.ndarray) -> Tuple[np.ndarray, ...]:
+        n_lists = max(1, int(np.sqrt(len(vectors))))
+        centroids = _kmeans(vectors, n_lists)
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        order = np.argsort(assignments, kind="stable")
+        offsets = np.searchsorted(assignments[order], np.arange(n_lists + 1))
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1
+        codes = np.round(vectors / scales[:, None]).astype(np.int8)
+        return centroids, order, offsets, codes, scales.astype(np.float32)
+
+    def add_vectors(self, vectors: List[List[float]], documents: List[Document], ids: List[str]):
+        new_vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+        merged = len(self.ids) - len(self._appended)
+        for vector, document, id in zip(new_vectors, documents, ids):
+            position = self._positions.get(id)
+            if position is None:
+                self._positions[id] = len(self.ids)
+                self.ids.append(id)
+                self.documents.append(document)
+                self._appended.append(vector)
+                continue
+            if position < merged:
+                self._replaced[position] = vector
+            else:
+                self._appended[position - merged] = vector
+            self.documents[position] = document
+        self._dirty = True
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None,
+                  ids: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        vectors = self._embedding.embed_documents(texts)
+        documents = [Document(page_content=text, metadata=metadata) for text, metadata in zip(texts, metadatas)]
+        self.add_vectors(vectors, documents, ids)
+        return ids
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        removed = [self._positions.pop(id) for id in ids or [] if id in self._positions]
+        if not removed:
+            return False
+        # The rows are only dropped when the changes are merged
+        self._deleted.update(removed)
+        self._dirty = True
+        return True
+
+    def _search_ivf(self, query: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        centroids, order, offsets, codes, scales = self._ivf
+        lists = _top_k(centroids @ query, self.nprobe)
+        candidates = np.concatenate([order[offsets[i]:offsets[i + 1]] for i in lists])
+        if len(candidates) == 0:
+            return candidates, np.zeros(0, dtype=np.float32)
+        approximate = (codes[candidates].astype(np.float32) @ query) * scales[candidates]
+        shortlist = candidates[_top_k(approximate, k * LOCAL_INDEX_RERANK)]
+        scores = self._vectors[shortlist] @ query
+        top = _top_k(scores, k)
+        return shortlist[top], scores[top]
+
+    def similarity_search_with_score_by_vector(self, embedding: List[float], k: int = 4,
+                                               **kwargs: Any) -> List[Tuple[Document, float]]:
+        self._merge()
+        if len(self.ids) == 0:
+            return []
+        query = _normalize(np.asarray(embedding, dtype=np.float32))
+        if self._ivf is not None:
+            rows, scores = self._search_ivf(query, k)
+        else:
+            scores = self._vectors @ query
+            rows = _top_k(scores, k)
+            scores = scores[rows]
+        return [(self.documents[row], float(score)) for row, score in zip(rows, scores)]
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        return [document for document, _ in self.similarity_search_with_score_by_vector(embedding, k, **kwargs)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vector(self._embedding.embed_query(query), k, **kwargs)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [document for document, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    async def asimilarity_search_with_score(self, query: str, k: int = 4,
+                                            **kwargs: Any) -> List[Tuple[Document, float]]:
+        # Only the embedding is awaited, the search itself is a matrix product that runs inline
+        return self.similarity_search_with_score_by_vector(await self._embedding.aembed_query(query), k, **kwargs)
+
+    async def asimilarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [document for document, _ in await self.asimilarity_search_with_score(query, k, **kwargs)]
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        return lambda score: (score + 1) / 2
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None,
+                   ids: Optional[List[str]] = None, path: str = LOCAL_INDEX_PATH, **kwargs: Any) -> "LocalVectorStore":
+        store = cls(embedding, path=path, **kwargs)
+        store.add_texts(texts, metadatas, ids)
+        store.flush()
+        return store
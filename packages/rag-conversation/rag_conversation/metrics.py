@@ -0,0 +1,276 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from uuid import UUID
+
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.schema import LLMResult
+
+# Upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 3000, 4000, 8000, 16000)
+# Metadata key of a run that names the request whose stage timings it reports, see `request_timings`
+TIMINGS_KEY = "timings_id"
+
+
+def _escape(value) -> str:
+    # Label values escape backslash, double quote and line feed in the text exposition format
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield f"{self.name}{_format_labels(labels)} {value}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # Per label set: count per bucket (not cumulative), sum and count
+        self._values: Dict[Tuple, List] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            values = [(labels, list(entry[0]), entry[1], entry[2]) for labels, entry in self._values.items()]
+        for labels, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                yield f"{self.name}_bucket{_format_labels(labels + (('le', repr(float(bound))),))} {cumulative}"
+            yield f"{self.name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}"
+            yield f"{self.name}_sum{_format_labels(labels)} {total}"
+            yield f"{self.name}_count{_format_labels(labels)} {count}"
+
+
+stage_seconds = Histogram("rag_stage_duration_seconds", "Duration of the stages of the RAG chain")
+external_seconds = Histogram("rag_external_call_duration_seconds", "Duration of calls to external services")
+first_token_seconds = Histogram("rag_llm_first_token_seconds", "Time until a streamed LLM call produced its first token")
+llm_tokens = Counter("rag_llm_tokens_total", "Tokens sent to and generated by the LLMs")
+context_tokens = Histogram("rag_context_tokens", "Tokens of context put into the answer prompt", TOKEN_BUCKETS)
+keyword_fastpath = Counter("rag_keyword_fastpath_total", "Retrievals answered from the keyword index alone")
+
+_metrics = [stage_seconds, external_seconds, first_token_seconds, llm_tokens, context_tokens, keyword_fastpath]
+# Caches by name, their hit and miss counters are read when the metrics are scraped
+_caches: Dict[str, Any] = {}
+
+
+def register(metric):
+    _metrics.append(metric)
+    return metric
+
+
+def register_cache(name: str, cache):
+    """Exposes the `hits`, `stale_hits` and `misses` counters of `cache`; a later cache of the same name replaces it."""
+    _caches[name] = cache
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    lines.append("# HELP rag_cache_requests_total Cache lookups by result")
+    lines.append("# TYPE rag_cache_requests_total counter")
+    for name, cache in list(_caches.items()):
+        for result, attribute in (("hit", "hits"), ("stale", "stale_hits"), ("miss", "misses")):
+            if hasattr(cache, attribute):
+                lines.append(f'rag_cache_requests_total{_format_labels((("cache", name), ("result", result)))} '
+                             f'{getattr(cache, attribute)}')
+    return "\n".join(lines) + "\n"
+
+
+class RequestTimings:
+    """Stage durations of one HTTP request, summed per stage, for its Server-Timing header."""
+
+    def __init__(self):
+        self.stages: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def header(self, total: Optional[float] = None) -> str:
+        with self._lock:
+            stages = list(self.stages.items())
+        if total is not None:
+            stages.append(("total", total))
+        return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in stages)
+
+
+# Requests in flight by ID; the chain finds its request through the TIMINGS_KEY metadata of its runs,
+# context variables do not reach the steps that LangChain runs on executor threads
+request_timings: Dict[str, RequestTimings] = {}
+
+
+class StageTimer(BaseCallbackHandler):
+    """
+    Times the named stages of the chain (runs named in `stages`, retrievers and LLM calls) into
+    `stage_seconds` and, for runs with TIMINGS_KEY metadata, into the timings of their request.
+    LLM calls are named after the stage they run in, e.g. the condensation's LLM call is
+    "condense_llm", and their token usage is counted.
+    """
+
+    # Runs inline on the calling thread, it only does bookkeeping
+    run_inline = True
+
+    def __init__(self, stages: Dict[str, str]):
+        self.stages = stages
+        # run ID -> (stage or None, parent run ID, start time, timings ID, model)
+        self._runs: Dict[UUID, Tuple[Optional[str], Optional[UUID], float, Optional[str], Optional[str]]] = {}
+        self._first_tokens: set = set()
+        self._lock = threading.Lock()
+
+    def _enclosing_stage(self, run_id: Optional[UUID]) -> Optional[str]:
+        while run_id is not None:
+            run = self._runs.get(run_id)
+            if run is None:
+                return None
+            if run[0] is not None:
+                return run[0]
+            run_id = run[1]
+        return None
+
+    def _start(self, run_id: UUID, parent_run_id: Optional[UUID], stage: Optional[str],
+               metadata: Optional[Dict[str, Any]], model: Optional[str] = None):
+        with self._lock:
+            self._runs[run_id] = (stage, parent_run_id, time.perf_counter(), (metadata or {}).get(TIMINGS_KEY), model)
+
+    def _end(self, run_id: UUID) -> Optional[Tuple]:
+        with self._lock:
+            run = self._runs.pop(run_id, None)
+            self._first_tokens.discard(run_id)
+        if run is None or run[0] is None:
+            return run
+        seconds = time.perf_counter() - run[2]
+        stage_seconds.observe(seconds, stage=run[0])
+        timings = request_timings.get(run[3]) if run[3] else None
+        if timings is not None:
+            timings.add(run[0], seconds)
+        return run
+
+    def on_chain_start(self, serialized: Dict[str, Any], inputs: Any, *, run_id: UUID,
+                       parent_run_id: Optional[UUID] = None, metadata: Optional[Dict[str, Any]] = None,
+                       **kwargs: Any):
+        self._start(run_id, parent_run_id, self.stages.get(kwargs.get("name")), metadata)
+
+    def on_chain_end(self, outputs: Any, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id)
+
+    def on_chain_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id)
+
+    def on_retriever_start(self, serialized: Dict[str, Any], query: str, *, run_id: UUID,
+                           parent_run_id: Optional[UUID] = None, metadata: Optional[Dict[str, Any]] = None,
+                           **kwargs: Any):
+        with self._lock:
+            parent = self._runs.get(parent_run_id)
+        # The vector retriever inside the hybrid retriever reports separately
+        stage = "vector_search" if parent is not None and parent[0] in ("retrieve", "vector_search") else "retrieve"
+        self._start(run_id, parent_run_id, stage, metadata)
+
+    def on_retriever_end(self, documents: Any, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id)
+
+    def on_retriever_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id)
+
+    def _start_llm(self, serialized: Dict[str, Any], run_id: UUID, parent_run_id: Optional[UUID],
+                   metadata: Optional[Dict[str, Any]]):
+        with self._lock:
+            enclosing = self._enclosing_stage(parent_run_id)
+        kwargs = serialized.get("kwargs", {})
+        model = kwargs.get("model_name") or kwargs.get("model") or serialized.get("id", ["llm"])[-1]
+        self._start(run_id, parent_run_id, f"{enclosing}_llm" if enclosing else "llm", metadata, model)
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID,
+                     parent_run_id: Optional[UUID] = None, metadata: Optional[Dict[str, Any]] = None,
+                     **kwargs: Any):
+        self._start_llm(serialized, run_id, parent_run_id, metadata)
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[Any]], *, run_id: UUID,
+                            parent_run_id: Optional[UUID] = None, metadata: Optional[Dict[str, Any]] = None,
+                            **kwargs: Any):
+        self._start_llm(serialized, run_id, parent_run_id, metadata)
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any):
+        with self._lock:
+            run = self._runs.get(run_id)
+            if run is None or run_id in self._first_tokens:
+                return
+            self._first_tokens.add(run_id)
+        first_token_seconds.observe(time.perf_counter() - run[2], stage=run[0])
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any):
+        run = self._end(run_id)
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        model = run[4] if run is not None else "llm"
+        # Streamed calls report no usage, only the generated tokens can be counted then
+        if usage:
+            llm_tokens.inc(usage.get("prompt_tokens", 0), model=model, type="prompt")
+            llm_tokens.inc(usage.get("completion_tokens", 0), model=model, type="completion")
+        else:
+            from rag_conversation.context import count_tokens
+
+            text = "".join(generation.text for generations in response.generations for generation in generations)
+            llm_tokens.inc(count_tokens(text), model=model, type="completion")
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id)
+
+
+@contextmanager
+def timed_call(service: str):
+    """Times a call to an external service into `external_seconds`."""
+    with external_seconds.time(service=service):
+        yield
+
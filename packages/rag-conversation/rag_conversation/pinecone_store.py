@@ -0,0 +1,32 @@
+import asyncio
+from functools import partial
+from typing import Any, List, Optional, Tuple
+
+from langchain.schema import Document
+from langchain.vectorstores import Pinecone
+
+
+class AsyncPinecone(Pinecone):
+    """
+    Pinecone store whose async search awaits the query embedding instead of waiting for it on a
+    thread. The Pinecone client has no async API, so only the query itself runs in the executor.
+    """
+
+    async def asimilarity_search_with_score(self, query: str, k: int = 4, filter: Optional[dict] = None,
+                                            namespace: Optional[str] = None,
+                                            **kwargs: Any) -> List[Tuple[Document, float]]:
+        embedding = await self._embedding.aembed_query(query)
+        search = partial(self.similarity_search_by_vector_with_score, embedding, k=k, filter=filter, namespace=namespace)
+        return await asyncio.get_running_loop().run_in_executor(None, search)
+
+    async def asimilarity_search(self, query: str, k: int = 4, filter: Optional[dict] = None,
+                                 namespace: Optional[str] = None, **kwargs: Any) -> List[Document]:
+        return [document for document, _ in await self.asimilarity_search_with_score(query, k, filter, namespace)]
+
+    def copy_to(self, namespace: str, ids: List[str], batch_size: int = 100):
+        """Copies the vectors `ids` with their metadata into `namespace`, without embedding them again."""
+        for i in range(0, len(ids), batch_size):
+            fetched = self._index.fetch(ids=ids[i:i + batch_size], namespace=self._namespace)
+            vectors = [(id, vector.values, vector.get("metadata", {})) for id, vector in fetched.vectors.items()]
+            if vectors:
+                self._index.upsert(vectors=vectors, namespace=namespace, show_progress=False)
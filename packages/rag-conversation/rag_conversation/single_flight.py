@@ -0,0 +1,189 @@
+import asyncio
+import os
+import threading
+from typing import Any, AsyncIterator, Callable, Dict, Hashable, Iterator, List, Optional, Tuple
+
+from langchain.schema.runnable import Runnable, RunnableConfig
+
+from rag_conversation import metrics
+
+SINGLE_FLIGHT_ENABLED = os.environ.get("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+
+coalesced = metrics.register(metrics.Counter(
+    "rag_single_flight_total", "Requests that started a call (leader) or shared one already in flight (follower)"))
+
+
+class Flight:
+    """
+    One call in flight whose output is shared by every request that asked for the same thing. The
+    chunks are kept until the flight finishes, so a request joining late still gets the whole output.
+    Followers can wait on a thread or on an event loop, whichever the leader runs on.
+    """
+
+    def __init__(self):
+        self.chunks: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self._condition = threading.Condition()
+        self._events: List[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = []
+
+    def _notify(self):
+        with self._condition:
+            self._condition.notify_all()
+            events = list(self._events)
+        for loop, event in events:
+            loop.call_soon_threadsafe(event.set)
+
+    def add(self, chunk: Any):
+        with self._condition:
+            self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self, error: Optional[BaseException] = None):
+        with self._condition:
+            self.done = True
+            self.error = error
+        self._notify()
+
+    def _next(self, index: int) -> Tuple[List[Any], bool]:
+        with self._condition:
+            return self.chunks[index:], self.done
+
+    def follow(self) -> Iterator[Any]:
+        index = 0
+        while True:
+            with self._condition:
+                while index >= len(self.chunks) and not self.done:
+                    self._condition.wait()
+            chunks, done = self._next(index)
+            index += len(chunks)
+            yield from chunks
+            if done and not chunks:
+                break
+        if self.error is not None:
+            raise self.error
+
+    async def afollow(self) -> AsyncIterator[Any]:
+        event = asyncio.Event()
+        with self._condition:
+            self._events.append((asyncio.get_running_loop(), event))
+        try:
+            index = 0
+            while True:
+                # Cleared before reading, so a chunk added in between sets it again
+                event.clear()
+                chunks, done = self._next(index)
+                index += len(chunks)
+                for chunk in chunks:
+                    yield chunk
+                if done and not chunks:
+                    break
+                if not chunks:
+                    await event.wait()
+        finally:
+            with self._condition:
+                self._events = [entry for entry in self._events if entry[1] is not event]
+        if self.error is not None:
+            raise self.error
+
+
+class SingleFlight:
+    """Flights in progress by key; a key is free again as soon as its flight finished."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._flights: Dict[Hashable, Flight] = {}
+        self._lock = threading.Lock()
+        # Detached leader calls, referenced until they finish
+        self._tasks = set()
+
+    def join(self, key: Hashable) -> Tuple[Flight, bool]:
+        """The flight for `key` and whether the caller is its leader, i.e. has to make the call."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+        coalesced.inc(group=self.name, role="leader" if leader else "follower")
+        return flight, leader
+
+    def land(self, key: Hashable, flight: Flight, error: Optional[BaseException] = None):
+        if error is not None and not isinstance(error, Exception):
+            # The leader was stopped (closed generator, cancelled task), its followers get an error instead
+            error = RuntimeError(f"Shared {self.name} call was interrupted")
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.finish(error)
+
+    def stream(self, key: Hashable, produce: Callable[[], Iterator[Any]]) -> Iterator[Any]:
+        flight, leader = self.join(key)
+        if not leader:
+            yield from flight.follow()
+            return
+        try:
+            for chunk in produce():
+                flight.add(chunk)
+                yield chunk
+        except BaseException as e:
+            self.land(key, flight, e)
+            raise
+        self.land(key, flight)
+
+    def call(self, key: Hashable, produce: Callable[[], Any]) -> Any:
+        return list(self.stream(key, lambda: iter([produce()])))[0]
+
+    async def astream(self, key: Hashable, produce: Callable[[], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        flight, leader = self.join(key)
+        if leader:
+            # Runs detached from the leader's request, a leader whose client disconnects does not
+            # cancel the call for its followers
+            async def run():
+                try:
+                    async for chunk in produce():
+                        flight.add(chunk)
+                except BaseException as e:
+                    self.land(key, flight, e)
+                    return
+                self.land(key, flight)
+
+            task = asyncio.ensure_future(run())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        async for chunk in flight.afollow():
+            yield chunk
+
+    async def acall(self, key: Hashable, produce: Callable[[], Any]) -> Any:
+        async def produce_one():
+            yield await produce()
+
+        return [chunk async for chunk in self.astream(key, produce_one)][0]
+
+
+class SingleFlightRunnable(Runnable):
+    """Runs `runnable` once for concurrent invocations whose inputs have the same `key`."""
+
+    def __init__(self, runnable: Runnable, key: Callable[[Any], Hashable], name: str,
+                 enabled: bool = SINGLE_FLIGHT_ENABLED):
+        self.runnable = runnable
+        self.key = key
+        self.flights = SingleFlight(name)
+        self.enabled = enabled
+
+    @property
+    def InputType(self) -> Any:
+        return self.runnable.InputType
+
+    @property
+    def OutputType(self) -> Any:
+        return self.runnable.OutputType
+
+    def invoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        if not self.enabled:
+            return self.runnable.invoke(input, config, **kwargs)
+        return self.flights.call(self.key(input), lambda: self.runnable.invoke(input, config, **kwargs))
+
+    async def ainvoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        if not self.enabled:
+            return await self.runnable.ainvoke(input, config, **kwargs)
+        return await self.flights.acall(self.key(input), lambda: self.runnable.ainvoke(input, config, **kwargs))
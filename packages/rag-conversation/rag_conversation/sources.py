@@ -0,0 +1,109 @@
+import asyncio
+import datetime
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+import httpx
+import requests
+
+from rag_conversation import metrics
+from rag_conversation.cache import TTLCache
+
+EAT_API_URL = "https://tum-dev.github.io/eat-api/en/mensa-garching/{year}/{week}.json"
+IRIS_API_URL = "https://iris.asta.tum.de/api/"
+REQUEST_TIMEOUT = float(os.environ.get("SOURCES_TIMEOUT", "10"))
+# Connections of the async client shared by all requests of the event loop
+SOURCES_MAX_CONNECTIONS = int(os.environ.get("SOURCES_MAX_CONNECTIONS", "20"))
+
+# The meal plan of a week rarely changes once published, the room availability changes during the day
+MENSA_TTL = float(os.environ.get("MENSA_TTL", str(6 * 60 * 60)))
+MENSA_STALE_TTL = float(os.environ.get("MENSA_STALE_TTL", str(24 * 60 * 60)))
+ROOMS_TTL = float(os.environ.get("ROOMS_TTL", str(5 * 60)))
+ROOMS_STALE_TTL = float(os.environ.get("ROOMS_STALE_TTL", str(30 * 60)))
+
+mensa_cache = TTLCache(MENSA_TTL, MENSA_STALE_TTL)
+rooms_cache = TTLCache(ROOMS_TTL, ROOMS_STALE_TTL, max_entries=1)
+metrics.register_cache("mensa", mensa_cache)
+metrics.register_cache("rooms", rooms_cache)
+
+_session = requests.Session()
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="sources")
+_async_client: Optional[httpx.AsyncClient] = None
+_async_client_loop = None
+
+
+def _get_json(url: str):
+    response = _session.get(url, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+
+def _fetch(service: str, url: str):
+    with metrics.timed_call(service):
+        return _get_json(url)
+
+
+def _client() -> httpx.AsyncClient:
+    """The async client of the running event loop; its connections belong to that loop."""
+    global _async_client, _async_client_loop
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client_loop is not loop:
+        _async_client = httpx.AsyncClient(timeout=REQUEST_TIMEOUT,
+                                          limits=httpx.Limits(max_connections=SOURCES_MAX_CONNECTIONS))
+        _async_client_loop = loop
+    return _async_client
+
+
+async def aclose():
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+
+async def _aget_json(url: str):
+    response = await _client().get(url)
+    response.raise_for_status()
+    return response.json()
+
+
+async def _afetch(service: str, url: str):
+    with metrics.timed_call(service):
+        return await _aget_json(url)
+
+
+def iso_week(date: datetime.date) -> Tuple[int, int]:
+    year, week, _ = date.isocalendar()
+    return year, week
+
+
+def get_mensa_week(year: int, week: int) -> dict:
+    return mensa_cache.get((year, week), lambda: _fetch("eat-api", EAT_API_URL.format(year=year, week=week)))
+
+
+def get_mensa_weeks(today: datetime.date) -> List[dict]:
+    """Returns the meal plans of the current and the next ISO week, fetching both concurrently."""
+    weeks = [iso_week(today), iso_week(today + datetime.timedelta(days=7))]
+    return list(_executor.map(lambda key: get_mensa_week(*key), weeks))
+
+
+def get_rooms() -> List[dict]:
+    return rooms_cache.get("rooms", lambda: _fetch("iris", IRIS_API_URL)["raeume"])
+
+
+async def aget_mensa_week(year: int, week: int) -> dict:
+    return await mensa_cache.aget(
+        (year, week), lambda: _afetch("eat-api", EAT_API_URL.format(year=year, week=week)))
+
+
+async def aget_mensa_weeks(today: datetime.date) -> List[dict]:
+    weeks = [iso_week(today), iso_week(today + datetime.timedelta(days=7))]
+    return list(await asyncio.gather(*(aget_mensa_week(*key) for key in weeks)))
+
+
+async def aget_rooms() -> List[dict]:
+    async def load():
+        return (await _afetch("iris", IRIS_API_URL))["raeume"]
+
+    return await rooms_cache.aget("rooms", load)
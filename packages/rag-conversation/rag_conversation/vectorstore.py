@@ -0,0 +1,55 @@
+import os
+import shutil
+from typing import List, Optional
+
+from langchain.schema.embeddings import Embeddings
+from langchain.schema.vectorstore import VectorStore
+
+# "pinecone" or "local"
+VECTOR_STORE = os.environ.get("VECTOR_STORE", "pinecone")
+
+PINECONE_INDEX_NAME = os.environ.get("PINECONE_INDEX", "langchain-test")
+# Bump after re-ingesting into an index that does not track its own version, e.g. Pinecone
+INDEX_VERSION = os.environ.get("INDEX_VERSION", "0")
+
+
+def get_vectorstore(embedding: Embeddings, backend: str = VECTOR_STORE, version: Optional[str] = None) -> VectorStore:
+    """Opens the index version `version` (a Pinecone namespace or a subdirectory of the local store)."""
+    if backend == "local":
+        from rag_conversation.local_store import LOCAL_INDEX_PATH, LocalVectorStore
+
+        return LocalVectorStore(embedding, path=os.path.join(LOCAL_INDEX_PATH, version) if version else LOCAL_INDEX_PATH)
+
+    if backend == "pinecone":
+        from rag_conversation.pinecone_store import AsyncPinecone
+
+        if os.environ.get("PINECONE_API_KEY", None) is None:
+            raise Exception("Missing `PINECONE_API_KEY` environment variable.")
+
+        if os.environ.get("PINECONE_ENVIRONMENT", None) is None:
+            raise Exception("Missing `PINECONE_ENVIRONMENT` environment variable.")
+
+        return AsyncPinecone.from_existing_index(PINECONE_INDEX_NAME, embedding, namespace=version)
+
+    raise ValueError(f"Unknown vector store `{backend}`, expected `pinecone` or `local`.")
+
+
+def delete_version(embedding: Embeddings, version: str, backend: str = VECTOR_STORE):
+    if backend == "local":
+        from rag_conversation.local_store import LOCAL_INDEX_PATH
+
+        shutil.rmtree(os.path.join(LOCAL_INDEX_PATH, version), ignore_errors=True)
+    else:
+        get_vectorstore(embedding, backend, version).delete(delete_all=True, namespace=version)
+
+
+def copy_version(embedding: Embeddings, source: str, target: str, ids: List[str], backend: str = VECTOR_STORE):
+    """Copies the vectors `ids` of the index version `source` into `target`; the local store copies the whole version."""
+    if backend == "local":
+        from rag_conversation.local_store import LOCAL_INDEX_PATH
+
+        source_path, target_path = os.path.join(LOCAL_INDEX_PATH, source), os.path.join(LOCAL_INDEX_PATH, target)
+        if os.path.isdir(source_path):
+            shutil.copytree(source_path, target_path, dirs_exist_ok=True)
+    else:
+        get_vectorstore(embedding, backend, source).copy_to(target, ids)
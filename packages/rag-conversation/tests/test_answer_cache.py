@@ -0,0 +1,69 @@
+import asyncio
+
+from langchain.schema.messages import AIMessage, HumanMessage
+from langchain.schema.runnable import RunnableLambda
+
+from rag_conversation import factory
+from rag_conversation.answer_cache import AnswerCacheRunnable, SemanticAnswerCache
+
+
+def chain_input(history):
+    return {"question": "What is my name?", "standalone_question": "What is my name?", "context": "TUM",
+            "intent": None, "chat_history": history}
+
+
+ALICE = [HumanMessage(content="My name is Alice"), AIMessage(content="Hello Alice")]
+BOB = [HumanMessage(content="I am Bob"), AIMessage(content="Hello Bob")]
+
+
+def answering_llm(calls):
+    async def answer(input):
+        calls.append(input)
+        await asyncio.sleep(0.05)
+        return input["chat_history"][0].content if input["chat_history"] else "I do not know"
+
+    return RunnableLambda(lambda input: None, afunc=answer)
+
+
+def test_concurrent_requests_with_different_histories_get_their_own_answer():
+    calls = []
+    runnable = AnswerCacheRunnable(answering_llm(calls), cache=SemanticAnswerCache(), enabled=False, single_flight=True)
+
+    async def run():
+        return await asyncio.gather(runnable.ainvoke(chain_input(ALICE)), runnable.ainvoke(chain_input(BOB)))
+
+    assert asyncio.run(run()) == ["My name is Alice", "I am Bob"]
+    assert len(calls) == 2
+
+
+def test_concurrent_identical_requests_share_one_call():
+    calls = []
+    runnable = AnswerCacheRunnable(answering_llm(calls), cache=SemanticAnswerCache(), enabled=False, single_flight=True)
+
+    async def run():
+        return await asyncio.gather(*[runnable.ainvoke(chain_input(ALICE)) for _ in range(3)])
+
+    assert asyncio.run(run()) == ["My name is Alice"] * 3
+    assert len(calls) == 1
+
+
+def test_answers_to_one_history_are_not_served_to_another(monkeypatch):
+    monkeypatch.setattr(factory, "get", lambda name: None)
+    monkeypatch.setattr(factory, "index_version", lambda: "v1")
+    calls = []
+    runnable = AnswerCacheRunnable(answering_llm(calls), cache=SemanticAnswerCache(), enabled=True, single_flight=False)
+
+    assert asyncio.run(runnable.ainvoke(chain_input(ALICE))) == "My name is Alice"
+    assert asyncio.run(runnable.ainvoke(chain_input(BOB))) == "I am Bob"
+    assert len(calls) == 2
+
+
+def test_answers_without_history_are_cached(monkeypatch):
+    monkeypatch.setattr(factory, "get", lambda name: None)
+    monkeypatch.setattr(factory, "index_version", lambda: "v1")
+    calls = []
+    runnable = AnswerCacheRunnable(answering_llm(calls), cache=SemanticAnswerCache(), enabled=True, single_flight=False)
+
+    assert asyncio.run(runnable.ainvoke(chain_input([]))) == "I do not know"
+    assert runnable.invoke(chain_input([])) == "I do not know"
+    assert len(calls) == 1
@@ -0,0 +1,28 @@
+import pytest
+
+from rag_conversation.condense import needs_condensation
+
+
+@pytest.mark.parametrize("question", [
+    "Wie kann ich mich für das Masterstudium Informatik bewerben?",
+    "Is it possible to take more than 30 credits per semester?",
+    "Welche Unterlagen brauche ich auch für die Immatrikulation?",
+    "Can I still register for exams after the deadline?",
+    "Gibt es noch freie Plätze in der Studienberatung?",
+    "What other master programs does the CIT school offer?",
+    "Wann sind die Öffnungszeiten der Bibliothek in Garching?",
+    "Where can I find the module handbook for Informatics?",
+])
+def test_self_contained_questions_skip_condensation(question):
+    assert not needs_condensation(question)
+
+
+@pytest.mark.parametrize("question", [
+    "Und was kostet das?",
+    "What about the summer semester?",
+    "Wie melde ich mich dafür an?",
+    "When is the deadline for the first one?",
+    "Do they also accept English certificates?",
+])
+def test_follow_up_questions_are_condensed(question):
+    assert needs_condensation(question)